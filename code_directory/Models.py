@@ -4,6 +4,24 @@ import torch
 from code_directory.inference import infer_heads
 
 
+def drop_words(word_idx, appearance_count, a=0.25, unk_ind=0, mask=None, generator=None):
+    """
+    replaces every word with the unknown word with probability a / (a + number of appearances of the word)
+    :param word_idx: a tensor from the shape (B, T) of word indices where the first position is the ROOT, the ROOT
+    is never dropped
+    :param appearance_count: a tensor of the number of appearances of every word index
+    :param mask: a bool tensor from the shape (B, T), only the True positions may be dropped (None for all)
+    :param generator: the torch.Generator to draw the randomness from
+    :return: the word indices after the dropout
+    """
+    p = a / (a + appearance_count[word_idx])
+    drop_idx = torch.rand(word_idx.shape, generator=generator) < p
+    drop_idx[:, 0] = False
+    if mask is not None:
+        drop_idx &= mask
+    return word_idx.masked_fill(drop_idx, unk_ind)
+
+
 class WordDropout(nn.Module):
     def __init__(self, appearance_count, a=0.25, unk_ind=0):
         super().__init__()
@@ -11,16 +29,154 @@ class WordDropout(nn.Module):
         self.a = float(a)
         self.unk_ind = unk_ind
 
-    def forward(self, word_idx):
+    def forward(self, word_idx, mask=None, generator=None):
         if self.training and self.appearance_count is not None:
-            out = word_idx.clone()
-            p = self.a / (self.a + self.appearance_count[word_idx.squeeze(0)])
-            drop_idx = torch.rand(word_idx.shape[1], requires_grad=False) < p
-            out[0][drop_idx] = self.unk_ind
-            return out
+            return drop_words(word_idx, self.appearance_count, self.a, self.unk_ind, mask, generator)
         return word_idx
 
 
+class LowRankEmbedding(nn.Module):
+    """
+    a word embedding factorised to a table of rank dimensions and a projection to embedding_dim, (num_embeddings +
+    embedding_dim) * rank values instead of num_embeddings * embedding_dim, a lookup decompresses only its rows
+    """
+    def __init__(self, num_embeddings, embedding_dim, rank=16, sparse=False):
+        super().__init__()
+        self.embedding_dim = embedding_dim
+        self.factors = nn.Embedding(num_embeddings, rank, sparse=sparse)
+        self.projection = nn.Linear(rank, embedding_dim, bias=False)
+
+    @classmethod
+    def from_pretrained(cls, embeddings, rank=16, freeze=True, sparse=False):
+        """
+        :return: the best rank approximation (the truncated SVD) of a (num_embeddings, embedding_dim) table
+        """
+        module = cls(embeddings.shape[0], embeddings.shape[1], rank, sparse)
+        u, s, vh = torch.linalg.svd(embeddings.float(), full_matrices=False)
+        with torch.no_grad():
+            module.factors.weight.copy_(u[:, :rank] * s[:rank])
+            module.projection.weight.copy_(vh[:rank].t())
+        module.requires_grad_(not freeze)
+        return module
+
+    @property
+    def weight(self):
+        """
+        the decompressed table
+        """
+        return self.projection(self.factors.weight)
+
+    def forward(self, word_idx):
+        return self.projection(self.factors(word_idx))
+
+
+def _kmeans(points, num_centroids, iterations=20, chunk_size=65536, generator=None):
+    """
+    :return: the centroids (num_centroids, dim) of the points (N, dim) and the index of the centroid of every point
+    """
+    start = torch.randperm(len(points), generator=generator)[:num_centroids]
+    centroids = points[start.repeat(math.ceil(num_centroids / len(start)))[:num_centroids]].clone()
+    for _ in range(iterations + 1):
+        assignment = torch.cat([torch.cdist(chunk, centroids).argmin(dim=1) for chunk in points.split(chunk_size)])
+        sums = torch.zeros_like(centroids).index_add_(0, assignment, points)
+        counts = torch.bincount(assignment, minlength=num_centroids).unsqueeze(1)
+        # the centroids without points stay where they are
+        centroids = torch.where(counts > 0, sums / counts.clamp(min=1), centroids)
+    return centroids, assignment
+
+
+class ProductQuantizedEmbedding(nn.Module):
+    """
+    a word embedding stored as product quantization codes: the embedding_dim dimensions are split to num_subspaces
+    subspaces, and every word has one byte in every subspace, the index of one of the num_centroids centroids of
+    the codebook of the subspace. a lookup concatenates the centroids of the codes of the word, num_embeddings *
+    num_subspaces bytes and the codebooks instead of num_embeddings * embedding_dim floats. the codes of a new module
+    are random (the codebooks are trained as the table of a hashing of every subspace), from_pretrained quantizes a
+    trained table
+    """
+    def __init__(self, num_embeddings, embedding_dim, num_subspaces=4, num_centroids=256):
+        super().__init__()
+        if embedding_dim % num_subspaces != 0:
+            raise ValueError('the embedding dim {} is not divisible to {} subspaces'.format(embedding_dim,
+                                                                                         num_subspaces))
+        if num_centroids > 256:
+            raise ValueError('the codes are bytes, there can be at most 256 centroids')
+        self.embedding_dim = embedding_dim
+        self.codebooks = nn.Parameter(torch.randn(num_subspaces, num_centroids, embedding_dim // num_subspaces))
+        self.register_buffer('codes', torch.randint(0, num_centroids, (num_embeddings, num_subspaces),
+                                                    dtype=torch.uint8))
+
+    @classmethod
+    def from_pretrained(cls, embeddings, num_subspaces=4, num_centroids=256, freeze=True, iterations=20, seed=0):
+        """
+        :return: the product quantization of a (num_embeddings, embedding_dim) table, with k-means in every subspace
+        """
+        module = cls(embeddings.shape[0], embeddings.shape[1], num_subspaces, num_centroids)
+        generator = torch.Generator().manual_seed(seed)
+        with torch.no_grad():
+            for subspace, points in enumerate(embeddings.float().cpu().chunk(num_subspaces, dim=1)):
+                centroids, assignment = _kmeans(points.contiguous(), num_centroids, iterations, generator=generator)
+                module.codebooks[subspace] = centroids
+                module.codes[:, subspace] = assignment.to(torch.uint8)
+        module.requires_grad_(not freeze)
+        return module
+
+    @property
+    def weight(self):
+        """
+        the decompressed table
+        """
+        return self(torch.arange(len(self.codes), device=self.codes.device))
+
+    def forward(self, word_idx):
+        codes = self.codes[word_idx].long()  # (..., num_subspaces)
+        subspaces = torch.arange(codes.shape[-1], device=codes.device)
+        return self.codebooks[subspaces, codes].flatten(-2)
+
+
+def make_word_embedding(word_vocab_size, word_emb_dim, pre_trained_word_embedding=None, freeze_word_embedding=True,
+                        sparse=False, compression=None):
+    """
+    :param pre_trained_word_embedding: the table to start from (compressed if compression is given), None for random
+    :param freeze_word_embedding: if True a pre trained table (or its factors or codebooks) is not trained
+    :param sparse: if True the gradients of the table (or of the factors of a low rank table) are sparse
+    :param compression: None for a full table, {'type': 'low_rank', 'rank': r} for a LowRankEmbedding,
+    {'type': 'pq', 'num_subspaces': m, 'num_centroids': k} for a ProductQuantizedEmbedding
+    :return: the word embedding of a model
+    """
+    if compression is None:
+        if pre_trained_word_embedding is None:
+            return nn.Embedding(word_vocab_size, word_emb_dim, sparse=sparse)
+        return nn.Embedding.from_pretrained(pre_trained_word_embedding, freeze=freeze_word_embedding, sparse=sparse)
+    kwargs = {key: value for key, value in compression.items() if key != 'type'}
+    if compression['type'] == 'low_rank':
+        if pre_trained_word_embedding is None:
+            return LowRankEmbedding(word_vocab_size, word_emb_dim, sparse=sparse, **kwargs)
+        return LowRankEmbedding.from_pretrained(pre_trained_word_embedding, freeze=freeze_word_embedding,
+                                                sparse=sparse, **kwargs)
+    if compression['type'] == 'pq':
+        if pre_trained_word_embedding is None:
+            return ProductQuantizedEmbedding(word_vocab_size, word_emb_dim, **kwargs)
+        return ProductQuantizedEmbedding.from_pretrained(pre_trained_word_embedding, freeze=freeze_word_embedding,
+                                                         **kwargs)
+    raise ValueError('unknown word embedding compression: {}'.format(compression['type']))
+
+
+def compress_word_embedding(model, compression):
+    """
+    replaces the word embedding of a trained BaseNet, AdvancedNet or JointNet by a compressed one made from it (see
+    make_word_embedding), the model can be saved and loaded as before
+    :return: the model
+    """
+    word_embedding = model.word_embedding
+    model.word_embedding = make_word_embedding(
+        len(word_embedding.weight), word_embedding.embedding_dim, word_embedding.weight.detach().cpu(),
+        freeze_word_embedding=not any(parameter.requires_grad for parameter in word_embedding.parameters()),
+        compression=compression).to(model.device)
+    model.args['word_embedding_compression'] = compression
+    return model
+
+
 class AdditiveAttention(nn.Module):
     def __init__(self, in_dim, hidden_dim=100, dropout=0.1):
         super().__init__()
@@ -66,31 +222,207 @@ class MultiplicativeAttention(nn.Module):
         return out
 
 
+class BiaffineAttention(nn.Module):
+    """
+    the biaffine arc scorer of Dozat & Manning: the head and modifier representations come from one fused projection
+    and the score of (h, m) is head_h U modifier_m + head_h u, computed with batched matmuls only (no intermediate of
+    the shape (B, T, T, hidden_dim))
+    """
+    def __init__(self, in_dim, hidden_dim=100, dropout=0.1):
+        super().__init__()
+        self.hidden_dim = hidden_dim
+        self.projection = nn.Sequential(
+            nn.Linear(in_dim, 2 * hidden_dim),
+            nn.ReLU(),
+            nn.Dropout(p=dropout)
+        )
+        self.weight = nn.Parameter(nn.init.xavier_uniform_(torch.empty(hidden_dim, hidden_dim)))
+        self.head_bias = nn.Parameter(torch.zeros(hidden_dim))
+
+    def forward(self, q, k):
+        if q is k:
+            head, modifier = self.projection(q).split(self.hidden_dim, dim=2)
+        else:
+            head = self.projection(q)[:, :, :self.hidden_dim]
+            modifier = self.projection(k)[:, :, self.hidden_dim:]
+        out = torch.bmm(head @ self.weight, modifier.transpose(1, 2))  # (B, T, T), [b, h, m]
+        return out + (head @ self.head_bias).unsqueeze(2)
+
+
+class LabelClassifier(nn.Module):
+    """
+    scores the relation labels of given arcs with a biaffine classifier over the head and the modifier of every arc
+    (Dozat & Manning): the score of label l for (h, m) is head_h U_l modifier_m + W_l [head_h; modifier_m] + b_l. it
+    is evaluated on one arc per word (the gold or the predicted head), so its cost is linear in the sentence length,
+    full_scores scores every (h, m) pair for comparison
+    """
+    def __init__(self, in_dim, num_labels, hidden_dim=100, dropout=0.):
+        super().__init__()
+        self.hidden_dim = hidden_dim
+        self.projection = nn.Sequential(
+            nn.Linear(in_dim, 2 * hidden_dim),
+            nn.ReLU(),
+            nn.Dropout(p=dropout)
+        )
+        self.bilinear = nn.Bilinear(hidden_dim, hidden_dim, num_labels, bias=False)
+        self.linear = nn.Linear(2 * hidden_dim, num_labels)
+
+    def forward(self, encoding, heads):
+        """
+        :param encoding: a tensor from the shape (B, T+1, in_dim) of the encoded sentences (the ROOT first)
+        :param heads: a tensor from the shape (B, T) of the head of every word (any head in [0, T] at padded words)
+        :return: a tensor from the shape (B, T, num_labels) of the scores of the labels of the arcs (heads[b, m-1], m)
+        """
+        head, modifier = self.projection(encoding).split(self.hidden_dim, dim=2)
+        head = head.gather(1, heads.to(head.device).unsqueeze(2).expand(-1, -1, self.hidden_dim))
+        modifier = modifier[:, 1:]
+        return self.bilinear(head, modifier) + self.linear(torch.cat((head, modifier), dim=2))
+
+    def full_scores(self, encoding):
+        """
+        :return: a tensor from the shape (B, num_labels, T+1, T) of the scores of the labels of every (h, m)
+        """
+        head, modifier = self.projection(encoding).split(self.hidden_dim, dim=2)
+        modifier = modifier[:, 1:]
+        weight_head, weight_modifier = self.linear.weight.split(self.hidden_dim, dim=1)
+        out = torch.einsum('bhi,lij,bmj->blhm', head, self.bilinear.weight, modifier)
+        out = out + (head @ weight_head.t()).permute(0, 2, 1).unsqueeze(3)
+        out = out + (modifier @ weight_modifier.t()).permute(0, 2, 1).unsqueeze(2)
+        return out + self.linear.bias.view(1, -1, 1, 1)
+
+
+def _lstm_recurrence(input_gates, weight_hh):
+    """
+    runs all the directions of an LSTM layer together, its input projections (and biases) are already in
+    input_gates (directions, B, T, 4H) and the second direction runs backwards
+    """
+    num_directions, _, seq_len, _ = input_gates.shape
+    hidden_dim = weight_hh.shape[2]
+    if num_directions == 2:
+        input_gates = torch.stack((input_gates[0], input_gates[1].flip(1)))
+    input_gates = input_gates.permute(2, 0, 1, 3)  # (T, directions, B, 4H) in the order every direction reads it
+    weight_hh = weight_hh.transpose(1, 2)
+    h = input_gates.new_zeros((num_directions, input_gates.shape[2], hidden_dim))
+    c = torch.zeros_like(h)
+    outputs = []
+    for t in range(seq_len):
+        gates = torch.baddbmm(input_gates[t], h, weight_hh)
+        i, f, g, o = gates.chunk(4, 2)
+        c = torch.sigmoid(f) * c + torch.sigmoid(i) * torch.tanh(g)
+        h = torch.sigmoid(o) * torch.tanh(c)
+        outputs.append(h)
+    out = torch.stack(outputs, dim=2)  # (directions, B, T, H)
+    if num_directions == 2:
+        out = torch.stack((out[0], out[1].flip(1)))
+    return torch.cat(out.unbind(0), dim=2)
+
+
+def _drop_upper_lstm_state(module, state_dict, prefix, local_metadata):
+    for key in [key for key in state_dict if key.startswith(prefix + 'upper_lstm.')]:
+        del state_dict[key]
+
+
+class FusedInputLSTM(nn.Module):
+    """
+    an inference replacement of the word embedding, the tag embedding and the LSTM of a model where the input to
+    hidden projection of the first LSTM layer (with both its biases) is folded into per word and per tag tables, so
+    the embedding lookup and the projection are two gathers and an add (the tables hold 4 * lstm_hidden_dim values
+    per direction for every word instead of word_emb_dim)
+    """
+    def __init__(self, word_embedding, tag_embedding, lstm):
+        super().__init__()
+        word_emb_dim = word_embedding.embedding_dim
+        suffixes = ['', '_reverse'] if lstm.bidirectional else ['']
+        word_tables, tag_tables, weights_hh = [], [], []
+        with torch.no_grad():
+            for suffix in suffixes:
+                weight_ih = getattr(lstm, 'weight_ih_l0' + suffix)
+                bias = getattr(lstm, 'bias_ih_l0' + suffix) + getattr(lstm, 'bias_hh_l0' + suffix)
+                word_tables.append(word_embedding.weight @ weight_ih[:, :word_emb_dim].t())
+                tag_tables.append(tag_embedding.weight @ weight_ih[:, word_emb_dim:].t() + bias)
+                weights_hh.append(getattr(lstm, 'weight_hh_l0' + suffix).clone())
+        self.register_buffer('word_table', torch.stack(word_tables, dim=1), persistent=False)  # (V, directions, 4H)
+        self.register_buffer('tag_table', torch.stack(tag_tables, dim=1), persistent=False)  # (V, directions, 4H)
+        self.register_buffer('weight_hh', torch.stack(weights_hh), persistent=False)  # (directions, 4H, H)
+        self.upper_lstm = None
+        if lstm.num_layers > 1:
+            self.upper_lstm = nn.LSTM(input_size=len(suffixes) * lstm.hidden_size, hidden_size=lstm.hidden_size,
+                                      num_layers=lstm.num_layers - 1, batch_first=True,
+                                      bidirectional=lstm.bidirectional)
+            upper_state = {name.replace('_l{}'.format(layer), '_l{}'.format(layer - 1)): value
+                           for name, value in lstm.state_dict().items()
+                           for layer in [int(name.split('_l')[1][0])] if layer > 0}
+            self.upper_lstm.load_state_dict(upper_state)
+        # the copied upper layers are not saved either, the state_dict of a converted model is the one it had
+        self.register_state_dict_post_hook(_drop_upper_lstm_state)
+
+    def forward(self, word_idx, tag_idx):
+        input_gates = self.word_table[word_idx] + self.tag_table[tag_idx]  # (B, T, directions, 4H)
+        out = _lstm_recurrence(input_gates.permute(2, 0, 1, 3), self.weight_hh)
+        if self.upper_lstm is not None:
+            out, _ = self.upper_lstm(out)
+        return out
+
+
+def fuse_embedding_projection(model):
+    """
+    converts a loaded BaseNet or AdvancedNet for inference, its embeddings and the first projection of its LSTM are
+    replaced by a FusedInputLSTM (the original modules stay in the model, so it can be saved as before)
+    :return: the model
+    """
+    model.eval()
+    model.fused_encoder = FusedInputLSTM(model.word_embedding, model.tag_embedding, model.lstm).to(model.device)
+    return model
+
+
 class BaseNet(nn.Module):
     def __init__(self, word_vocab_size, tag_vocab_size, appearance_count=None, word_emb_dim=100, tag_emb_dim=100,
-                 lstm_hidden_dim=125, mlp_hidden_dim=100, dropout_a=0.25, unk_word_ind=0, device=None):
+                 lstm_hidden_dim=125, mlp_hidden_dim=100, dropout_a=0.25, unk_word_ind=0, lstm_layers=2,
+                 num_labels=None, label_hidden_dim=100, sparse_word_embedding=False, word_embedding_compression=None,
+                 device=None):
+        """
+        :param sparse_word_embedding: if True the word embedding has sparse gradients (only the rows of the words of
+        the step), to be trained with SparseAdam (see train_model.make_optimizers)
+        :param word_embedding_compression: the compression of the word embedding table (see make_word_embedding)
+        """
         super().__init__()
         self.args = {'word_vocab_size': word_vocab_size, 'tag_vocab_size': tag_vocab_size, 'word_emb_dim': word_emb_dim,
-                     'tag_emb_dim': tag_emb_dim, 'mlp_hidden_dim': mlp_hidden_dim}
+                     'tag_emb_dim': tag_emb_dim, 'mlp_hidden_dim': mlp_hidden_dim, 'lstm_hidden_dim': lstm_hidden_dim,
+                     'lstm_layers': lstm_layers, 'num_labels': num_labels, 'label_hidden_dim': label_hidden_dim,
+                     'sparse_word_embedding': sparse_word_embedding,
+                     'word_embedding_compression': word_embedding_compression}
         if device is None:
             self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         else:
             self.device = device
         self.word_dropout = WordDropout(appearance_count, dropout_a, unk_word_ind)
-        self.word_embedding = nn.Embedding(word_vocab_size, word_emb_dim)  # (B, len(sentence))
+        self.word_embedding = make_word_embedding(word_vocab_size, word_emb_dim, sparse=sparse_word_embedding,
+                                                  compression=word_embedding_compression)  # (B, len(sentence))
         self.tag_embedding = nn.Embedding(tag_vocab_size, tag_emb_dim)    # (B, len(sentence))
-        self.lstm = nn.LSTM(input_size=word_emb_dim + tag_emb_dim, hidden_size=lstm_hidden_dim, num_layers=2,
+        self.lstm = nn.LSTM(input_size=word_emb_dim + tag_emb_dim, hidden_size=lstm_hidden_dim, num_layers=lstm_layers,
                             batch_first=True, bidirectional=True)  # (B, len(sentence), 2 * hidden)
+        self.fused_encoder = None
         self.layer1_head = nn.Linear(2 * lstm_hidden_dim, mlp_hidden_dim)  # (B, len(sentence), mlp_hidden_dim)
         self.layer1_modifier = nn.Linear(2 * lstm_hidden_dim, mlp_hidden_dim)  # (B, len(sentence), mlp_hidden_dim)
         self.out_layer = nn.Linear(mlp_hidden_dim, 1)
+        self.label_classifier = None
+        if num_labels is not None:
+            self.label_classifier = LabelClassifier(2 * lstm_hidden_dim, num_labels, label_hidden_dim)
 
-    def forward(self, word_idx, tag_idx):
-        self.word_dropout(word_idx)
+    def encode(self, word_idx, tag_idx):
+        word_idx = self.word_dropout(word_idx)
+        if self.fused_encoder is not None:
+            return self.fused_encoder(word_idx.to(self.device), tag_idx.to(self.device))
         word_embeds = self.word_embedding(word_idx.to(self.device))
         tag_embeds = self.tag_embedding(tag_idx.to(self.device))
         x = torch.cat((word_embeds, tag_embeds), dim=2)
         lstm_out, _ = self.lstm(x)
+        return lstm_out
+
+    def forward(self, word_idx, tag_idx):
+        return self.score_arcs(self.encode(word_idx, tag_idx))
+
+    def score_arcs(self, lstm_out):
         vh = self.layer1_head(lstm_out)
         vm = self.layer1_modifier(lstm_out)
         vh = vh.repeat(1, vh.shape[1], 1).view(vh.shape[0], vh.shape[1], vh.shape[1], -1)
@@ -108,56 +440,152 @@ class AdvancedNet(nn.Module):
                  lstm_hidden_dim=125, lstm_dropout=0., lstm_out_dropout=0., attn_type='additive',
                  attn_hidden_dim=100, attn_dropout=0.,
                  appearance_count=None, dropout_a=0.25, unk_word_ind=0,
-                 pre_trained_word_embedding=None, freeze_word_embedding=True, device=None):
+                 pre_trained_word_embedding=None, freeze_word_embedding=True, lstm_layers=2, num_labels=None,
+                 label_hidden_dim=100, sparse_word_embedding=False, word_embedding_compression=None, device=None):
+        """
+        :param sparse_word_embedding: if True the word embedding has sparse gradients (when it is not frozen), see
+        BaseNet
+        :param word_embedding_compression: the compression of the word embedding table, a pre trained table is
+        compressed (see make_word_embedding)
+        """
         self.args = {'word_vocab_size': word_vocab_size, 'tag_vocab_size': tag_vocab_size, 'word_emb_dim': word_emb_dim,
-                     'tag_emb_dim': tag_emb_dim, 'attn_type': attn_type, 'attn_hidden_dim': attn_hidden_dim}
+                     'tag_emb_dim': tag_emb_dim, 'attn_type': attn_type, 'attn_hidden_dim': attn_hidden_dim,
+                     'lstm_hidden_dim': lstm_hidden_dim, 'lstm_layers': lstm_layers, 'num_labels': num_labels,
+                     'label_hidden_dim': label_hidden_dim, 'sparse_word_embedding': sparse_word_embedding,
+                     'word_embedding_compression': word_embedding_compression}
         super().__init__()
         if device is None:
             self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         else:
             self.device = device
         self.word_dropout = WordDropout(appearance_count, dropout_a, unk_word_ind)
-        if pre_trained_word_embedding is None:
-            self.word_embedding = nn.Embedding(word_vocab_size, word_emb_dim)
-        else:
-            self.word_embedding = nn.Embedding.from_pretrained(pre_trained_word_embedding, freeze=freeze_word_embedding)
+        self.word_embedding = make_word_embedding(word_vocab_size, word_emb_dim, pre_trained_word_embedding,
+                                                  freeze_word_embedding, sparse_word_embedding,
+                                                  word_embedding_compression)
         self.tag_embedding = nn.Embedding(tag_vocab_size, tag_emb_dim)    # (B, len(sentence))
-        self.lstm = nn.LSTM(input_size=word_emb_dim + tag_emb_dim, hidden_size=lstm_hidden_dim, num_layers=2,
-                            batch_first=True, bidirectional=True, dropout=lstm_dropout)
+        self.lstm = nn.LSTM(input_size=word_emb_dim + tag_emb_dim, hidden_size=lstm_hidden_dim,
+                            num_layers=lstm_layers, batch_first=True, bidirectional=True,
+                            dropout=lstm_dropout if lstm_layers > 1 else 0.)
         self.encoder_dropout = nn.Dropout(p=lstm_out_dropout)
+        self.fused_encoder = None
         if attn_type == 'additive':
             self.attn = AdditiveAttention(in_dim=2*lstm_hidden_dim, hidden_dim=attn_hidden_dim, dropout=attn_dropout)
         if attn_type == 'multiplicative':
             self.attn = MultiplicativeAttention(in_dim=2*lstm_hidden_dim, hidden_dim=attn_hidden_dim,
                                                 dropout=attn_dropout)
+        if attn_type == 'biaffine':
+            self.attn = BiaffineAttention(in_dim=2*lstm_hidden_dim, hidden_dim=attn_hidden_dim, dropout=attn_dropout)
+        self.label_classifier = None
+        if num_labels is not None:
+            self.label_classifier = LabelClassifier(2 * lstm_hidden_dim, num_labels, label_hidden_dim, attn_dropout)
 
-    def forward(self, word_idx, tag_idx):
-        self.word_dropout(word_idx)
+    def encode(self, word_idx, tag_idx):
+        word_idx = self.word_dropout(word_idx)
+        if self.fused_encoder is not None:
+            return self.fused_encoder(word_idx.to(self.device), tag_idx.to(self.device))
         word_embeds = self.word_embedding(word_idx.to(self.device))
         tag_embeds = self.tag_embedding(tag_idx.to(self.device))
         x = torch.cat((word_embeds, tag_embeds), dim=2)
         lstm_out, _ = self.lstm(x)
-        lstm_out = self.encoder_dropout(lstm_out)
+        return self.encoder_dropout(lstm_out)
+
+    def forward(self, word_idx, tag_idx):
+        return self.score_arcs(self.encode(word_idx, tag_idx))
+
+    def score_arcs(self, lstm_out):
         out = self.attn(q=lstm_out, k=lstm_out)
         return out[:, :, 1:]
 
 
-class PositionalEncoding(nn.Module):
+class JointNet(nn.Module):
+    """
+    a POS tagger and a parser that share the word embedding and the BiLSTM encoder, so untagged text is tagged and
+    parsed in one encoder pass: the encoder reads the words only, the tagging layer and the arc scorer (as in
+    AdvancedNet) both read its output
+    """
+    def __init__(self, word_vocab_size, tag_vocab_size, word_emb_dim=100, lstm_hidden_dim=125, lstm_layers=2,
+                 lstm_dropout=0., attn_type='biaffine', attn_hidden_dim=100, attn_dropout=0., appearance_count=None,
+                 dropout_a=0.25, unk_word_ind=0, pre_trained_word_embedding=None, freeze_word_embedding=True,
+                 sparse_word_embedding=False, word_embedding_compression=None, device=None):
+        super().__init__()
+        self.args = {'word_vocab_size': word_vocab_size, 'tag_vocab_size': tag_vocab_size, 'word_emb_dim': word_emb_dim,
+                     'lstm_hidden_dim': lstm_hidden_dim, 'lstm_layers': lstm_layers, 'attn_type': attn_type,
+                     'attn_hidden_dim': attn_hidden_dim, 'sparse_word_embedding': sparse_word_embedding,
+                     'word_embedding_compression': word_embedding_compression}
+        if device is None:
+            self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        else:
+            self.device = device
+        self.word_dropout = WordDropout(appearance_count, dropout_a, unk_word_ind)
+        self.word_embedding = make_word_embedding(word_vocab_size, word_emb_dim, pre_trained_word_embedding,
+                                                  freeze_word_embedding, sparse_word_embedding,
+                                                  word_embedding_compression)
+        self.lstm = nn.LSTM(input_size=word_emb_dim, hidden_size=lstm_hidden_dim, num_layers=lstm_layers,
+                            batch_first=True, bidirectional=True, dropout=lstm_dropout if lstm_layers > 1 else 0.)
+        self.tag_layer = nn.Linear(2 * lstm_hidden_dim, tag_vocab_size)
+        if attn_type == 'additive':
+            self.attn = AdditiveAttention(in_dim=2*lstm_hidden_dim, hidden_dim=attn_hidden_dim, dropout=attn_dropout)
+        if attn_type == 'multiplicative':
+            self.attn = MultiplicativeAttention(in_dim=2*lstm_hidden_dim, hidden_dim=attn_hidden_dim,
+                                                dropout=attn_dropout)
+        if attn_type == 'biaffine':
+            self.attn = BiaffineAttention(in_dim=2*lstm_hidden_dim, hidden_dim=attn_hidden_dim, dropout=attn_dropout)
+        self.label_classifier = None
+
+    def encode(self, word_idx, tag_idx=None):
+        """
+        :param tag_idx: ignored, the encoder does not read the POS tags
+        """
+        word_idx = self.word_dropout(word_idx)
+        lstm_out, _ = self.lstm(self.word_embedding(word_idx.to(self.device)))
+        return lstm_out
+
+    def score_arcs(self, lstm_out):
+        return self.attn(q=lstm_out, k=lstm_out)[:, :, 1:]
+
+    def forward(self, word_idx, tag_idx=None):
+        return self.score_arcs(self.encode(word_idx))
+
+    def forward_with_tags(self, word_idx):
+        """
+        :return: the arc scores (B, T+1, T) and the POS tag scores (B, T, tag_vocab_size) of the words (without the
+        ROOT) from one encoder pass
+        """
+        lstm_out = self.encode(word_idx)
+        return self.score_arcs(lstm_out), self.tag_layer(lstm_out[:, 1:])
 
+
+def pos_loss(tag_scores, true_tags):
+    """
+    :param tag_scores: a tensor from the shape (B, T, tag_vocab_size) of the scores of the tags of the words
+    :param true_tags: a tensor from the shape (B, T) of the true tags (-1 for padded words)
+    :return: the mean over the words of the negative log probability of their true tag
+    """
+    return nn.functional.cross_entropy(tag_scores.transpose(1, 2), true_tags.to(tag_scores.device), ignore_index=-1)
+
+
+class PositionalEncoding(nn.Module):
+    """
+    adds the sinusoidal positional encodings to batch first inputs, the table grows on demand to the longest length
+    seen so far and is kept (not saved with the model)
+    """
     def __init__(self, d_model, max_len=300):
         super(PositionalEncoding, self).__init__()
+        self.d_model = d_model
+        self.register_buffer('pe', self._encodings(max_len), persistent=False)
 
-        pe = torch.zeros(max_len, d_model)
+    def _encodings(self, max_len):
+        pe = torch.zeros(max_len, self.d_model)
         position = torch.arange(0, max_len, dtype=torch.float).unsqueeze(1)
-        div_term = torch.exp(torch.arange(0, d_model, 2).float() * (-math.log(10000.0) / d_model))
+        div_term = torch.exp(torch.arange(0, self.d_model, 2).float() * (-math.log(10000.0) / self.d_model))
         pe[:, 0::2] = torch.sin(position * div_term)
         pe[:, 1::2] = torch.cos(position * div_term)
-        pe = pe.unsqueeze(0).transpose(0, 1)
-        self.register_buffer('pe', pe)
+        return pe.unsqueeze(0)
 
     def forward(self, x):
-        x = x + self.pe[:x.size(0), :]
-        return x
+        if x.size(1) > self.pe.size(1):
+            self.pe = self._encodings(max(x.size(1), 2 * self.pe.size(1))).to(self.pe.device)
+        return x + self.pe[:, :x.size(1)]
 
 
 class TransformerModel(nn.Module):
@@ -165,8 +593,12 @@ class TransformerModel(nn.Module):
                  nhead=8, transformer_hidden=256, transformer_layers=2, transformer_dropout=0.5,
                  attn_type='additive', attn_hidden_dim=100, attn_dropout=0, appearance_count=None,
                  dropout_a=0.25, unk_word_ind=0, pre_trained_word_embedding=None, freeze_word_embedding=True,
-                 device=None):
+                 num_labels=None, label_hidden_dim=100, device=None):
         super().__init__()
+        self.args = {'word_vocab_size': word_vocab_size, 'tag_vocab_size': tag_vocab_size, 'word_emb_dim': word_emb_dim,
+                     'tag_emb_dim': tag_emb_dim, 'nhead': nhead, 'transformer_hidden': transformer_hidden,
+                     'transformer_layers': transformer_layers, 'attn_type': attn_type,
+                     'attn_hidden_dim': attn_hidden_dim, 'num_labels': num_labels, 'label_hidden_dim': label_hidden_dim}
         self.inp_dim = word_emb_dim + tag_emb_dim
         self.pos_encoder = PositionalEncoding(word_emb_dim + tag_emb_dim)
         if device is None:
@@ -179,37 +611,145 @@ class TransformerModel(nn.Module):
         else:
             self.word_embedding = nn.Embedding.from_pretrained(pre_trained_word_embedding, freeze=freeze_word_embedding)
         self.tag_embedding = nn.Embedding(tag_vocab_size, tag_emb_dim)
-        encoding_layer = nn.TransformerEncoderLayer(self.inp_dim, nhead, transformer_hidden, transformer_dropout)
-        self.encoder = nn.TransformerEncoder(encoding_layer, transformer_layers)
+        encoding_layer = nn.TransformerEncoderLayer(self.inp_dim, nhead, transformer_hidden, transformer_dropout,
+                                                    batch_first=True)
+        # in eval mode (without grad) the encoder takes the fused fast path of torch, with nested tensors for padding
+        self.encoder = nn.TransformerEncoder(encoding_layer, transformer_layers, enable_nested_tensor=True)
         if attn_type == 'additive':
             self.attn = AdditiveAttention(in_dim=self.inp_dim, hidden_dim=attn_hidden_dim, dropout=attn_dropout)
         if attn_type == 'multiplicative':
             self.attn = MultiplicativeAttention(in_dim=self.inp_dim, hidden_dim=attn_hidden_dim,
                                                 dropout=attn_dropout)
+        if attn_type == 'biaffine':
+            self.attn = BiaffineAttention(in_dim=self.inp_dim, hidden_dim=attn_hidden_dim, dropout=attn_dropout)
+        self.label_classifier = None
+        if num_labels is not None:
+            self.label_classifier = LabelClassifier(self.inp_dim, num_labels, label_hidden_dim, attn_dropout)
 
-    def forward(self, word_idx, tag_idx):
-        sec_len = word_idx.size(1)
-        self.word_dropout(word_idx)
+    def encode(self, word_idx, tag_idx, lengths=None):
+        word_idx = self.word_dropout(word_idx)
         word_embeds = self.word_embedding(word_idx.to(self.device))
         tag_embeds = self.tag_embedding(tag_idx.to(self.device))
-        x = torch.cat((word_embeds, tag_embeds), dim=2)
-        x = x.transpose(0, 1) * math.sqrt(self.inp_dim)
+        x = torch.cat((word_embeds, tag_embeds), dim=2) * math.sqrt(self.inp_dim)
         x = self.pos_encoder(x)
-        encoding = self.encoder(x, mask=torch.zeros((sec_len, sec_len), device=self.device))
-        encoding = encoding.transpose(0, 1)
+        padding_mask = None
+        if lengths is not None:
+            positions = torch.arange(x.size(1), device=self.device).unsqueeze(0)
+            padding_mask = positions >= lengths.to(self.device).unsqueeze(1)
+        return self.encoder(x, src_key_padding_mask=padding_mask)
+
+    def forward(self, word_idx, tag_idx, lengths=None):
+        """
+        :param lengths: a tensor from the shape (B,) of the lengths of the padded sentences (including the ROOT as in
+        DpDataset), None if nothing is padded
+        """
+        return self.score_arcs(self.encode(word_idx, tag_idx, lengths))
+
+    def score_arcs(self, encoding):
         out = self.attn(q=encoding, k=encoding)
         return out[:, :, 1:]
 
 
-def nll_loss(out, true_heads):
-    sentence_len = true_heads.shape[0]
-    true_scores = out[:, true_heads, torch.arange(sentence_len)]
-    sum_exp = torch.sum(torch.exp(out), dim=1)
-    log_sum_exp = torch.log(sum_exp)
-    return torch.mean(- true_scores + log_sum_exp)
+class EnsembleModel(nn.Module):
+    """
+    an ensemble of models of the same architecture (e.g. the checkpoints of train checkpoint_at_test, or several
+    seeds) whose arc scores are averaged, so every sentence is decoded once. every model runs its own encoder (with
+    the native LSTM kernel, which is faster than batching the models with torch.func.vmap over an unrolled LSTM). it
+    is used as the models are (encode gives the encodings of all the models, score_arcs the average of their
+    scores), without a label classifier, and the POS tags of an ensemble of JointNets are not inferred
+    """
+    def __init__(self, models, device=None):
+        super().__init__()
+        shapes = [(type(model), {name: tensor.shape for name, tensor in model.state_dict().items()})
+                  for model in models]
+        if any(model_shapes != shapes[0] for model_shapes in shapes):
+            raise ValueError('the models of an ensemble must have the same architecture')
+        self.device = device if device is not None else models[0].device
+        self.args = models[0].args
+        self.label_classifier = None
+        self.label_idx_mappings = getattr(models[0], 'label_idx_mappings', None)
+        self.models = nn.ModuleList(models)
+
+    def encode(self, word_idx, tag_idx=None):
+        """
+        :return: a list of the encodings of the sentences by every model
+        """
+        return [model.encode(word_idx, tag_idx) for model in self.models]
+
+    def score_arcs(self, encodings):
+        """
+        :param encodings: the encodings of every model (see encode)
+        :return: the average over the models of their arc scores (B, T+1, T)
+        """
+        return torch.stack([model.score_arcs(encoding) for model, encoding in zip(self.models, encodings)]).mean(0)
+
+    def forward(self, word_idx, tag_idx=None):
+        return self.score_arcs(self.encode(word_idx, tag_idx))
+
+
+def forward_with_labels(model, word_idx, tag_idx, heads=None, lengths=None):
+    """
+    the arc scores and the label scores of a model with a label classifier, the labels are scored only on one arc
+    per word
+    :param model: a BaseNet, AdvancedNet or TransformerModel built with num_labels
+    :param heads: a tensor from the shape (B, T) of the heads the labels are scored on (the gold heads in training),
+    None scores them on the heads decoded from the arc scores
+    :param lengths: a tensor from the shape (B,) of the lengths of the padded sentences (including the ROOT as in
+    DpDataset), None if nothing is padded
+    :return: the arc scores (B, T+1, T), the label scores (B, T, num_labels) and the heads (B, T) they are scored on
+    """
+    if isinstance(model, TransformerModel):
+        encoding = model.encode(word_idx, tag_idx, lengths)
+    else:
+        encoding = model.encode(word_idx, tag_idx)
+    scores = model.score_arcs(encoding)
+    if heads is None:
+        heads = torch.zeros(scores.shape[0], scores.shape[2], dtype=torch.long)
+        sentence_lengths = [scores.shape[1]] * scores.shape[0] if lengths is None else lengths.tolist()
+        for b, length in enumerate(sentence_lengths):
+            heads[b, :length - 1] = torch.from_numpy(
+                infer_heads(scores[b, :length, :length - 1].float(), squeeze=False).astype('int64'))
+    heads = heads.clamp(min=0)
+    return scores, model.label_classifier(encoding, heads), heads
 
 
-def paper_loss(out, true_heads):
+def label_loss(label_scores, true_labels):
+    """
+    :param label_scores: a tensor from the shape (B, T, num_labels) of the scores of the labels of the gold arcs
+    :param true_labels: a tensor from the shape (B, T) of the true labels (-1 for padded and unknown labels)
+    :return: the mean over the words of the negative log probability of their true label
+    """
+    return nn.functional.cross_entropy(label_scores.transpose(1, 2), true_labels.to(label_scores.device),
+                                       ignore_index=-1)
+
+
+def masked_nll_loss(out, true_heads, mask=None):
+    """
+    the head selection negative log likelihood of a padded batch, computed with one fused log-softmax
+    :param out: a tensor from the shape (B, T+1, T) such that out[b, h, m-1] is the score of (h, m) in sentence b
+    :param true_heads: a tensor from the shape (B, T) of the true heads (any value at padded positions)
+    :param mask: a bool tensor from the shape (B, T), True at the words of the sentences (None if nothing is padded)
+    :return: the mean over all the words in the batch of the negative log probability of their true head
+    """
+    if mask is None:
+        return nn.functional.cross_entropy(out, true_heads)
+    head_mask = torch.cat((torch.ones_like(mask[:, :1]), mask), dim=1)
+    out = out.masked_fill(~head_mask.unsqueeze(2), float('-inf'))
+    return nn.functional.cross_entropy(out, true_heads.masked_fill(~mask, -1), ignore_index=-1)
+
+
+def nll_loss(out, true_heads, return_heads=False):
+    loss = masked_nll_loss(out.view(1, out.shape[-2], out.shape[-1]), true_heads.unsqueeze(0))
+    if return_heads:
+        return loss, None
+    return loss
+
+
+def hinge_loss(out, true_heads):
+    """
+    the structured hinge loss of the paper
+    :return: the loss and the heads inferred from the loss augmented scores
+    """
     sentence_len = true_heads.shape[0]
     modifiers = torch.arange(sentence_len)
     true_score = torch.sum(out[:, true_heads, modifiers])
@@ -218,30 +758,104 @@ def paper_loss(out, true_heads):
     inferred_heads = infer_heads(shifted_scores)
     inferred_score = torch.sum(shifted_scores[:, inferred_heads, modifiers])
     loss = torch.max(torch.tensor(0.), inferred_score - true_score + 1)
+    return loss, inferred_heads
+
+
+def paper_loss(out, true_heads, return_heads=False):
+    loss, inferred_heads = hinge_loss(out, true_heads)
+    if return_heads:
+        return loss, inferred_heads
     return loss
 
 
-def regularized_paper_loss(out, true_heads, alpha=0.1):
-    sentence_len = true_heads.shape[0]
-    modifiers = torch.arange(sentence_len)
-    true_score = torch.sum(out[:, true_heads, modifiers])
-    shifted_scores = out + 1
-    shifted_scores[:, true_heads, modifiers] -= 1
-    inferred_heads = infer_heads(shifted_scores)
-    inferred_score = torch.sum(shifted_scores[:, inferred_heads, modifiers])
-    reg = alpha * torch.sum(out[:, true_heads, modifiers]**2)
-    loss = torch.max(torch.tensor(0.), inferred_score - true_score + 1) + reg
+def regularized_paper_loss(out, true_heads, alpha=0.1, return_heads=False):
+    loss, inferred_heads = hinge_loss(out, true_heads)
+    modifiers = torch.arange(true_heads.shape[0])
+    loss = loss + alpha * torch.sum(out[:, true_heads, modifiers]**2)
+    if return_heads:
+        return loss, inferred_heads
     return loss
 
 
-def variational_paper_loss(out, true_heads, std=0.1):
+def variational_paper_loss(out, true_heads, std=0.1, return_heads=False):
     out = out + torch.normal(mean=0.0, std=std, size=out.shape, device=out.device)
-    sentence_len = true_heads.shape[0]
-    modifiers = torch.arange(sentence_len)
-    true_score = torch.sum(out[:, true_heads, modifiers])
-    shifted_scores = out + 1
-    shifted_scores[:, true_heads, modifiers] -= 1
-    inferred_heads = infer_heads(shifted_scores)
-    inferred_score = torch.sum(shifted_scores[:, inferred_heads, modifiers])
-    loss = torch.max(torch.tensor(0.), inferred_score - true_score + 1)
+    loss, _ = hinge_loss(out, true_heads)
+    if return_heads:
+        # the heads were decoded on the noisy scores, they say nothing about the plain decode
+        return loss, None
+    return loss
+
+
+def distillation_loss(out, teacher_probs, temperature=1.):
+    """
+    the cross entropy between the head distributions of a teacher and of the model
+    :param out: a tensor from the shape (1, n+1, n) as the network outputs
+    :param teacher_probs: a tensor from the shape (1, n+1, n) of the probability the teacher gives every head of every
+    word
+    :param temperature: the temperature of the head distribution of the model
+    :return: the mean over the words of the cross entropy
+    """
+    log_probs = torch.log_softmax(out / temperature, dim=1)
+    return -torch.mean(torch.sum(teacher_probs * log_probs, dim=1))
+
+
+def tree_log_partition(out, mask=None):
+    """
+    the log of the sum of the exponentiated scores of all the dependency trees (the root may have several
+    modifiers, as in decode_mst) of every sentence in the batch, by the Matrix-Tree theorem
+    :param out: a tensor from the shape (B, T+1, T) such that out[b, h, m-1] is the score of (h, m) in sentence b
+    :param mask: a bool tensor from the shape (B, T), True at the words of the sentences (None if nothing is padded)
+    :return: a tensor from the shape (B,) of the log partition functions
+    """
+    batch_size, _, max_len = out.shape
+    dtype = out.dtype
+    if mask is None:
+        mask = torch.ones((batch_size, max_len), dtype=torch.bool, device=out.device)
+    eye = torch.eye(max_len, dtype=torch.bool, device=out.device)
+    head_mask = torch.cat((torch.ones_like(mask[:, :1]), mask), dim=1)
+    arc_mask = head_mask.unsqueeze(2) & mask.unsqueeze(1)
+    arc_mask[:, 1:] &= ~eye
+    # float64 keeps the determinant away from underflow when some arcs score far below the best ones
+    out = out.double().masked_fill(~arc_mask, float('-inf'))
+    # every modifier's scores are shifted by their max, which shifts the log determinant by the same amount
+    shift = out.max(dim=1).values.masked_fill(~mask, 0.).detach()
+    weights = torch.exp(out - shift.unsqueeze(1))
+    root_weights = weights[:, 0]
+    arc_weights = weights[:, 1:]
+    diagonal = torch.where(mask, root_weights + arc_weights.sum(dim=1), torch.ones_like(root_weights))
+    laplacian = torch.diag_embed(diagonal) - arc_weights
+    log_partition = torch.linalg.slogdet(laplacian).logabsdet + shift.sum(dim=1)
+    return log_partition.to(dtype)
+
+
+def arc_marginals(out, mask=None):
+    """
+    the probability of every arc under the tree CRF of the scores, the gradient of the log partition function
+    (computed by the Matrix-Tree theorem, so one batched inverse of the Laplacians through autograd)
+    :param out: a tensor from the shape (B, T+1, T) such that out[b, h, m-1] is the score of (h, m) in sentence b
+    :param mask: a bool tensor from the shape (B, T), True at the words of the sentences (None if nothing is padded)
+    :return: a tensor from the shape (B, T+1, T) such that [b, h, m-1] is the probability that h is the head of m
+    """
+    with torch.enable_grad():
+        scores = out.detach().double().requires_grad_(True)
+        marginals, = torch.autograd.grad(tree_log_partition(scores, mask).sum(), scores)
+    return marginals.to(out.dtype)
+
+
+def tree_crf_loss(out, true_heads, mask=None, return_heads=False):
+    """
+    the negative log likelihood of the true tree under a globally normalised tree CRF, needs no decoding
+    :param out: a tensor from the shape (B, T+1, T) (or (n+1, n)) such that out[b, h, m-1] is the score of (h, m)
+    :param true_heads: a tensor from the shape (B, T) (or (n,)) of the true heads (any value at padded positions)
+    :param mask: a bool tensor from the shape (B, T), True at the words of the sentences (None if nothing is padded)
+    :return: the mean over the sentences of the loss
+    """
+    out = out.view(-1, out.shape[-2], out.shape[-1])
+    true_heads = true_heads.view(out.shape[0], -1)
+    true_scores = out.gather(1, true_heads.clamp(min=0).unsqueeze(1)).squeeze(1)
+    if mask is not None:
+        true_scores = true_scores.masked_fill(~mask, 0.)
+    loss = torch.mean(tree_log_partition(out, mask) - true_scores.sum(dim=1))
+    if return_heads:
+        return loss, None
     return loss
@@ -0,0 +1,118 @@
+import copy
+import queue
+
+import torch
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader
+
+from code_directory.data_loader import SharedDataset
+from code_directory.eval import evaluate_training
+
+
+def _evaluation_loop(models, train_dataset, test_dataset, eval_kwargs, requests, results):
+    test_loader = DataLoader(test_dataset, shuffle=False)
+    while True:
+        request = requests.get()
+        if request is None:
+            return
+        slot, epoch = request
+        try:
+            result = evaluate_training(models[slot], train_dataset, test_loader, **eval_kwargs)
+        except Exception as e:
+            result = e
+        results.put((slot, epoch, result))
+
+
+class BackgroundEvaluator:
+    """
+    runs the evaluation of the test epochs of a training (see eval.evaluate_training) in a separate process on
+    snapshots of the model, while the training goes on. a snapshot is copied into one of max_pending copies of the
+    model in shared memory (on the CPU) that the evaluation process reads, so submitting it costs a copy of the
+    parameters, and the copy is reused only after its results came back: when max_pending snapshots wait for their
+    results, submit blocks until one of them is evaluated. the results come back in the order of the snapshots and are
+    passed to on_result(epoch, result, state_dict) with the state_dict of the evaluated snapshot (valid during the
+    call only), from submit, poll and close
+    """
+    def __init__(self, model, train_dataset, test_dataset, loss, on_result, max_pending=2, num_threads=1,
+                 train_eval_size=1000, train_eval_seed=0, execution_config=None, labeled=False, joint=False):
+        """
+        :param model: the trained model
+        :param train_dataset: the train dataset (a sample of it is evaluated)
+        :param test_dataset: the test dataset
+        :param loss: the loss function
+        :param on_result: called with the results of every snapshot
+        :param max_pending: the number of snapshots that can wait for their results
+        :param num_threads: the number of intra-op threads of the evaluation process
+        :param execution_config: the execution config of the evaluation (its thread count is num_threads)
+        """
+        self.model = model
+        self.on_result = on_result
+        context = mp.get_context('spawn')
+        self.models = []
+        for _ in range(max_pending):
+            shared_model = copy.deepcopy(model).to('cpu')
+            shared_model.device = torch.device('cpu')
+            shared_model.share_memory()
+            shared_model.eval()
+            self.models.append(shared_model)
+        self.free_slots = list(range(max_pending))
+        self.requests = context.Queue()
+        self.results = context.Queue()
+        eval_kwargs = {'loss': loss, 'train_eval_size': train_eval_size, 'train_eval_seed': train_eval_seed,
+                       'execution_config': dict(execution_config or {}, num_threads=num_threads, num_workers=0),
+                       'labeled': labeled, 'joint': joint}
+        # the sentences are sent to the process as a few shared tensors
+        train_dataset, test_dataset = [dataset if isinstance(dataset, SharedDataset) else SharedDataset(dataset)
+                                       for dataset in [train_dataset, test_dataset]]
+        self.process = context.Process(target=_evaluation_loop, daemon=True,
+                                       args=(self.models, train_dataset, test_dataset, eval_kwargs, self.requests,
+                                             self.results))
+        self.process.start()
+
+    def _receive(self, block):
+        """
+        passes the results of one snapshot to on_result and frees its copy of the model
+        :return: False if block is False and there are no results
+        """
+        while True:
+            try:
+                slot, epoch, result = self.results.get(timeout=1.) if block else self.results.get_nowait()
+                break
+            except queue.Empty:
+                if not self.process.is_alive():
+                    raise RuntimeError('the evaluation process exited with code {}'.format(self.process.exitcode))
+                if not block:
+                    return False
+        if isinstance(result, Exception):
+            raise result
+        self.on_result(epoch, result, self.models[slot].state_dict())
+        self.free_slots.append(slot)
+        return True
+
+    def submit(self, epoch):
+        """
+        evaluates a snapshot of the current parameters of the model in the background
+        :param epoch: the epoch of the snapshot, passed back with its results
+        """
+        while not self.free_slots:
+            self._receive(block=True)
+        slot = self.free_slots.pop(0)
+        with torch.no_grad():
+            self.models[slot].load_state_dict(self.model.state_dict())
+        self.requests.put((slot, epoch))
+
+    def poll(self):
+        """
+        passes the results that came back to on_result, without waiting
+        """
+        while self._receive(block=False):
+            pass
+
+    def close(self):
+        """
+        waits for the results of all the snapshots and stops the evaluation process
+        """
+        while len(self.free_slots) < len(self.models):
+            self._receive(block=True)
+        self.requests.put(None)
+        self.process.join()
@@ -0,0 +1,386 @@
+import copy
+import os
+import time
+
+import numpy as np
+import torch
+from torch import optim
+from torch.utils.data import DataLoader, Subset
+
+from code_directory.Models import AdditiveAttention, AdvancedNet, BaseNet, BiaffineAttention, EnsembleModel, \
+    JointNet, LabelClassifier, MultiplicativeAttention, WordDropout, arc_marginals, fuse_embedding_projection, \
+    masked_nll_loss, nll_loss
+from code_directory.chu_liu_edmonds import decode_mst
+from code_directory.data_loader import DpDataset, PadCollate
+from code_directory.decoding import candidate_heads, chu_liu_edmonds_decode, pruned_chu_liu_edmonds_decode
+from code_directory.eval import load_model
+from code_directory.execution import autocast, configure_execution
+from code_directory.inference import infer_heads
+from code_directory.train_model import make_optimizers
+
+
+def _time(func, repeats):
+    func()
+    t0 = time.perf_counter()
+    for _ in range(repeats):
+        func()
+    return (time.perf_counter() - t0) / repeats
+
+
+def benchmark_nll_loss(batch_size=128, max_len=120, repeats=20, seed=0):
+    """
+    times forward and backward of the head selection loss on a padded batch of random scores, once as a loop over
+    the sentences with the exp/log formulation and once with masked_nll_loss on the whole batch
+    """
+    generator = torch.Generator().manual_seed(seed)
+    lengths = torch.randint(5, max_len + 1, (batch_size,), generator=generator)
+    mask = torch.arange(max_len).unsqueeze(0) < lengths.unsqueeze(1)
+    scores = torch.randn(batch_size, max_len + 1, max_len, generator=generator, requires_grad=True)
+    true_heads = torch.randint(0, max_len + 1, (batch_size, max_len), generator=generator)
+    true_heads = torch.minimum(true_heads, lengths.unsqueeze(1))
+
+    def looped():
+        total = 0.
+        for b, n in enumerate(lengths.tolist()):
+            out = scores[b, :n + 1, :n]
+            true_scores = out[true_heads[b, :n], torch.arange(n)]
+            total = total + torch.sum(-true_scores + torch.log(torch.sum(torch.exp(out), dim=0)))
+        (total / mask.sum()).backward()
+
+    def batched():
+        masked_nll_loss(scores, true_heads, mask).backward()
+
+    looped_time = _time(looped, repeats)
+    batched_time = _time(batched, repeats)
+    print('nll loss, batch of {} sentences up to {} words'.format(batch_size, max_len))
+    print('looped exp/log: {:.2f} ms\tmasked_nll_loss: {:.2f} ms\tspeedup: {:.1f}x'.format(
+        1000 * looped_time, 1000 * batched_time, looped_time / batched_time))
+
+
+def benchmark_loss_epoch(loss_types=('regularized_paper', 'tree_crf'), num_sentences=None, data_dir='data'):
+    """
+    times one training epoch of a BaseNet (same initialisation) with each of the losses
+    :param loss_types: keys of train_model.LOSS_FUNCTIONS
+    :param num_sentences: the number of train sentences in the epoch (None for all of them)
+    :param data_dir: the directory of train.labeled
+    """
+    from code_directory.train_model import LOSS_FUNCTIONS
+    dataset = DpDataset(data_dir, 'train')
+    if num_sentences is not None:
+        dataset = Subset(dataset, range(num_sentences))
+    loader = DataLoader(dataset, shuffle=False)
+    vocabs = dataset.dataset if num_sentences is not None else dataset
+    for loss_type in loss_types:
+        loss_func = LOSS_FUNCTIONS[loss_type]
+        torch.manual_seed(0)
+        model = BaseNet(len(vocabs.word_idx_mappings), len(vocabs.pos_idx_mappings), tag_emb_dim=25)
+        optimizer = optim.Adam(model.parameters(), lr=0.01)
+        t0 = time.perf_counter()
+        for i, (words_idx_tensor, pos_idx_tensor, true_heads, _) in enumerate(loader):
+            scores = model(words_idx_tensor, pos_idx_tensor)
+            loss = loss_func(scores.to("cpu"), true_heads.squeeze(0)) / 50
+            loss.backward()
+            if (i + 1) % 50 == 0:
+                optimizer.step()
+                model.zero_grad()
+        print('{}: {:.1f} s per epoch of {} sentences'.format(loss_type, time.perf_counter() - t0, len(dataset)))
+
+
+def benchmark_execution(model_type='advanced', num_sentences=300, thread_counts=None, data_dir='data'):
+    """
+    sweeps the intra-op thread count and bf16 autocast over inference (forward and decoding) of test sentences and
+    reports the fastest execution config for the local machine (an untrained model of the given type is timed, the
+    timing does not depend on the weights)
+    :param thread_counts: the thread counts to try (None for the powers of 2 up to the number of CPUs)
+    :return: the fastest execution config
+    """
+    dataset = DpDataset(data_dir, 'test')
+    sentences = [dataset[i] for i in range(min(num_sentences, len(dataset)))]
+    model_class = AdvancedNet if model_type == 'advanced' else BaseNet
+    model = model_class(len(dataset.word_idx_mappings), len(dataset.pos_idx_mappings), device=torch.device('cpu'))
+    model.eval()
+    if thread_counts is None:
+        num_cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+        thread_counts = [2 ** i for i in range(num_cpus.bit_length()) if 2 ** i <= num_cpus]
+    default_threads = torch.get_num_threads()
+    results = []
+    for num_threads in thread_counts:
+        for bf16 in (False, True):
+            config = configure_execution({'num_threads': num_threads, 'bf16': bf16})
+
+            def run():
+                with torch.no_grad():
+                    for words_idx, pos_idx, _, _ in sentences:
+                        with autocast(config, model.device):
+                            scores = model(words_idx.unsqueeze(0), pos_idx.unsqueeze(0))
+                        infer_heads(scores.float())
+
+            results.append((_time(run, 1), {'num_threads': num_threads, 'bf16': bf16}))
+            print('threads: {}\tbf16: {}\t{:.1f} sentences/s'.format(num_threads, bf16,
+                                                                      len(sentences) / results[-1][0]))
+    torch.set_num_threads(default_threads)
+    best_time, best_config = min(results, key=lambda result: result[0])
+    print('best config:', best_config, '({:.1f} sentences/s)'.format(len(sentences) / best_time))
+    return best_config
+
+
+def benchmark_word_dropout(batch_size=32, num_batches=50, data_dir='data'):
+    """
+    times the collate of train batches with and without word dropout, next to a BaseNet training step on one
+    sentence for scale
+    """
+    dataset = DpDataset(data_dir, 'train')
+    batches = [[dataset[i * batch_size + j] for j in range(batch_size)] for i in range(num_batches)]
+    word_dropout = WordDropout(dataset.word_idx_to_appearance, a=0.25, unk_ind=dataset.unk_word_idx)
+    plain_collate = PadCollate()
+    dropout_collate = PadCollate(word_dropout)
+    plain_time = _time(lambda: [plain_collate(batch) for batch in batches], 5) / (num_batches * batch_size)
+    dropout_time = _time(lambda: [dropout_collate(batch) for batch in batches], 5) / (num_batches * batch_size)
+    model = BaseNet(len(dataset.word_idx_mappings), len(dataset.pos_idx_mappings), tag_emb_dim=25)
+    words_idx, pos_idx, heads, _ = plain_collate(batches[0][:1])
+    step_time = _time(lambda: nll_loss(model(words_idx, pos_idx), heads.squeeze(0)).backward(), 20)
+    print('per sentence: collate {:.1f} us\tcollate with word dropout {:.1f} us\t(training step {:.1f} us)'.format(
+        1e6 * plain_time, 1e6 * dropout_time, 1e6 * step_time))
+
+
+def benchmark_fused_embedding(batch_sizes=(1, 8, 32), sentence_len=30, word_vocab_size=20000, repeats=50):
+    """
+    checks that fuse_embedding_projection keeps the scores of an AdvancedNet and times the encoder before and after
+    the conversion
+    """
+    torch.manual_seed(0)
+    model = AdvancedNet(word_vocab_size, 50, device=torch.device('cpu'))
+    model.eval()
+    fused_model = fuse_embedding_projection(copy.deepcopy(model))
+    with torch.no_grad():
+        for batch_size in batch_sizes:
+            words_idx = torch.randint(0, word_vocab_size, (batch_size, sentence_len))
+            pos_idx = torch.randint(0, 50, (batch_size, sentence_len))
+            max_diff = (model(words_idx, pos_idx) - fused_model(words_idx, pos_idx)).abs().max().item()
+            encoder_time = _time(lambda: model.encode(words_idx, pos_idx), repeats)
+            fused_time = _time(lambda: fused_model.encode(words_idx, pos_idx), repeats)
+            print('batch {}: encoder {:.2f} ms\tfused encoder {:.2f} ms\tmax score difference {:.1e}'.format(
+                batch_size, 1000 * encoder_time, 1000 * fused_time, max_diff))
+
+
+def _allocated_memory(func):
+    """
+    :return: the number of bytes the ops of func allocate on the cpu (by the torch profiler)
+    """
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as profiler:
+        func()
+    return sum(max(event.self_cpu_memory_usage, 0) for event in profiler.key_averages())
+
+
+def benchmark_attention(batch_size=8, sentence_len=40, in_dim=250, hidden_dim=100, repeats=20, train_epochs=0):
+    """
+    times forward and backward of every arc scorer on random encodings and measures the memory its forward
+    allocates, if train_epochs is positive an AdvancedNet is trained with every scorer and their test UAS is compared
+    """
+    torch.manual_seed(0)
+    encoding = torch.randn(batch_size, sentence_len, in_dim, requires_grad=True)
+    attention_types = {'additive': AdditiveAttention, 'multiplicative': MultiplicativeAttention,
+                       'biaffine': BiaffineAttention}
+    print('batch of {} sentences of {} words, hidden {}'.format(batch_size, sentence_len, hidden_dim))
+    for name, attention_type in attention_types.items():
+        attention = attention_type(in_dim, hidden_dim, dropout=0.)
+        forward_time = _time(lambda: attention(encoding, encoding), repeats)
+        backward_time = _time(lambda: attention(encoding, encoding).sum().backward(), repeats)
+        with torch.no_grad():
+            memory = _allocated_memory(lambda: attention(encoding, encoding))
+        print('{}: forward {:.2f} ms\tforward and backward {:.2f} ms\tforward allocates {:.2f} MB'.format(
+            name, 1000 * forward_time, 1000 * backward_time, memory / 2 ** 20))
+    if train_epochs:
+        from code_directory.eval import compare_models
+        from code_directory.train_model import train
+        bundles = {}
+        for name in attention_types:
+            train(train_epochs, model_type='advanced', model_path='attn_{}.pkl'.format(name),
+                  model_kwargs={'attn_type': name})
+            bundles[name] = ('attn_{}.pkl'.format(name), 'advanced')
+        compare_models(bundles)
+
+
+def benchmark_marginals(num_sentences=300, data_dir='data'):
+    """
+    times the arc marginals against decoding the heads on the scores of an untrained AdvancedNet over test sentences
+    """
+    dataset = DpDataset(data_dir, 'test')
+    model = AdvancedNet(len(dataset.word_idx_mappings), len(dataset.pos_idx_mappings), device=torch.device('cpu'))
+    model.eval()
+    with torch.no_grad():
+        all_scores = [model(words_idx.unsqueeze(0), pos_idx.unsqueeze(0))
+                      for words_idx, pos_idx, _, _ in (dataset[i] for i in range(min(num_sentences, len(dataset))))]
+    decode_time = _time(lambda: [infer_heads(scores) for scores in all_scores], 1)
+    marginals_time = _time(lambda: [arc_marginals(scores) for scores in all_scores], 1)
+    print('decoding {:.3f} s\tmarginals {:.3f} s\t({:.2f} of decoding)'.format(
+        decode_time, marginals_time, marginals_time / decode_time))
+
+
+def benchmark_candidate_pruning(model_path=None, model_type='advanced', ks=(1, 2, 3, 5, 10, 20), data_dir='data',
+                                long_lengths=(100, 200, 400), seed=0):
+    """
+    reports for every k the oracle recall of the top k candidate heads (the fraction of the true heads of test.labeled
+    that are candidates), the decode time of the pruned Chu-Liu-Edmonds against the dense one and the UAS of both,
+    and times both decoders on random scores of long sentences
+    :param model_path: the path of the model whose scores are pruned (an untrained AdvancedNet if None)
+    """
+    if model_path is None:
+        dataset = DpDataset(data_dir, 'test')
+        model = AdvancedNet(len(dataset.word_idx_mappings), len(dataset.pos_idx_mappings), device=torch.device('cpu'))
+    else:
+        model, indexing_dictionaries = load_model(model_path, model_type)
+        dataset = DpDataset(data_dir, 'test', indexing_dictionaries=indexing_dictionaries)
+    model.eval()
+    with torch.no_grad():
+        all_scores = [model(words_idx.unsqueeze(0), pos_idx.unsqueeze(0))[0].float().cpu().numpy().astype(float)
+                      for words_idx, pos_idx, _, _ in (dataset[i] for i in range(len(dataset)))]
+    all_heads = [dataset[i][2].numpy() for i in range(len(dataset))]
+    num_words = sum(len(heads) for heads in all_heads)
+    dense_time = _time(lambda: [chu_liu_edmonds_decode(scores) for scores in all_scores], 1)
+    dense_correct = sum(np.sum(chu_liu_edmonds_decode(scores) == heads)
+                        for scores, heads in zip(all_scores, all_heads))
+    print('dense: decoding {:.3f} s\tUAS {:.4f}'.format(dense_time, dense_correct / num_words))
+    print('k\toracle recall\tdecoding (s)\tUAS')
+    for k in ks:
+        recall = sum(candidate_heads(scores, k)[heads, np.arange(len(heads))].sum()
+                     for scores, heads in zip(all_scores, all_heads)) / num_words
+        pruned_time = _time(lambda: [pruned_chu_liu_edmonds_decode(scores, k) for scores in all_scores], 1)
+        pruned_correct = sum(np.sum(pruned_chu_liu_edmonds_decode(scores, k) == heads)
+                             for scores, heads in zip(all_scores, all_heads))
+        print('{}\t{:.4f}\t{:.3f}\t{:.4f}'.format(k, recall, pruned_time, pruned_correct / num_words))
+    rng = np.random.default_rng(seed)
+    for length in long_lengths:
+        scores = rng.normal(size=(length + 1, length))
+        dense_time = _time(lambda: chu_liu_edmonds_decode(scores), 1)
+        times = ['k={}: {:.1f} ms'.format(k, 1000 * _time(lambda: pruned_chu_liu_edmonds_decode(scores, k), 1))
+                 for k in ks]
+        print('{} words, random scores: dense {:.1f} ms\t{}'.format(length, 1000 * dense_time, '\t'.join(times)))
+
+
+def benchmark_labels(lengths=(10, 40, 100), num_labels=40, in_dim=250, hidden_dim=100, repeats=10):
+    """
+    times labeling a sentence by scoring the labels only on the decoded arcs against the full variant, that scores
+    every label of every (h, m) pair and decodes with the labeled path of decode_mst
+    """
+    torch.manual_seed(0)
+    classifier = LabelClassifier(in_dim, num_labels, hidden_dim)
+    classifier.eval()
+    for length in lengths:
+        encoding = torch.randn(1, length + 1, in_dim)
+        scores = torch.randn(1, length + 1, length)
+
+        def arc_labels():
+            heads = infer_heads(scores)
+            return classifier(encoding, torch.from_numpy(heads.astype('int64'))[None]).argmax(dim=2)
+
+        def full_labels():
+            energy = np.full((num_labels, length + 1, length + 1), float('-inf'))
+            energy[:, :, 1:] = (classifier.full_scores(encoding)[0] + scores).numpy()
+            return decode_mst(energy, length + 1, has_labels=True)
+
+        heads = torch.from_numpy(infer_heads(scores).astype('int64'))[None]
+        with torch.no_grad():
+            arc_time = _time(arc_labels, repeats)
+            full_time = _time(full_labels, repeats)
+            arc_scoring_time = _time(lambda: classifier(encoding, heads), repeats)
+            full_scoring_time = _time(lambda: classifier.full_scores(encoding), repeats)
+        print('{} words: labels of the decoded arcs {:.2f} ms (scoring {:.2f} ms)\tfull (n+1) x n x labels {:.2f} ms '
+              '(scoring {:.2f} ms)'.format(length, 1000 * arc_time, 1000 * arc_scoring_time, 1000 * full_time,
+                                          1000 * full_scoring_time))
+
+
+def benchmark_joint_parsing(num_sentences=300, data_dir='data'):
+    """
+    times tagging and parsing untagged test sentences with a JointNet (one encoder pass) against a separate tagger (a
+    BiLSTM over the words with a tagging layer) followed by an AdvancedNet on the inferred tags, untrained models of
+    the default sizes, the decoding of the heads included in both
+    """
+    dataset = DpDataset(data_dir, 'test')
+    torch.manual_seed(0)
+    cpu = torch.device('cpu')
+    joint_model = JointNet(len(dataset.word_idx_mappings), len(dataset.pos_idx_mappings), device=cpu)
+    tagger = JointNet(len(dataset.word_idx_mappings), len(dataset.pos_idx_mappings), device=cpu)
+    parser = AdvancedNet(len(dataset.word_idx_mappings), len(dataset.pos_idx_mappings), attn_type='biaffine',
+                         device=cpu)
+    for model in [joint_model, tagger, parser]:
+        model.eval()
+    sentences = [dataset[i][0].unsqueeze(0) for i in range(min(num_sentences, len(dataset)))]
+
+    def joint():
+        for words_idx in sentences:
+            scores, tag_scores = joint_model.forward_with_tags(words_idx)
+            tag_scores.argmax(dim=2)
+            infer_heads(scores)
+
+    def pipeline():
+        for words_idx in sentences:
+            tags = tagger.tag_layer(tagger.encode(words_idx)).argmax(dim=2)
+            infer_heads(parser(words_idx, tags))
+
+    with torch.no_grad():
+        joint_time = _time(joint, 1)
+        pipeline_time = _time(pipeline, 1)
+    print('{} sentences: joint {:.3f} s\ttagger then parser {:.3f} s\tspeedup {:.2f}x'.format(
+        len(sentences), joint_time, pipeline_time, pipeline_time / joint_time))
+
+
+def benchmark_sparse_embeddings(vocab_sizes=(10000, 100000, 400000), sentence_len=30, accumulate_steps=5,
+                                repeats=10):
+    """
+    times a training step (accumulate_steps sentences, then the optimizer steps) of a BaseNet with a dense word
+    embedding trained by Adam against a sparse one trained by SparseAdam (see train_model.make_optimizers) over
+    vocabulary sizes
+    """
+    cpu = torch.device('cpu')
+    for vocab_size in vocab_sizes:
+        step_times = []
+        for sparse in [False, True]:
+            torch.manual_seed(0)
+            model = BaseNet(vocab_size, 50, sparse_word_embedding=sparse, device=cpu)
+            optimizers = make_optimizers(model, lr=0.01)
+            sentences = [(torch.randint(0, vocab_size, (1, sentence_len + 1)),
+                          torch.randint(0, 50, (1, sentence_len + 1)),
+                          torch.randint(0, sentence_len + 1, (sentence_len,))) for _ in range(accumulate_steps)]
+
+            def step():
+                for words_idx, pos_idx, heads in sentences:
+                    (nll_loss(model(words_idx, pos_idx), heads) / accumulate_steps).backward()
+                for optimizer in optimizers:
+                    optimizer.step()
+                model.zero_grad()
+            step_times.append(_time(step, repeats))
+        print('vocabulary {}: dense Adam {:.1f} ms\tSparseAdam {:.1f} ms\tspeedup {:.2f}x'.format(
+            vocab_size, 1000 * step_times[0], 1000 * step_times[1], step_times[0] / step_times[1]))
+
+
+def benchmark_ensemble(num_models=(1, 2, 4, 8), model_type='advanced', lengths=(10, 30, 60), repeats=10):
+    """
+    times tagging a sentence with num_models randomly initialized models as num_models separate tag_file runs do
+    (every model scores and decodes the sentence) against one pass of an EnsembleModel (the models score the
+    sentence, the averaged scores are decoded once), for sentences of every length in lengths
+    """
+    cpu = torch.device('cpu')
+    model_class = AdvancedNet if model_type == 'advanced' else BaseNet
+    for sentence_len in lengths:
+        words_idx = torch.randint(0, 1000, (1, sentence_len + 1))
+        pos_idx = torch.randint(0, 50, (1, sentence_len + 1))
+        for n in num_models:
+            models = []
+            for seed in range(n):
+                torch.manual_seed(seed)
+                models.append(model_class(1000, 50, device=cpu).eval())
+            ensemble = EnsembleModel(models)
+            with torch.no_grad():
+                separate_time = _time(lambda: [infer_heads(model(words_idx, pos_idx).float()) for model in models],
+                                      repeats)
+                ensemble_time = _time(lambda: infer_heads(ensemble(words_idx, pos_idx).float()), repeats)
+                scores = ensemble(words_idx, pos_idx).float()
+                decode_time = _time(lambda: infer_heads(scores), repeats)
+            print('length {}, {} models: separate runs {:.2f} ms\tensemble {:.2f} ms\tspeedup {:.2f}x\t'
+                  'one decode {:.2f} ms'.format(sentence_len, n, 1000 * separate_time, 1000 * ensemble_time,
+                                                separate_time / ensemble_time, 1000 * decode_time))
+
+
+if __name__ == '__main__':
+    benchmark_nll_loss()
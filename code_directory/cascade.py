@@ -0,0 +1,131 @@
+import os
+import time
+
+import numpy as np
+import torch
+
+from code_directory.Models import arc_marginals
+from code_directory.data_loader import DpDataset
+from code_directory.eval import load_model
+from code_directory.execution import autocast, configure_execution
+from code_directory.inference import infer_heads
+from code_directory.tag_file import write_tagged_file
+
+
+def sentence_confidence(scores, heads, measure='margin'):
+    """
+    :param scores: a tensor from the shape (1, n+1, n) as the network outputs
+    :param heads: the inferred heads of the sentence
+    :param measure: 'margin' - the smallest difference over the words between the score of the best head and of the
+    runner up, 'marginal' - the mean tree marginal probability of the inferred heads (see Models.arc_marginals)
+    :return: the confidence of the model in the sentence, higher is more confident
+    """
+    scores = scores.float().cpu()[0]
+    if measure == 'margin':
+        if scores.shape[0] < 3:
+            return float('inf')
+        modifiers = torch.arange(scores.shape[1])
+        scores = scores.clone()
+        scores[modifiers + 1, modifiers] = float('-inf')
+        best_two = scores.topk(2, dim=0).values
+        return (best_two[0] - best_two[1]).min().item()
+    if measure == 'marginal':
+        return arc_marginals(scores.unsqueeze(0))[0][heads, np.arange(len(heads))].mean().item()
+    raise ValueError('unknown confidence measure: {}'.format(measure))
+
+
+def _load_bundle(bundle, dir_path, file):
+    model_path, model_type = bundle
+    model, indexing_dictionaries = load_model(model_path=model_path, model_type=model_type,
+                                              return_indexing_dictionaries=True)
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    model.to(device)
+    return model, DpDataset(dir_path, file.split('.')[0], indexing_dictionaries=indexing_dictionaries)
+
+
+def _parse(model, sentence, config):
+    words_idx_tensor, pos_idx_tensor, _, _ = sentence
+    with torch.no_grad(), autocast(config, model.device):
+        scores = model(words_idx_tensor.unsqueeze(0), pos_idx_tensor.unsqueeze(0))
+    scores = scores.float()
+    return scores, infer_heads(scores)
+
+
+def cascade_tag_file(dir_path: str, file: str, out_path, first_bundle, second_bundle, threshold, measure='margin',
+                     time_run=False, execution_config=None):
+    """
+    tags the file with the first (cheap) model and escalates the sentences it is not confident in to the second model
+    :param dir_path: the path of the directory of the file to tag
+    :param file: the name of the file to tag
+    :param out_path: the path of the output
+    :param first_bundle: (model path, model type) of the model every sentence is parsed with, e.g. a BaseNet
+    :param second_bundle: (model path, model type) of the model the uncertain sentences are parsed with
+    :param threshold: the sentences with a confidence below it are escalated
+    :param measure: the confidence measure (see sentence_confidence)
+    :param time_run: if True times the run
+    :param execution_config: the execution config (see execution.configure_execution)
+    :return: the number of escalated sentences
+    """
+    config = configure_execution(execution_config)
+    if time_run:
+        t0 = time.time()
+    first_model, first_dataset = _load_bundle(first_bundle, dir_path, file)
+    second_model, second_dataset = _load_bundle(second_bundle, dir_path, file)
+    inferred_heads = []
+    num_escalated = 0
+    for i in range(len(first_dataset)):
+        scores, heads = _parse(first_model, first_dataset[i], config)
+        if sentence_confidence(scores, heads, measure) < threshold:
+            _, heads = _parse(second_model, second_dataset[i], config)
+            num_escalated += 1
+        inferred_heads.append(heads)
+    write_tagged_file(os.path.join(dir_path, file), out_path, inferred_heads)
+    if time_run:
+        print('tagging took: {}, escalated {} of {} sentences'.format(time.time() - t0, num_escalated,
+                                                                      len(first_dataset)))
+    return num_escalated
+
+
+def cascade_sweep(dir_path: str, file: str, first_bundle, second_bundle, thresholds, measure='margin',
+                  execution_config=None):
+    """
+    reports the throughput and the UAS of the cascade on a labeled file over escalation thresholds, both models parse
+    every sentence once and are timed per sentence, and the cascade is assembled from these runs for every threshold
+    (its time is the time of the first model on all the sentences, confidence included, and of the second model on
+    the escalated ones)
+    :return: a list of (threshold, fraction of escalated sentences, sentences per second, UAS)
+    """
+    config = configure_execution(execution_config)
+    first_model, first_dataset = _load_bundle(first_bundle, dir_path, file)
+    second_model, second_dataset = _load_bundle(second_bundle, dir_path, file)
+    num_sentences = len(first_dataset)
+    first_time, second_time, confidence = np.zeros(num_sentences), np.zeros(num_sentences), np.zeros(num_sentences)
+    first_correct, second_correct, num_words = np.zeros(num_sentences), np.zeros(num_sentences), 0
+    for i in range(num_sentences):
+        true_heads = first_dataset[i][2].numpy()
+        num_words += len(true_heads)
+        t0 = time.perf_counter()
+        scores, heads = _parse(first_model, first_dataset[i], config)
+        confidence[i] = sentence_confidence(scores, heads, measure)
+        first_time[i] = time.perf_counter() - t0
+        first_correct[i] = np.sum(heads == true_heads)
+        t0 = time.perf_counter()
+        _, heads = _parse(second_model, second_dataset[i], config)
+        second_time[i] = time.perf_counter() - t0
+        second_correct[i] = np.sum(heads == true_heads)
+    results = []
+    print('threshold\tescalated\tsentences/s\tUAS')
+    for threshold in thresholds:
+        escalated = confidence < threshold
+        total_time = first_time.sum() + second_time[escalated].sum()
+        uas = np.where(escalated, second_correct, first_correct).sum() / num_words
+        results.append((threshold, escalated.mean(), num_sentences / total_time, uas))
+        print('{}\t{:.3f}\t{:.1f}\t{:.4f}'.format(*results[-1]))
+    print('second model only\t1.000\t{:.1f}\t{:.4f}'.format(num_sentences / second_time.sum(),
+                                                              second_correct.sum() / num_words))
+    return results
+
+
+if __name__ == '__main__':
+    cascade_sweep('data', 'test.labeled', ('./basic_model.pkl', 'base'), ('./advanced_model.pkl', 'advanced'),
+                  thresholds=[0., 0.5, 1., 2., 4., float('inf')])
@@ -0,0 +1,137 @@
+import glob
+import os
+import queue
+import random
+import threading
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+
+class ResumableSampler(Sampler):
+    """
+    a random sampler whose order depends only on its seed and the epoch, so an epoch can be resumed from the middle
+    with the same order: set_epoch(epoch, start) skips the first start samples of the epoch
+    """
+    def __init__(self, data_source, seed=0):
+        super().__init__()
+        self.data_source = data_source
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch, start=0):
+        self.epoch = epoch
+        self.start = start
+
+    def __iter__(self):
+        generator = torch.Generator().manual_seed(self.seed + self.epoch)
+        order = torch.randperm(len(self.data_source), generator=generator)
+        return iter(order[self.start:].tolist())
+
+    def __len__(self):
+        return len(self.data_source) - self.start
+
+
+def rng_state(collate=None):
+    """
+    :param collate: a data_loader.PadCollate whose generator state is kept too (the word dropout of the main process)
+    :return: the states of the random generators of torch, numpy and random
+    """
+    state = {'torch': torch.get_rng_state(), 'numpy': np.random.get_state(), 'random': random.getstate(),
+             'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None, 'collate': None}
+    if collate is not None and collate.generator is not None:
+        state['collate'] = (collate.worker_id, collate.generator.get_state())
+    return state
+
+
+def set_rng_state(state, collate=None):
+    torch.set_rng_state(state['torch'])
+    np.random.set_state(state['numpy'])
+    random.setstate(state['random'])
+    if state['cuda'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+    if collate is not None and state['collate'] is not None:
+        collate.worker_id, generator_state = state['collate']
+        collate.generator = torch.Generator()
+        collate.generator.set_state(generator_state)
+
+
+def _snapshot(obj):
+    """
+    a copy of a (nested) state on the cpu, which the training can keep changing while the copy is saved
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {key: _snapshot(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_snapshot(value) for value in obj)
+    return obj
+
+
+def latest_checkpoint(path):
+    """
+    :param path: a checkpoint file or a directory of checkpoints written by CheckpointWriter
+    :return: the path of the checkpoint (the one of the latest step if path is a directory), None if there is none
+    """
+    if os.path.isfile(path):
+        return path
+    checkpoints = sorted(glob.glob(os.path.join(path, 'checkpoint_*.pt')))
+    return checkpoints[-1] if checkpoints else None
+
+
+class CheckpointWriter:
+    """
+    saves checkpoints in a background thread: save() copies the state (on the calling thread, so the training can
+    go on changing it) and a thread writes it to a temporary file that is renamed to checkpoint_<step>.pt, so a
+    checkpoint is never seen half written, and then deletes all but the last keep_last checkpoints. a checkpoint that
+    is still waiting to be written when the next one is saved is replaced by it
+    """
+    def __init__(self, directory, keep_last=3):
+        self.directory = directory
+        self.keep_last = keep_last
+        os.makedirs(directory, exist_ok=True)
+        self.queue = queue.Queue(maxsize=1)
+        self.error = None
+        self.thread = threading.Thread(target=self._write_loop, daemon=True)
+        self.thread.start()
+
+    def _write_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            step, state = item
+            path = os.path.join(self.directory, 'checkpoint_{:09d}.pt'.format(step))
+            try:
+                torch.save(state, path + '.tmp')
+                os.replace(path + '.tmp', path)
+                for old_path in sorted(glob.glob(os.path.join(self.directory, 'checkpoint_*.pt')))[:-self.keep_last]:
+                    os.remove(old_path)
+            except Exception as e:
+                self.error = e
+
+    def save(self, state, step):
+        """
+        :param state: the state to save (any nesting of dicts, lists and tensors)
+        :param step: the training step, orders the checkpoints
+        """
+        if self.error is not None:
+            raise self.error
+        state = _snapshot(state)
+        try:
+            self.queue.get_nowait()
+        except queue.Empty:
+            pass
+        self.queue.put((step, state))
+
+    def close(self):
+        """
+        waits for the last checkpoint to be written
+        """
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
@@ -1,22 +1,53 @@
 import os
+import zlib
 import torch
 from torchtext.vocab import Vocab
 from torch.utils.data.dataset import Dataset
 from collections import Counter
 from collections import defaultdict
 from torch.utils.data.dataloader import DataLoader
+from torch.utils.data import get_worker_info
 
 UNKNOWN_TOKEN = "<unk>"
 ROOT_TOKEN = "<ROOT>"  # Optional: this is used to pad a batch of sentences in different lengths.
 SPECIAL_TOKENS = [UNKNOWN_TOKEN, ROOT_TOKEN]
 
 
-def get_vocabs(file_path, from_other_dataset=None, word_embeddings_name=None):
+class HashedVocab:
+    """
+    a word to index mapping by feature hashing: the special tokens get the first indices and every other word the
+    index of its bucket, from a hash of the word that is the same in every process, so there is no vocabulary to keep
+    (and no unknown words, only collisions)
+    """
+    def __init__(self, num_buckets):
+        self.num_buckets = num_buckets
+
+    def __getitem__(self, word):
+        if word in SPECIAL_TOKENS:
+            return SPECIAL_TOKENS.index(word)
+        return len(SPECIAL_TOKENS) + zlib.crc32(word.encode('utf-8')) % self.num_buckets
+
+    def get(self, word, default=None):
+        return self[word]
+
+    def __len__(self):
+        return len(SPECIAL_TOKENS) + self.num_buckets
+
+    def __eq__(self, other):
+        return isinstance(other, HashedVocab) and other.num_buckets == self.num_buckets
+
+    def __hash__(self):
+        return hash(self.num_buckets)
+
+
+def get_vocabs(file_path, from_other_dataset=None, word_embeddings_name=None, word_hash_buckets=None):
     """
         Extract vocabs from given datasets. Return a word2ids and tag2idx.
         :param from_other_dataset: getting vocab from the dataset from_dataset
         :param file_path: full path of the corpuses
         :param word_embeddings_name: name pre trained word embedding wanted to use
+        :param word_hash_buckets: if given the words are hashed into this number of buckets (see HashedVocab) instead
+        of indexed by a vocabulary, the number of appearances is of every bucket
             Return:
               - word2idx
               - tag2idx
@@ -36,8 +67,16 @@ def get_vocabs(file_path, from_other_dataset=None, word_embeddings_name=None):
                     word_dict[word] += 1
                     pos_dict[pos_tag] += 1
 
-        index_dict_word = Vocab(Counter(word_dict), specials=SPECIAL_TOKENS, vectors=word_embeddings_name)
         index_dict_pos = Vocab(Counter(pos_dict), specials=SPECIAL_TOKENS)
+        if word_hash_buckets is not None:
+            if word_embeddings_name is not None:
+                raise ValueError('pre trained word embeddings need a vocabulary, not hashed words')
+            word_idx_mappings = HashedVocab(word_hash_buckets)
+            word_idx_to_appearance = torch.zeros(len(word_idx_mappings), dtype=torch.float)
+            for word, count in word_dict.items():
+                word_idx_to_appearance[word_idx_mappings[word]] += count
+            return word_idx_mappings, index_dict_pos.stoi, word_idx_to_appearance, None
+        index_dict_word = Vocab(Counter(word_dict), specials=SPECIAL_TOKENS, vectors=word_embeddings_name)
         word_idx_to_appearance = torch.zeros(len(index_dict_word.stoi), dtype=torch.float)
         for word in word_dict:
             word_idx_to_appearance[index_dict_word.stoi[word]] = word_dict.get(word, float('inf'))
@@ -48,19 +87,27 @@ def get_vocabs(file_path, from_other_dataset=None, word_embeddings_name=None):
 
 
 class DpDataReader:
-    def __init__(self, file):
+    def __init__(self, file, keep_lines=False):
+        """
+        :param keep_lines: if True the lines of every sentence are kept in self.lines (e.g. to write a tagged copy of
+        the file without reading it again)
+        """
         self.file = file
         # self.word_dict = word_dict
         # self.pos_dict = pos_dict
         self.sentences = []
+        self.lines = [] if keep_lines else None
         self.__readData__()
 
     def __readData__(self):
         """main reader function which also populates the class data structures"""
         with open(self.file, 'r') as f:
             cur_sentence = []
+            cur_lines = []
             for line in f:
                 if line.strip():
+                    if self.lines is not None:
+                        cur_lines.append(line)
                     splited_words = line.split()
                     # print(line)
                     word = splited_words[1]
@@ -69,10 +116,14 @@ class DpDataReader:
                         head_index = int(splited_words[6])
                     else:
                         head_index = int(-1)
-                    cur_sentence.append((word, pos_tag, head_index))
+                    label = splited_words[7] if len(splited_words) > 7 and splited_words[7] != '_' else None
+                    cur_sentence.append((word, pos_tag, head_index, label))
                 else:
                     self.sentences.append(cur_sentence)
                     cur_sentence = []
+                    if self.lines is not None:
+                        self.lines.append(cur_lines)
+                        cur_lines = []
 
     def get_num_sentences(self):
         """returns num of sentences in data"""
@@ -81,7 +132,18 @@ class DpDataReader:
 
 class DpDataset(Dataset):
     def __init__(self, dir_path: str, subset: str, vocab_dataset=None, indexing_dictionaries=None,
-                 word_embeddings_name=None):
+                 word_embeddings_name=None, with_labels=False, label_idx_mappings=None, datareader=None,
+                 word_hash_buckets=None):
+        """
+        :param with_labels: if True the samples have a fifth element, the indices of the relation labels of the words
+        (column 8, -1 for a label that is missing or not in the label mapping)
+        :param label_idx_mappings: the mapping from a label to its index, None takes it from vocab_dataset or (if it
+        is None too) builds it from the labels of the file
+        :param datareader: a DpDataReader of the file that is already read (e.g. shared by the datasets of several
+        vocabularies), None reads the file
+        :param word_hash_buckets: if given (and the vocabularies are not given) the words are hashed into this number
+        of buckets (see HashedVocab)
+        """
         super().__init__()
         self.subset = subset  # One of the following: [train, test]
         # self.file = dir_path + subset + ".labeled"
@@ -91,17 +153,28 @@ class DpDataset(Dataset):
             self.file = os.path.join(dir_path, subset) + ".unlabeled"
 
 
-        self.datareader = DpDataReader(self.file)
+        self.datareader = datareader if datareader is not None else DpDataReader(self.file)
         # self.vocab_size = len(self.datareader.word_dict)
         if indexing_dictionaries is not None:
             self.word_idx_mappings, self.pos_idx_mappings, self.word_idx_to_appearance, self.word_embeddings = \
                 indexing_dictionaries
         else:
             self.word_idx_mappings, self.pos_idx_mappings, self.word_idx_to_appearance, self.word_embeddings = \
-                get_vocabs(self.file, vocab_dataset, word_embeddings_name)
+                get_vocabs(self.file, vocab_dataset, word_embeddings_name, word_hash_buckets)
 
         self.unk_word_idx = self.word_idx_mappings[UNKNOWN_TOKEN]
         self.unk_pos_idx = self.pos_idx_mappings[UNKNOWN_TOKEN]
+        self.with_labels = with_labels
+        self.label_idx_mappings = None
+        if with_labels:
+            if label_idx_mappings is not None:
+                self.label_idx_mappings = label_idx_mappings
+            elif vocab_dataset is not None and vocab_dataset.label_idx_mappings is not None:
+                self.label_idx_mappings = vocab_dataset.label_idx_mappings
+            else:
+                labels = sorted({label for sentence in self.datareader.sentences for _, _, _, label in sentence
+                                 if label is not None})
+                self.label_idx_mappings = {label: i for i, label in enumerate(labels)}
         self.sentences_dataset = self.convert_sentences_to_dataset()
         self.name = "here for debugging"
 
@@ -109,33 +182,122 @@ class DpDataset(Dataset):
         return len(self.sentences_dataset)
 
     def __getitem__(self, index):
-        word_embed_idx, pos_embed_idx, head, sentence_len = self.sentences_dataset[index]
-        return word_embed_idx, pos_embed_idx, head, sentence_len
+        return self.sentences_dataset[index]
 
     def convert_sentences_to_dataset(self):
         sentence_word_idx_list = list()
         sentence_pos_idx_list = list()
         sentence_head_list = list()
         sentence_len_list = list()
+        sentence_label_list = list()
         for sentence_idx, sentence in enumerate(self.datareader.sentences):
             words_idx_list = [self.word_idx_mappings[ROOT_TOKEN]]
             pos_idx_list = [self.pos_idx_mappings[ROOT_TOKEN]]
             head_idx_list = []
-            for word, pos, head in sentence:
+            label_idx_list = []
+            for word, pos, head, label in sentence:
                 words_idx_list.append(self.word_idx_mappings.get(word, self.unk_word_idx))
                 pos_idx_list.append(self.pos_idx_mappings.get(pos, self.unk_pos_idx))
                 head_idx_list.append(head)
+                if self.with_labels:
+                    label_idx_list.append(self.label_idx_mappings.get(label, -1))
             sentence_len = len(words_idx_list)
 
             sentence_word_idx_list.append(torch.tensor(words_idx_list, dtype=torch.long, requires_grad=False))
             sentence_pos_idx_list.append(torch.tensor(pos_idx_list, dtype=torch.long, requires_grad=False))
             sentence_head_list.append(torch.tensor(head_idx_list, dtype=torch.long, requires_grad=False))
             sentence_len_list.append(sentence_len)
+            sentence_label_list.append(torch.tensor(label_idx_list, dtype=torch.long, requires_grad=False))
+
+        samples = [sentence_word_idx_list, sentence_pos_idx_list, sentence_head_list, sentence_len_list]
+        if self.with_labels:
+            samples.append(sentence_label_list)
+        return {i: sample_tuple for i, sample_tuple in enumerate(zip(*samples))}
+
+
+class SharedDataset(Dataset):
+    """
+    a DpDataset packed into a few flat tensors in shared memory, so worker processes get the sentences without copying
+    them (a tensor of every sample would be sent to them one by one), its samples are views into the tensors as the
+    samples of the DpDataset, and it has the vocabularies of the DpDataset
+    """
+    VOCABULARY_ATTRIBUTES = ['file', 'subset', 'word_idx_mappings', 'pos_idx_mappings', 'word_idx_to_appearance',
+                             'word_embeddings', 'unk_word_idx', 'unk_pos_idx', 'with_labels', 'label_idx_mappings']
+
+    def __init__(self, dataset):
+        super().__init__()
+        for name in self.VOCABULARY_ATTRIBUTES:
+            setattr(self, name, getattr(dataset, name))
+        samples = [dataset[i] for i in range(len(dataset))]
+        self.lengths = torch.tensor([sample[3] for sample in samples], dtype=torch.long)
+        # the words and the tags have the ROOT, the heads and the labels do not
+        self.sentence_offsets = torch.cat([torch.zeros(1, dtype=torch.long), self.lengths.cumsum(0)])
+        self.word_offsets = self.sentence_offsets - torch.arange(len(samples) + 1)
+        self.columns = [torch.cat([sample[column] for sample in samples])
+                        for column in [0, 1, 2] + ([4] if self.with_labels else [])]
+        for tensor in self.columns + [self.lengths, self.sentence_offsets, self.word_offsets]:
+            tensor.share_memory_()
+        if self.word_idx_to_appearance is not None:
+            self.word_idx_to_appearance.share_memory_()
+        if self.word_embeddings is not None:
+            self.word_embeddings.share_memory_()
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __getitem__(self, index):
+        start, end = self.sentence_offsets[index].item(), self.sentence_offsets[index + 1].item()
+        word_start, word_end = self.word_offsets[index].item(), self.word_offsets[index + 1].item()
+        words_idx, pos_idx, heads, *labels = self.columns
+        sample = (words_idx[start:end], pos_idx[start:end], heads[word_start:word_end], end - start)
+        return sample + tuple(column[word_start:word_end] for column in labels)
+
+
+class PadCollate:
+    """
+    collates DpDataset samples into padded batches of word indices (B, T+1), tag indices (B, T+1), heads (B, T)
+    (padded with -1) and the lengths (B,) (including the ROOT as in DpDataset), a batch of one sentence is the same as
+    the default collate of the DataLoader. if word_dropout is given it is applied to the batch here, so it runs in the
+    DataLoader worker processes, with a generator per worker seeded by the worker seed (or by the torch seed in the
+    main process). the elements of the samples after the fourth are collated too: the (n,) labels of the words (see
+    DpDataset with_labels) padded with -1 to (B, T) and the (n+1, n) head distributions of a teacher (see
+    distillation.DistillationDataset) padded with zeros to (B, T+1, T)
+    """
+    def __init__(self, word_dropout=None, word_pad_idx=0, pos_pad_idx=0):
+        self.word_dropout = word_dropout
+        self.word_pad_idx = word_pad_idx
+        self.pos_pad_idx = pos_pad_idx
+        self.generator = None
+        self.worker_id = None
+
+    def get_generator(self):
+        worker_info = get_worker_info()
+        worker_id = worker_info.id if worker_info is not None else -1
+        if self.generator is None or self.worker_id != worker_id:
+            seed = worker_info.seed if worker_info is not None else torch.initial_seed()
+            self.generator = torch.Generator().manual_seed(seed)
+            self.worker_id = worker_id
+        return self.generator
 
-        return {i: sample_tuple for i, sample_tuple in enumerate(zip(sentence_word_idx_list,
-                                                                     sentence_pos_idx_list,
-                                                                     sentence_head_list,
-                                                                     sentence_len_list))}
+    def __call__(self, batch):
+        words_idx, pos_idx, heads, lengths, *extra = zip(*batch)
+        lengths = torch.tensor(lengths, dtype=torch.long)
+        words_idx = torch.nn.utils.rnn.pad_sequence(words_idx, batch_first=True, padding_value=self.word_pad_idx)
+        pos_idx = torch.nn.utils.rnn.pad_sequence(pos_idx, batch_first=True, padding_value=self.pos_pad_idx)
+        heads = torch.nn.utils.rnn.pad_sequence(heads, batch_first=True, padding_value=-1)
+        if self.word_dropout is not None:
+            mask = torch.arange(words_idx.shape[1]).unsqueeze(0) < lengths.unsqueeze(1)
+            words_idx = self.word_dropout(words_idx, mask=mask, generator=self.get_generator())
+        padded_extra = []
+        for values in extra:
+            if values[0].dim() == 1:
+                padded_extra.append(torch.nn.utils.rnn.pad_sequence(values, batch_first=True, padding_value=-1))
+            else:
+                padded_probs = torch.zeros(len(batch), heads.shape[1] + 1, heads.shape[1])
+                for i, probs in enumerate(values):
+                    padded_probs[i, :probs.shape[0], :probs.shape[1]] = probs
+                padded_extra.append(padded_probs)
+        return (words_idx, pos_idx, heads, lengths, *padded_extra)
 
 
 def main():
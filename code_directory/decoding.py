@@ -0,0 +1,462 @@
+import heapq
+import json
+import os
+import time
+from collections import Counter, defaultdict
+
+import numpy as np
+
+from code_directory.chu_liu_edmonds import decode_mst
+
+# the correctness requirements from the strictest to the loosest:
+# non_projective - the maximum spanning tree (projective or not)
+# projective - a well formed tree, the best projective tree is allowed
+# none - any heads, they may not form a tree
+REQUIREMENTS = ['non_projective', 'projective', 'none']
+
+
+def chu_liu_edmonds_decode(scores):
+    """
+    :param scores: a np array from the shape (n+1, n) such that scores[h, m-1] is the score of (h, m)
+    :return: np array of the heads of the maximum spanning tree
+    """
+    length = scores.shape[0]
+    weights = np.empty((length, length))
+    weights[:, 1:] = scores
+    weights[:, :1] = float('-inf')
+    return decode_mst(weights, length, has_labels=False)[0][1:]
+
+
+def greedy_decode(scores):
+    """
+    :return: np array of the best scoring head of every word, the heads may not form a tree
+    """
+    scores = np.array(scores, dtype=float)
+    modifiers = np.arange(scores.shape[1])
+    scores[modifiers + 1, modifiers] = float('-inf')
+    return scores.argmax(axis=0)
+
+
+def _has_cycle(heads):
+    state = np.zeros(len(heads) + 1, dtype=np.int8)  # 0 - unvisited, 1 - on the current path, 2 - reaches the root
+    state[0] = 2
+    for start in range(1, len(heads) + 1):
+        path = []
+        node = start
+        while state[node] == 0:
+            state[node] = 1
+            path.append(node)
+            node = heads[node - 1]
+        if state[node] == 1:
+            return True
+        state[path] = 2
+    return False
+
+
+def greedy_chu_liu_edmonds_decode(scores):
+    """
+    the maximum spanning tree, when the greedy heads have no cycle they are the maximum spanning tree and
+    Chu-Liu-Edmonds is skipped
+    """
+    heads = greedy_decode(scores)
+    if _has_cycle(heads):
+        return chu_liu_edmonds_decode(scores)
+    return heads
+
+
+def eisner_decode(scores):
+    """
+    the best projective tree by the Eisner algorithm, vectorised over the spans of every width
+    :param scores: a np array from the shape (n+1, n) such that scores[h, m-1] is the score of (h, m)
+    :return: np array of the heads of the best projective tree
+    """
+    num_nodes = scores.shape[0]
+    arc_scores = np.full((num_nodes, num_nodes), float('-inf'))
+    arc_scores[:, 1:] = scores
+    # [s, t, 0] - the head is t, [s, t, 1] - the head is s
+    complete = np.full((num_nodes, num_nodes, 2), float('-inf'))
+    incomplete = np.full((num_nodes, num_nodes, 2), float('-inf'))
+    complete_split = np.zeros((num_nodes, num_nodes, 2), dtype=np.int64)
+    incomplete_split = np.zeros((num_nodes, num_nodes, 2), dtype=np.int64)
+    complete[np.arange(num_nodes), np.arange(num_nodes)] = 0.
+    for width in range(1, num_nodes):
+        s = np.arange(num_nodes - width)[:, None]
+        t = s + width
+        r = s + np.arange(width)[None, :]
+        # incomplete spans: s..r is complete with head s and r+1..t is complete with head t
+        joined = complete[s, r, 1] + complete[r + 1, t, 0]
+        best = joined.argmax(axis=1)
+        best_score = joined[np.arange(len(best)), best]
+        s, t = s[:, 0], t[:, 0]
+        incomplete[s, t, 0] = best_score + arc_scores[t, s]
+        incomplete[s, t, 1] = best_score + arc_scores[s, t]
+        incomplete_split[s, t, 0] = incomplete_split[s, t, 1] = s + best
+        s, t = s[:, None], t[:, None]
+        # complete spans with head t: s..r is complete and r..t is incomplete
+        joined = complete[s, r, 0] + incomplete[r, t, 0]
+        best = joined.argmax(axis=1)
+        complete[s[:, 0], t[:, 0], 0] = joined[np.arange(len(best)), best]
+        complete_split[s[:, 0], t[:, 0], 0] = s[:, 0] + best
+        # complete spans with head s: s..r is incomplete and r..t is complete
+        r = r + 1
+        joined = incomplete[s, r, 1] + complete[r, t, 1]
+        best = joined.argmax(axis=1)
+        complete[s[:, 0], t[:, 0], 1] = joined[np.arange(len(best)), best]
+        complete_split[s[:, 0], t[:, 0], 1] = s[:, 0] + 1 + best
+    heads = np.zeros(num_nodes - 1, dtype=np.int64)
+    stack = [(0, num_nodes - 1, 1, True)]
+    while stack:
+        s, t, direction, is_complete = stack.pop()
+        if s == t:
+            continue
+        if is_complete:
+            r = complete_split[s, t, direction]
+            if direction == 0:
+                stack += [(s, r, 0, True), (r, t, 0, False)]
+            else:
+                stack += [(s, r, 1, False), (r, t, 1, True)]
+        else:
+            r = incomplete_split[s, t, direction]
+            if direction == 0:
+                heads[s - 1] = t
+            else:
+                heads[t - 1] = s
+            stack += [(s, r, 1, True), (r + 1, t, 0, True)]
+    return heads
+
+
+def _constrained_decode(scores, included, excluded, forbidden_score=-1e9):
+    """
+    the maximum spanning tree that has all the included arcs and none of the excluded arcs
+    :param included: dict from a modifier (1 based) to its forced head
+    :param excluded: set of (head, modifier) arcs
+    :return: the heads and the score of the tree, or None if there is no such tree
+    """
+    constrained_scores = np.array(scores, dtype=float)
+    for modifier, head in included.items():
+        constrained_scores[:, modifier - 1] = forbidden_score
+        constrained_scores[head, modifier - 1] = scores[head, modifier - 1]
+    for head, modifier in excluded:
+        constrained_scores[head, modifier - 1] = forbidden_score
+    heads = greedy_chu_liu_edmonds_decode(constrained_scores)
+    modifiers = np.arange(len(heads))
+    if any(heads[modifier - 1] != head for modifier, head in included.items()) or \
+            any(heads[modifier - 1] == head for head, modifier in excluded):
+        return None
+    return heads, float(scores[heads, modifiers].sum())
+
+
+def k_best_decode(scores, k):
+    """
+    the k best spanning trees (projective or not) by Lawler's partitioning of the trees, as in Camerini et al.: after
+    a tree is output, the trees that remain in its part are split into disjoint parts, each defined by arcs it must
+    have and an arc it must not have, and the best tree of every part is found once with a constrained
+    Chu-Liu-Edmonds (skipped when the greedy heads are a tree) and kept in a heap, so no tree is decoded twice
+    :param scores: a np array from the shape (n+1, n) such that scores[h, m-1] is the score of (h, m)
+    :param k: the number of trees
+    :return: a list of up to k (heads, score) pairs from the best tree down
+    """
+    best = _constrained_decode(scores, {}, set())
+    heap = [(-best[1], 0, best[0], {}, frozenset())]
+    counter = 1
+    trees = []
+    while heap and len(trees) < k:
+        negative_score, _, heads, included, excluded = heapq.heappop(heap)
+        trees.append((heads, -negative_score))
+        if len(trees) == k:
+            break
+        included = dict(included)
+        for modifier in range(1, len(heads) + 1):
+            if modifier in included:
+                continue
+            arc = (int(heads[modifier - 1]), modifier)
+            part_best = _constrained_decode(scores, included, excluded | {arc})
+            if part_best is not None:
+                heapq.heappush(heap, (-part_best[1], counter, part_best[0], dict(included), excluded | {arc}))
+                counter += 1
+            included[modifier] = arc[0]
+    return trees
+
+
+def candidate_heads(scores, k, first_pass_scores=None):
+    """
+    the top k candidate heads of every word, by its scores or by a cheap first pass, and the root that is always a
+    candidate, so the candidate graph always has a spanning tree
+    :param scores: a np array from the shape (n+1, n) such that scores[h, m-1] is the score of (h, m)
+    :param k: the number of candidate heads of every word (not counting the root when it is not among them)
+    :param first_pass_scores: optional scores of the same shape the candidates are chosen by instead of scores
+    :return: a bool np array from the shape (n+1, n), True at the candidate arcs
+    """
+    selection_scores = np.array(scores if first_pass_scores is None else first_pass_scores, dtype=float)
+    num_nodes, num_words = selection_scores.shape
+    modifiers = np.arange(num_words)
+    selection_scores[modifiers + 1, modifiers] = float('-inf')
+    candidates = np.zeros((num_nodes, num_words), dtype=bool)
+    if k >= num_nodes - 1:
+        candidates[:] = True
+    else:
+        top_heads = np.argpartition(-selection_scores, k - 1, axis=0)[:k]
+        candidates[top_heads, modifiers] = True
+    candidates[modifiers + 1, modifiers] = False
+    candidates[0] = True
+    return candidates
+
+
+def _cycles(parent):
+    """
+    :param parent: np array of the parent of every node (parent[0] is ignored, node 0 is the root)
+    :return: a list of the cycles of the graph, every cycle as a list of its nodes
+    """
+    state = np.zeros(len(parent), dtype=np.int8)  # 0 - unvisited, 1 - on the current path, 2 - done
+    state[0] = 2
+    cycles = []
+    for start in range(1, len(parent)):
+        path = []
+        node = start
+        while state[node] == 0:
+            state[node] = 1
+            path.append(node)
+            node = parent[node]
+        if state[node] == 1:
+            cycles.append(path[path.index(node):])
+        state[path] = 2
+    return cycles
+
+
+def sparse_chu_liu_edmonds(num_nodes, heads, modifiers, weights):
+    """
+    the maximum spanning tree (with any number of root children) of a sparse graph by Chu-Liu-Edmonds on its edge
+    list, all the cycles of the best incoming edges are contracted at once and the edge arrays of every contraction
+    level are O(number of edges), so on a pruned graph with k heads per word the work per level is O(k n) instead of
+    O(n^2). every node except the root must have an incoming edge
+    :param num_nodes: the number of nodes, node 0 is the root
+    :param heads: np array of the heads of the edges
+    :param modifiers: np array of the modifiers of the edges
+    :param weights: np array of the weights of the edges
+    :return: np array of the heads of the nodes 1..num_nodes-1
+    """
+    levels = []
+    while True:
+        # the best incoming edge of every node
+        order = np.lexsort((-weights, modifiers))
+        first = np.unique(modifiers[order], return_index=True)[1]
+        best_edge = np.full(num_nodes, -1)
+        best_edge[modifiers[order][first]] = order[first]
+        parent = np.zeros(num_nodes, dtype=np.int64)
+        parent[1:] = heads[best_edge[1:]]
+        cycles = _cycles(parent)
+        if not cycles:
+            break
+        # contract every cycle to a node, the other nodes keep their order
+        in_cycle = np.full(num_nodes, -1)
+        for cycle_index, cycle in enumerate(cycles):
+            in_cycle[cycle] = cycle_index
+        new_ids = np.cumsum(in_cycle < 0) - 1
+        num_free = new_ids[-1] + 1
+        new_ids[in_cycle >= 0] = num_free + in_cycle[in_cycle >= 0]
+        kept = (in_cycle[heads] < 0) | (in_cycle[heads] != in_cycle[modifiers])
+        entering = in_cycle[modifiers] >= 0
+        new_weights = weights - np.where(entering, weights[best_edge[modifiers]], 0.)
+        levels.append((num_nodes, heads, modifiers, best_edge, in_cycle, np.flatnonzero(kept)))
+        num_nodes = num_free + len(cycles)
+        heads, modifiers, weights = new_ids[heads[kept]], new_ids[modifiers[kept]], new_weights[kept]
+    # expand the contractions from the last: every node of a cycle keeps its best edge in the cycle except the node
+    # the edge chosen for the cycle enters
+    chosen = best_edge
+    for num_nodes, heads, modifiers, best_edge, in_cycle, kept in reversed(levels):
+        level_chosen = np.where(in_cycle >= 0, best_edge, -1)
+        chosen_edges = kept[chosen[1:]]
+        level_chosen[modifiers[chosen_edges]] = chosen_edges
+        chosen = level_chosen
+    return heads[chosen[1:]]
+
+
+def pruned_chu_liu_edmonds_decode(scores, k=10, first_pass_scores=None):
+    """
+    the maximum spanning tree of the graph of the top k candidate heads of every word (see candidate_heads), the
+    root is always a candidate so it is a tree, and it is the maximum spanning tree of the full graph whenever the
+    heads of that tree are candidates
+    :param scores: a np array from the shape (n+1, n) such that scores[h, m-1] is the score of (h, m)
+    :return: np array of the heads
+    """
+    candidate_head, candidate_modifier = np.nonzero(candidate_heads(scores, k, first_pass_scores))
+    return sparse_chu_liu_edmonds(scores.shape[0], candidate_head, candidate_modifier + 1,
+                                  np.asarray(scores, dtype=float)[candidate_head, candidate_modifier])
+
+
+class PrunedDecoder:
+    """
+    a decoder (see inference.infer_heads) of the maximum spanning tree of the top k candidate heads of every word
+    """
+    def __init__(self, k=10):
+        self.k = k
+
+    def decode(self, scores):
+        return pruned_chu_liu_edmonds_decode(scores, self.k)
+
+
+# name: (decoder, the strictest requirement it meets)
+DECODERS = {'chu_liu_edmonds': (chu_liu_edmonds_decode, 'non_projective'),
+            'greedy_chu_liu_edmonds': (greedy_chu_liu_edmonds_decode, 'non_projective'),
+            'eisner': (eisner_decode, 'projective'),
+            'greedy': (greedy_decode, 'none')}
+
+
+def calibrate_decoders(lengths=(5, 10, 20, 40, 80, 160), repeats=3, score_samples=None, path=None, seed=0):
+    """
+    times every decoder over sentence lengths and fits a power law time = c * length ** k to each
+    :param lengths: the sentence lengths to time (ignored if score_samples is given)
+    :param repeats: the number of score matrices timed per length
+    :param score_samples: optional list of (n+1, n) np score matrices (e.g. model outputs) to time instead of
+    random scores, the greedy shortcut of greedy_chu_liu_edmonds depends on how peaked the scores are
+    :param path: if given the calibration is saved there as json
+    :return: a dict from decoder name to its (c, k)
+    """
+    if score_samples is None:
+        rng = np.random.default_rng(seed)
+        score_samples = [rng.normal(size=(n + 1, n)) for n in lengths for _ in range(repeats)]
+    calibration = {}
+    for name, (decoder, _) in DECODERS.items():
+        sample_lengths, times = [], []
+        for scores in score_samples:
+            t0 = time.perf_counter()
+            decoder(scores)
+            times.append(time.perf_counter() - t0)
+            sample_lengths.append(scores.shape[1])
+        k, log_c = np.polyfit(np.log(sample_lengths), np.log(times), 1)
+        calibration[name] = (float(np.exp(log_c)), float(k))
+    if path is not None:
+        with open(path, 'w') as f:
+            json.dump(calibration, f, indent=2)
+    return calibration
+
+
+class HybridDecoder:
+    """
+    routes every sentence to the decoder with the lowest predicted time, by its calibrated time curve, among the
+    decoders that meet the requirement (the decision is made once per sentence length) and keeps a record of the
+    decisions and of the time saved compared to Chu-Liu-Edmonds. without a saved calibration the decoders are
+    calibrated on the score matrices of the first sentences it decodes (the scores of the model it is used with),
+    which are decoded with Chu-Liu-Edmonds meanwhile
+    """
+    def __init__(self, requirement='non_projective', calibration_path='decoder_calibration.json', calibration=None,
+                 calibration_sentences=100, measure_baseline=False):
+        """
+        :param requirement: one of REQUIREMENTS
+        :param calibration_path: the saved calibration, if it does not exist the decoders are calibrated and it is
+        saved there (None calibrates without saving)
+        :param calibration: a calibration (as returned by calibrate_decoders) to use instead of the saved one
+        :param calibration_sentences: the number of sentences the decoders are calibrated on
+        :param measure_baseline: if True Chu-Liu-Edmonds is also timed on every sentence routed to another decoder,
+        so the report compares measured times (it costs the time of Chu-Liu-Edmonds)
+        """
+        if calibration is None and calibration_path is not None and os.path.isfile(calibration_path):
+            with open(calibration_path) as f:
+                calibration = json.load(f)
+        self.requirement = requirement
+        self.calibration_path = calibration_path
+        self.calibration_sentences = calibration_sentences
+        self.measure_baseline = measure_baseline
+        self.calibration_samples = []
+        self.decoders = []
+        self.routes = {}
+        self.calibration = None
+        if calibration is not None:
+            self.calibrate(calibration=calibration)
+        self.decisions = defaultdict(Counter)
+        self.calibration_time = 0.
+        self.decode_time = 0.
+        self.predicted_decode_time = 0.
+        self.predicted_baseline_time = 0.
+        self.baseline_time = 0.
+
+    def calibrate(self, score_samples=None, calibration=None):
+        """
+        sets the calibration of the decoders, by timing them on score matrices (see calibrate_decoders) unless it is
+        given
+        """
+        if calibration is None:
+            calibration = calibrate_decoders(score_samples=score_samples, path=self.calibration_path)
+        self.calibration = calibration
+        self.decoders = [name for name, (_, level) in DECODERS.items()
+                         if REQUIREMENTS.index(level) <= REQUIREMENTS.index(self.requirement) and name in calibration]
+        self.routes = {}
+        self.calibration_samples = []
+
+    def predicted_time(self, name, length):
+        c, k = self.calibration[name]
+        return c * length ** k
+
+    def route(self, length):
+        """
+        :return: the name of the decoder for sentences of the given length
+        """
+        if length not in self.routes:
+            self.routes[length] = min(self.decoders, key=lambda name: self.predicted_time(name, length))
+        return self.routes[length]
+
+    def decode(self, scores):
+        """
+        :param scores: a np array from the shape (n+1, n) such that scores[h, m-1] is the score of (h, m)
+        :return: np array of the inferred heads
+        """
+        length = scores.shape[1]
+        if self.calibration is None:
+            t0 = time.perf_counter()
+            heads = chu_liu_edmonds_decode(scores)
+            self.calibration_time += time.perf_counter() - t0
+            self.calibration_samples.append(scores)
+            # the time curves are fitted over lengths, so the samples must have at least two
+            if len(self.calibration_samples) >= self.calibration_sentences and \
+                    len({sample.shape[1] for sample in self.calibration_samples}) > 1:
+                self.calibrate(self.calibration_samples)
+            return heads
+        name = self.route(length)
+        t0 = time.perf_counter()
+        heads = DECODERS[name][0](scores)
+        decode_time = time.perf_counter() - t0
+        self.decode_time += decode_time
+        if self.measure_baseline:
+            if name != 'chu_liu_edmonds':
+                t0 = time.perf_counter()
+                chu_liu_edmonds_decode(scores)
+                decode_time = time.perf_counter() - t0
+            self.baseline_time += decode_time
+        self.predicted_decode_time += self.predicted_time(name, length)
+        self.predicted_baseline_time += self.predicted_time('chu_liu_edmonds', length)
+        self.decisions[name][length] += 1
+        return heads
+
+    def merge(self, other):
+        """
+        adds the decisions and the times of another HybridDecoder (e.g. a copy used by another worker) to this one,
+        and takes its calibration (saved to calibration_path) if this one is not calibrated
+        """
+        for name, lengths in other.decisions.items():
+            self.decisions[name].update(lengths)
+        for attribute in ['calibration_time', 'decode_time', 'predicted_decode_time', 'predicted_baseline_time',
+                          'baseline_time']:
+            setattr(self, attribute, getattr(self, attribute) + getattr(other, attribute))
+        if self.calibration is None and other.calibration is not None:
+            self.calibrate(calibration=other.calibration)
+            if self.calibration_path is not None:
+                with open(self.calibration_path, 'w') as f:
+                    json.dump(self.calibration, f, indent=2)
+
+    def report(self):
+        """
+        prints the routing decisions and the time saved compared to Chu-Liu-Edmonds on the same sentences, predicted
+        by the time curves of the decoders and (with measure_baseline) measured
+        """
+        if self.calibration_time:
+            print('calibration: the first sentences were decoded with Chu-Liu-Edmonds in {:.3f} s'.format(
+                self.calibration_time))
+        for name, lengths in self.decisions.items():
+            print('{}: {} sentences, lengths {}-{}'.format(name, sum(lengths.values()), min(lengths), max(lengths)))
+        print('decoding took {:.3f} s'.format(self.decode_time))
+        print('predicted: {:.3f} s, Chu-Liu-Edmonds {:.3f} s (saved {:.3f} s)'.format(
+            self.predicted_decode_time, self.predicted_baseline_time,
+            self.predicted_baseline_time - self.predicted_decode_time))
+        if self.measure_baseline:
+            print('measured: {:.3f} s, Chu-Liu-Edmonds {:.3f} s (saved {:.3f} s)'.format(
+                self.decode_time, self.baseline_time, self.baseline_time - self.decode_time))
@@ -0,0 +1,96 @@
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+from torch.utils.data.dataset import Dataset
+
+from code_directory.data_loader import DpDataset
+from code_directory.eval import compare_models, load_model
+from code_directory.execution import autocast, configure_execution, loader_kwargs
+
+
+def precompute_teacher_targets(model_path, model_type, dir_path, file, out_path, top_k=8, temperature=1.,
+                               execution_config=None):
+    """
+    runs a teacher model over a file (labeled or not) and saves the head distribution of every word (the softmax over
+    the heads of its scores divided by the temperature) compactly: only the top_k heads of every word are kept, the
+    heads as int16 and their probabilities (renormalized to sum to 1) as float16
+    :param model_path: the path of the teacher model
+    :param model_type: the model type 'advanced', 'base' or 'transformer'
+    :param dir_path: the path of the directory of the file
+    :param file: the name of the file
+    :param out_path: the path of the npz file: heads and probs - arrays from the shape (number of words, top_k),
+    sentence_offsets - where the words of every sentence start in them
+    :param top_k: the number of heads kept for every word
+    :param temperature: the temperature of the head distributions
+    :param execution_config: the execution config (see execution.configure_execution)
+    """
+    config = configure_execution(execution_config)
+    model, indexing_dictionaries = load_model(model_path=model_path, model_type=model_type,
+                                              return_indexing_dictionaries=True)
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    model.to(device)
+    dataset = DpDataset(dir_path, file.split('.')[0], indexing_dictionaries=indexing_dictionaries)
+    loader = DataLoader(dataset, shuffle=False, **loader_kwargs(config))
+    heads_all, probs_all, sentence_lengths = [], [], []
+    for words_idx_tensor, pos_idx_tensor, _, _ in loader:
+        with torch.no_grad(), autocast(config, device):
+            scores = model(words_idx_tensor, pos_idx_tensor)
+        head_probs = torch.softmax(scores.float().cpu()[0] / temperature, dim=0)  # (n+1, n)
+        top_probs, top_heads = head_probs.topk(min(top_k, head_probs.shape[0]), dim=0)
+        top_probs = top_probs / top_probs.sum(dim=0, keepdim=True)
+        heads = np.zeros((head_probs.shape[1], top_k), dtype=np.int16)
+        probs = np.zeros((head_probs.shape[1], top_k), dtype=np.float16)
+        heads[:, :top_heads.shape[0]] = top_heads.t().numpy()
+        probs[:, :top_probs.shape[0]] = top_probs.t().numpy()
+        heads_all.append(heads)
+        probs_all.append(probs)
+        sentence_lengths.append(head_probs.shape[1])
+    np.savez(out_path, heads=np.concatenate(heads_all), probs=np.concatenate(probs_all),
+             sentence_offsets=np.cumsum([0] + sentence_lengths))
+
+
+class DistillationDataset(Dataset):
+    """
+    a DpDataset whose samples have one more (last) element: the (n+1, n) head distributions the teacher saved for the
+    sentence (see precompute_teacher_targets), zero for the heads outside the top_k of every word
+    """
+    def __init__(self, dataset, targets_path):
+        """
+        :param dataset: a DpDataset of the file the targets were computed on (indexed by the student vocabulary)
+        :param targets_path: the path of the saved targets
+        """
+        super().__init__()
+        self.dataset = dataset
+        targets = np.load(targets_path)
+        self.heads = targets['heads'].astype(np.int64)
+        self.probs = targets['probs'].astype(np.float32)
+        self.sentence_offsets = targets['sentence_offsets']
+        if len(self.sentence_offsets) - 1 != len(dataset):
+            raise ValueError('the targets have {} sentences and the dataset has {}'.format(
+                len(self.sentence_offsets) - 1, len(dataset)))
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        sample = self.dataset[index]
+        start, end = self.sentence_offsets[index], self.sentence_offsets[index + 1]
+        heads = torch.from_numpy(self.heads[start:end])
+        teacher_probs = torch.zeros(sample[3], end - start)
+        teacher_probs.scatter_add_(0, heads.t(), torch.from_numpy(self.probs[start:end]).t())
+        return (*sample, teacher_probs)
+
+
+if __name__ == '__main__':
+    from code_directory.train_model import train
+
+    distill_targets = {'train': 'teacher_train.npz', 'comp': 'teacher_comp.npz'}
+    precompute_teacher_targets('./advanced_model.pkl', 'advanced', 'data', 'train.labeled', distill_targets['train'])
+    precompute_teacher_targets('./advanced_model.pkl', 'advanced', 'data', 'comp.unlabeled', distill_targets['comp'])
+    bundles = {'teacher': ('./advanced_model.pkl', 'advanced')}
+    for hidden_dim in [125, 64, 32]:
+        model_path = 'student_{}.pkl'.format(hidden_dim)
+        train(4, model_type='base', model_path=model_path, distill_targets=distill_targets,
+              model_kwargs={'lstm_hidden_dim': hidden_dim, 'lstm_layers': 1, 'mlp_hidden_dim': min(hidden_dim, 100)})
+        bundles['student_{}'.format(hidden_dim)] = (model_path, 'base')
+    compare_models(bundles)
@@ -1,42 +1,268 @@
+import inspect
+import os
+import time
+import numpy as np
 import torch
-from code_directory.Models import AdvancedNet, BaseNet
-from code_directory.inference import compute_uas
+from torch.utils.data import DataLoader, Subset
+from code_directory.Models import AdvancedNet, BaseNet, EnsembleModel, JointNet, TransformerModel, forward_with_labels
+from code_directory.data_loader import DpDataset
+from code_directory.execution import autocast, configure_execution, loader_kwargs
+from code_directory.inference import compute_uas, infer_heads
 
 
 def load_model(model_path, model_type, return_indexing_dictionaries=True):
-    saved_model = torch.load(model_path)
+    """
+    :param model_path: the path of a saved model, or a list of paths of saved models of the same architecture and
+    vocabulary that are loaded as one Models.EnsembleModel (their scores averaged)
+    :param model_type: the model type 'base', 'advanced', 'transformer' or 'joint'
+    :return: the model (in eval mode), and its indexing dictionaries if return_indexing_dictionaries
+    """
+    if isinstance(model_path, (list, tuple)):
+        models, all_indexing_dictionaries = zip(*[load_model(path, model_type) for path in model_path])
+        if any(indexing_dictionaries[:2] != all_indexing_dictionaries[0][:2]
+               for indexing_dictionaries in all_indexing_dictionaries):
+            raise ValueError('the models of an ensemble must have the same vocabulary')
+        model = EnsembleModel(list(models))
+        model.eval()
+        if return_indexing_dictionaries:
+            return model, all_indexing_dictionaries[0]
+        return model
+    saved_model = torch.load(model_path, weights_only=False)
     if model_type == 'base':
         model = BaseNet(**saved_model['args'])
     if model_type == 'advanced':
         model = AdvancedNet(**saved_model['args'])
+    if model_type == 'transformer':
+        model = TransformerModel(**saved_model['args'])
+    if model_type == 'joint':
+        model = JointNet(**saved_model['args'])
     model.load_state_dict(saved_model['state_dict'])
+    model.label_idx_mappings = saved_model.get('label_idx_mappings')
     model.eval()
     if return_indexing_dictionaries:
         return model, saved_model['indexing_dictionaries']
     return model
 
 
-def eval_model(model, loader, loss=None, uas_list: list = None, loss_list: list = None):
+def evaluate_scores(scores, true_heads, loss=None):
+    """
+    computes the number of correct heads and the loss of a sentence from one scores tensor with at most one loss
+    augmented decode (done by the margin losses) and one plain decode. when the loss reports the heads it decoded
+    (the losses in Models accept return_heads) and they are the true heads, the plain decode is skipped: a tree
+    that wins under the loss augmented scores also wins under the plain scores. a loss that decodes perturbed scores
+    (variational_paper_loss) reports None heads, its decode says nothing about the plain scores
+    :param scores: a tensor from the shape (1, n+1, n) as the network outputs
+    :param true_heads: the true heads
+    :param loss: the loss function, None computes the number of correct heads only
+    :return: the number of correct heads and the loss (None if loss is None)
+    """
+    loss_value = None
+    augmented_heads = None
+    if loss is not None:
+        if 'return_heads' in inspect.signature(loss).parameters:
+            loss_value, augmented_heads = loss(scores.to("cpu"), true_heads, return_heads=True)
+        else:
+            loss_value = loss(scores.to("cpu"), true_heads)
+        loss_value = loss_value.item()
+    if augmented_heads is not None and np.array_equal(augmented_heads, true_heads.numpy()):
+        return true_heads.shape[0], loss_value
+    _, num_correct = compute_uas(scores, true_heads)
+    return num_correct, loss_value
+
+
+def sentence_statistics(model, loader, loss=None, execution_config=None, labeled=False):
+    """
+    runs the model once over every sentence in the loader and keeps the per sentence results, every sentence is
+    decoded once and its results can be reused by any number of aggregations (see sampled_eval_model)
+    :param model: the model to evaluate
+    :param loader: a loader of the sentences
+    :param loss: the loss function (or None to compute only the number of correct heads)
+    :param execution_config: the execution config (see execution.configure_execution)
+    :param labeled: if True the model has a label classifier and the loader yields the labels (see DpDataset
+    with_labels), the labels are predicted on the decoded heads and the number of correct labeled heads is counted
+    :return: np arrays of the number of correct heads, the number of words and the loss (None if loss is None) of
+    every sentence, and if labeled the number of correct labeled heads of every sentence
+    """
+    config = configure_execution(execution_config)
     model.eval()
     num_sentences = len(loader)
-    num_total = 0
-    num_correct = 0
-    total_loss = 0.
-    for i, input_data in enumerate(loader):
-        words_idx_tensor, pos_idx_tensor, true_heads, _ = input_data
-        true_heads = true_heads.squeeze(0)
-        num_total += true_heads.shape[0]
-        scores = model(words_idx_tensor, pos_idx_tensor)
-        _, curr_num_correct = compute_uas(scores, true_heads)
-        num_correct += curr_num_correct
-        if loss is not None:
-            total_loss += loss(scores.to("cpu"), true_heads).item()/num_sentences
-    uas = num_correct / num_total
+    num_correct = np.zeros(num_sentences, dtype=np.int64)
+    num_words = np.zeros(num_sentences, dtype=np.int64)
+    losses = np.zeros(num_sentences) if loss is not None else None
+    num_labeled_correct = np.zeros(num_sentences, dtype=np.int64)
+    with torch.no_grad():
+        for i, input_data in enumerate(loader):
+            words_idx_tensor, pos_idx_tensor, true_heads = input_data[:3]
+            true_heads = true_heads.squeeze(0)
+            num_words[i] = true_heads.shape[0]
+            if labeled:
+                with autocast(config, model.device):
+                    scores, label_scores, heads = forward_with_labels(model, words_idx_tensor, pos_idx_tensor)
+                correct_heads = heads[0] == true_heads
+                num_correct[i] = correct_heads.sum().item()
+                labels = label_scores[0].argmax(dim=1).cpu()
+                num_labeled_correct[i] = (correct_heads & (labels == input_data[4][0])).sum().item()
+                if loss is not None:
+                    losses[i] = loss(scores.float().to("cpu"), true_heads).item()
+                continue
+            with autocast(config, model.device):
+                scores = model(words_idx_tensor, pos_idx_tensor)
+            num_correct[i], sentence_loss = evaluate_scores(scores.float(), true_heads, loss)
+            if loss is not None:
+                losses[i] = sentence_loss
+    if labeled:
+        return num_correct, num_words, losses, num_labeled_correct
+    return num_correct, num_words, losses
+
+
+def eval_model(model, loader, loss=None, uas_list: list = None, loss_list: list = None, metrics_only=False,
+               execution_config=None, labeled=False, las_list: list = None):
+    """
+    :param model: the model to evaluate
+    :param loader: a loader of the sentences
+    :param loss: the loss function
+    :param uas_list: if given the UAS is appended to it
+    :param loss_list: if given the loss is appended to it
+    :param metrics_only: if True the loss is skipped entirely (as if loss is None) and only the UAS is returned
+    :param execution_config: the execution config (see execution.configure_execution)
+    :param labeled: if True the LAS is computed too (see sentence_statistics)
+    :param las_list: if given the LAS is appended to it
+    :return: the UAS, the loss if it is computed and the LAS if labeled
+    """
+    if metrics_only:
+        loss = None
+    statistics = sentence_statistics(model, loader, loss, execution_config, labeled)
+    num_correct, num_words, losses = statistics[:3]
+    uas = num_correct.sum() / num_words.sum()
     if uas_list is not None:
         uas_list.append(uas)
+    results = [uas]
     if loss is not None:
+        total_loss = losses.mean()
         if loss_list is not None:
             loss_list.append(total_loss)
-        return uas, total_loss
-    return uas
+        results.append(total_loss)
+    if labeled:
+        las = statistics[3].sum() / num_words.sum()
+        if las_list is not None:
+            las_list.append(las)
+        results.append(las)
+    return tuple(results) if len(results) > 1 else uas
+
+
+def tagging_accuracy(model, loader, execution_config=None):
+    """
+    :param model: a JointNet
+    :param loader: a loader of tagged sentences
+    :return: the accuracy of the POS tags the model predicts
+    """
+    config = configure_execution(execution_config)
+    model.eval()
+    num_correct, num_words = 0, 0
+    with torch.no_grad():
+        for input_data in loader:
+            words_idx_tensor, pos_idx_tensor = input_data[:2]
+            with autocast(config, model.device):
+                _, tag_scores = model.forward_with_tags(words_idx_tensor)
+            num_correct += (tag_scores[0].argmax(dim=1).cpu() == pos_idx_tensor[0, 1:]).sum().item()
+            num_words += tag_scores.shape[1]
+    return num_correct / num_words
+
+
+def sampled_eval_model(model, dataset, loss=None, sample_size=1000, seed=0, num_bootstrap=1000, confidence=0.95,
+                       uas_list: list = None, loss_list: list = None, execution_config=None):
+    """
+    estimates the UAS (and the loss) of the model on the dataset from a fixed random subset of its sentences, with
+    bootstrap confidence intervals
+    :param model: the model to evaluate
+    :param dataset: the dataset to sample the sentences from
+    :param loss: the loss function (or None to estimate only the UAS)
+    :param sample_size: the number of sentences to sample (the whole dataset is used if it is not larger)
+    :param seed: the seed of the sample and of the bootstrap, the same seed gives the same subset on every call
+    :param num_bootstrap: the number of bootstrap resamples
+    :param confidence: the confidence level of the intervals
+    :param uas_list: if given the estimated UAS is appended to it
+    :param loss_list: if given the estimated loss is appended to it
+    :param execution_config: the execution config (see execution.configure_execution)
+    :return: the estimated UAS and its (low, high) interval, and if loss is not None the estimated loss and its
+    interval too (uas, loss, uas_interval, loss_interval)
+    """
+    rng = np.random.default_rng(seed)
+    if sample_size is not None and sample_size < len(dataset):
+        indices = np.sort(rng.choice(len(dataset), size=sample_size, replace=False))
+        dataset = Subset(dataset, indices.tolist())
+    config = configure_execution(execution_config)
+    loader = DataLoader(dataset, shuffle=False, **loader_kwargs(config))
+    num_correct, num_words, losses = sentence_statistics(model, loader, loss, config)
+    uas = num_correct.sum() / num_words.sum()
+    resamples = rng.integers(0, len(num_correct), size=(num_bootstrap, len(num_correct)))
+    percentiles = [100 * (1 - confidence) / 2, 100 * (1 + confidence) / 2]
+    bootstrap_uas = num_correct[resamples].sum(axis=1) / num_words[resamples].sum(axis=1)
+    uas_interval = tuple(np.percentile(bootstrap_uas, percentiles))
+    if uas_list is not None:
+        uas_list.append(uas)
+    if loss is None:
+        return uas, uas_interval
+    total_loss = losses.mean()
+    loss_interval = tuple(np.percentile(losses[resamples].mean(axis=1), percentiles))
+    if loss_list is not None:
+        loss_list.append(total_loss)
+    return uas, total_loss, uas_interval, loss_interval
+
+
+def evaluate_training(model, train_dataset, test_loader, loss, train_eval_size=1000, train_eval_seed=0,
+                      execution_config=None, labeled=False, joint=False):
+    """
+    the evaluation of a test epoch of the training (see train_model.train): the UAS and the loss estimated on a
+    sample of train (see sampled_eval_model) and the UAS and the loss of test
+    :param labeled: if True the test LAS is computed too
+    :param joint: if True the test POS tagging accuracy of the model (a JointNet) is computed too
+    :return: a dict with train_uas, train_loss, train_uas_interval, test_uas, test_loss, and test_las if labeled and
+    pos_accuracy if joint
+    """
+    train_uas, train_loss, train_uas_interval, _ = sampled_eval_model(
+        model, train_dataset, loss, sample_size=train_eval_size, seed=train_eval_seed,
+        execution_config=execution_config)
+    test_uas, test_loss, *test_las = eval_model(model, test_loader, loss, execution_config=execution_config,
+                                                labeled=labeled)
+    result = {'train_uas': train_uas, 'train_loss': train_loss, 'train_uas_interval': train_uas_interval,
+              'test_uas': test_uas, 'test_loss': test_loss}
+    if labeled:
+        result['test_las'] = test_las[0]
+    if joint:
+        result['pos_accuracy'] = tagging_accuracy(model, test_loader, execution_config)
+    return result
+
 
+def compare_models(bundles, dir_path='data', file='test.labeled', execution_config=None):
+    """
+    prints the number of parameters, the size of the saved model (the parameters and the indexing dictionaries), the
+    latency (of the network and the decoding) and the UAS of saved models on a labeled file, e.g. a teacher and its
+    students or a model and its pruned versions
+    :param bundles: a dict from a name to (model path, model type), the model path may be a list of paths of an
+    ensemble (see load_model)
+    :return: a list of (name, number of parameters, MB, ms per sentence, UAS)
+    """
+    config = configure_execution(execution_config)
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    results = []
+    print('model\tparameters\tMB\tms/sentence\tUAS')
+    for name, (model_path, model_type) in bundles.items():
+        model, indexing_dictionaries = load_model(model_path=model_path, model_type=model_type,
+                                                  return_indexing_dictionaries=True)
+        model.to(device)
+        dataset = DpDataset(dir_path, file.split('.')[0], indexing_dictionaries=indexing_dictionaries)
+        loader = DataLoader(dataset, shuffle=False, **loader_kwargs(config))
+        t0 = time.perf_counter()
+        for words_idx_tensor, pos_idx_tensor, _, _ in loader:
+            with torch.no_grad(), autocast(config, device):
+                scores = model(words_idx_tensor, pos_idx_tensor)
+            infer_heads(scores.float())
+        latency = 1000 * (time.perf_counter() - t0) / len(dataset)
+        uas = eval_model(model, loader, execution_config=config)
+        num_parameters = sum(parameter.numel() for parameter in model.parameters())
+        model_paths = model_path if isinstance(model_path, (list, tuple)) else [model_path]
+        size = sum(os.path.getsize(path) for path in model_paths) / 2 ** 20
+        results.append((name, num_parameters, size, latency, uas))
+        print('{}\t{}\t{:.2f}\t{:.2f}\t{:.4f}'.format(*results[-1]))
+    return results
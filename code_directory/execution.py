@@ -0,0 +1,54 @@
+import os
+
+import torch
+
+DEFAULT_EXECUTION_CONFIG = {'num_threads': None, 'num_interop_threads': None, 'bf16': False, 'num_workers': 0,
+                            'pin_workers': False}
+
+
+def configure_execution(execution_config=None):
+    """
+    applies the thread counts of the execution config to torch
+    :param execution_config: a dict with some of the keys of DEFAULT_EXECUTION_CONFIG:
+        num_threads - the number of intra-op threads (None keeps the torch default)
+        num_interop_threads - the number of inter-op threads (None keeps the torch default), torch allows setting it
+            only once per process before any parallel work, later requests are ignored
+        bf16 - if True the model runs under bfloat16 autocast on CPU
+        num_workers - the number of DataLoader worker processes
+        pin_workers - if True every DataLoader worker is pinned to one of the CPUs of the process
+    :return: the full execution config
+    """
+    config = dict(DEFAULT_EXECUTION_CONFIG)
+    if execution_config is not None:
+        config.update(execution_config)
+    if config['num_threads'] is not None:
+        torch.set_num_threads(config['num_threads'])
+    if config['num_interop_threads'] is not None and torch.get_num_interop_threads() != config['num_interop_threads']:
+        try:
+            torch.set_num_interop_threads(config['num_interop_threads'])
+        except RuntimeError:
+            pass
+    return config
+
+
+def autocast(config, device):
+    """
+    :return: the autocast context of the model forward, bfloat16 when config['bf16'] is set and the device is CPU
+    """
+    return torch.autocast(device_type='cpu', dtype=torch.bfloat16, enabled=config['bf16'] and device.type == 'cpu')
+
+
+def _pin_worker(worker_id):
+    cpus = sorted(os.sched_getaffinity(0))
+    os.sched_setaffinity(0, {cpus[worker_id % len(cpus)]})
+    torch.set_num_threads(1)
+
+
+def loader_kwargs(config):
+    """
+    :return: the DataLoader keyword arguments of the execution config
+    """
+    kwargs = {'num_workers': config['num_workers']}
+    if config['num_workers'] > 0 and config['pin_workers'] and hasattr(os, 'sched_setaffinity'):
+        kwargs['worker_init_fn'] = _pin_worker
+    return kwargs
@@ -0,0 +1,142 @@
+import contextlib
+import csv
+import itertools
+import os
+import random
+
+import torch
+import torch.multiprocessing as mp
+
+from code_directory.data_loader import DpDataset, SharedDataset
+from code_directory.train_model import train
+
+# the hyperparameters that are arguments of train, the others are arguments of the model constructor
+TRAIN_HYPERPARAMETERS = ['lr', 'word_dropout_a', 'loss_type']
+
+# the datasets shared by the trials of a worker process, set by _init_worker
+_datasets = None
+
+
+def _init_worker(datasets):
+    global _datasets
+    _datasets = datasets
+
+
+def _run_trial(trial_dir, model_type, hyperparameters, epochs, num_threads, train_kwargs):
+    """
+    trains a trial up to epochs epochs in a worker process, continuing its previous run from its checkpoint, with the
+    output of train in trial_dir/log.txt
+    :return: the test UAS of the trial after the last epoch
+    """
+    model_path = os.path.join(trial_dir, 'model.pkl')
+    checkpoint_dir = os.path.join(trial_dir, 'checkpoints')
+    with open(os.path.join(trial_dir, 'log.txt'), 'a') as log, contextlib.redirect_stdout(log):
+        train(epochs, model_type=model_type, model_path=model_path, checkpoint_dir=checkpoint_dir,
+              resume=checkpoint_dir, keep_checkpoints=1, datasets=_datasets,
+              execution_config={'num_threads': num_threads},
+              model_kwargs={name: value for name, value in hyperparameters.items()
+                            if name not in TRAIN_HYPERPARAMETERS},
+              **{name: value for name, value in hyperparameters.items() if name in TRAIN_HYPERPARAMETERS},
+              **train_kwargs)
+    return torch.load(model_path, weights_only=False)['test_uas_arr'][-1]
+
+
+def sample_configurations(search_space, num_trials=None, seed=0):
+    """
+    :param search_space: a dict from a hyperparameter to the list of its values
+    :param num_trials: the number of configurations, sampled without repetition from the grid, None for the whole
+    grid
+    :return: a list of dicts from a hyperparameter to its value
+    """
+    names = sorted(search_space)
+    grid = [dict(zip(names, values)) for values in itertools.product(*[search_space[name] for name in names])]
+    if num_trials is None or num_trials >= len(grid):
+        return grid
+    return random.Random(seed).sample(grid, num_trials)
+
+
+def _make_datasets(model_type, with_labels=False, word_hash_buckets=None):
+    """
+    :return: the train and test datasets train makes for the model type, in shared memory
+    """
+    word_embeddings_name = "glove.6B.100d" if model_type != 'base' and word_hash_buckets is None else None
+    train_dataset = DpDataset('data', 'train', word_embeddings_name=word_embeddings_name,
+                              with_labels=with_labels and model_type != 'joint', word_hash_buckets=word_hash_buckets)
+    test_dataset = DpDataset('data', 'test', vocab_dataset=train_dataset, with_labels=train_dataset.with_labels)
+    return SharedDataset(train_dataset), SharedDataset(test_dataset)
+
+
+def hp_search(search_space, model_type='advanced', num_trials=None, min_epochs=1, max_epochs=25, eta=3,
+              out_dir='hp_search', results_path=None, max_parallel=None, seed=0, train_kwargs=None):
+    """
+    searches hyperparameters with successive halving: all the trials are trained for min_epochs epochs, the best
+    1 / eta of them (by the test UAS) are trained on to eta times more epochs, and so on up to max_epochs. the trials
+    run concurrently in a pool of worker processes that share the train and test datasets (made once, in shared
+    memory, see data_loader.SharedDataset), and every (process) trial gets an equal share of the CPUs as intra-op
+    threads. a trial continues from the checkpoint of its previous rung (see train resume)
+    :param search_space: a dict from a hyperparameter to the list of its values, the hyperparameters are lr,
+    word_dropout_a and loss_type (see train) and the arguments of the model constructor (e.g. attn_dropout,
+    attn_type, lstm_dropout)
+    :param model_type: the model type (see train)
+    :param num_trials: the number of configurations sampled from the grid of the search space, None for all of them
+    :param min_epochs: the number of epochs of the first rung
+    :param max_epochs: the number of epochs of the last rung
+    :param eta: the factor of the number of epochs between rungs, 1 / eta of the trials go on to the next rung
+    :param out_dir: the directory of the trials: a directory trial_<index> for every trial with its model, its
+    checkpoint and the output of its training in log.txt
+    :param results_path: the path of the results table, a csv file with a row for every trial in every rung: the
+    trial, the rung, the epochs, the test UAS, the status (promoted, stopped or finished) and the hyperparameters
+    (out_dir/results.csv if None)
+    :param max_parallel: the number of trials that run at once, None for the number of CPUs
+    :param seed: the seed of the sampling of the configurations
+    :param train_kwargs: other arguments of train that all the trials share (e.g. train_eval_size, with_labels)
+    :return: a list of (hyperparameters, test UAS) of the trials of the last rung, the best first
+    """
+    train_kwargs = dict(train_kwargs or {})
+    configurations = sample_configurations(search_space, num_trials, seed)
+    rungs = []
+    epochs = min_epochs
+    while epochs < max_epochs:
+        rungs.append(epochs)
+        epochs *= eta
+    rungs.append(max_epochs)
+    results_path = results_path if results_path is not None else os.path.join(out_dir, 'results.csv')
+    for index in range(len(configurations)):
+        os.makedirs(os.path.join(out_dir, 'trial_{:03d}'.format(index)), exist_ok=True)
+    num_cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    num_workers = max(1, min(max_parallel or num_cpus, len(configurations)))
+    num_threads = max(1, num_cpus // num_workers)
+    datasets = _make_datasets(model_type, train_kwargs.get('with_labels', False),
+                              train_kwargs.get('word_hash_buckets'))
+    names = sorted(search_space)
+    trials = list(range(len(configurations)))
+    with open(results_path, 'w', newline='') as results_file:
+        results_writer = csv.writer(results_file)
+        results_writer.writerow(['trial', 'rung', 'epochs', 'test_uas', 'status'] + names)
+        with mp.get_context('spawn').Pool(num_workers, initializer=_init_worker, initargs=(datasets,)) as pool:
+            for rung, epochs in enumerate(rungs):
+                uas = pool.starmap(_run_trial, [(os.path.join(out_dir, 'trial_{:03d}'.format(trial)), model_type,
+                                                 configurations[trial], epochs, num_threads, train_kwargs)
+                                                for trial in trials])
+                ranking = sorted(zip(trials, uas), key=lambda trial_uas: -trial_uas[1])
+                last_rung = rung == len(rungs) - 1
+                promoted = ranking if last_rung else ranking[:max(1, len(ranking) // eta)]
+                promoted_trials = [trial for trial, _ in promoted]
+                for trial, trial_uas in ranking:
+                    status = 'finished' if last_rung else 'promoted' if trial in promoted_trials else 'stopped'
+                    results_writer.writerow([trial, rung, epochs, trial_uas, status] +
+                                            [configurations[trial][name] for name in names])
+                results_file.flush()
+                print('rung {}: {} trials trained to {} epochs, best test UAS {:.4f} (trial {})'.format(
+                    rung, len(trials), epochs, ranking[0][1], ranking[0][0]))
+                trials = promoted_trials
+    return [(configurations[trial], trial_uas) for trial, trial_uas in ranking]
+
+
+if __name__ == '__main__':
+    results = hp_search({'word_dropout_a': [0.25, 1, 5], 'attn_dropout': [0., 0.25], 'lr': [0.001, 0.005, 0.01],
+                         'attn_type': ['additive', 'multiplicative', 'biaffine'],
+                         'loss_type': ['nll', 'regularized_paper']},
+                        model_type='advanced', num_trials=27, min_epochs=1, max_epochs=25, eta=3,
+                        train_kwargs={'train_eval_size': 200})
+    print('best:', results[0])
@@ -1,9 +1,10 @@
 from code_directory.chu_liu_edmonds import decode_mst
+from code_directory.decoding import k_best_decode
 import torch
 import numpy as np
 
 
-def infer_heads(scores, squeeze=True):
+def infer_heads(scores, squeeze=True, decoder=None, k=None):
     """
     infer the heads
     :param scores: a tensor from the shape (n+1, n) (or (1, n+1, n) if squeeze==True where n is the length of the
@@ -11,10 +12,18 @@ def infer_heads(scores, squeeze=True):
     score of (h, m)
     :param squeeze: if the input is from the shape (1, n+1, n) (as the network outputs) the first dimension will be
     squeezed
-    :return: np array of inferred heads where the first value is the head of the first word of the sentence and so on
+    :param decoder: an object with a decode method from the np array of the scores to the heads (e.g.
+    decoding.HybridDecoder), None decodes the maximum spanning tree with Chu-Liu-Edmonds
+    :param k: if given the k best trees are decoded (see decoding.k_best_decode) instead of the best one
+    :return: np array of inferred heads where the first value is the head of the first word of the sentence and so on,
+    or if k is given a list of up to k (heads, tree score) pairs from the best tree down
     """
     if squeeze:
         scores = torch.squeeze(scores, 0)
+    if k is not None:
+        return k_best_decode(scores.detach().cpu().numpy().astype(float), k)
+    if decoder is not None:
+        return decoder.decode(scores.detach().cpu().numpy())
     length = scores.shape[0]
     weights = np.empty((length, length))
     weights[:, 1:] = scores.detach().cpu().numpy()
@@ -22,6 +31,22 @@ def infer_heads(scores, squeeze=True):
     return decode_mst(weights, length, has_labels=False)[0][1:]
 
 
+def infer_k_best_heads(scores, k, lengths=None):
+    """
+    decodes the k best trees of every sentence in a padded batch
+    :param scores: a tensor from the shape (B, T+1, T) such that scores[b, h, m-1] is the score of (h, m)
+    :param k: the number of trees of every sentence
+    :param lengths: a tensor from the shape (B,) of the lengths of the sentences (including the ROOT as in DpDataset),
+    None if nothing is padded
+    :return: a list with a list of up to k (heads, tree score) pairs of every sentence
+    """
+    scores = scores.detach().cpu().numpy().astype(float)
+    if lengths is None:
+        lengths = [scores.shape[1]] * scores.shape[0]
+    return [k_best_decode(sentence_scores[:length, :length - 1], k)
+            for sentence_scores, length in zip(scores, lengths.tolist() if torch.is_tensor(lengths) else lengths)]
+
+
 def compute_uas(scores, true_heads, squeeze=True):
     """
 
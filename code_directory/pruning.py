@@ -0,0 +1,219 @@
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Subset
+
+from code_directory.Models import AdditiveAttention, BaseNet, BiaffineAttention, nll_loss
+from code_directory.data_loader import DpDataset
+from code_directory.eval import compare_models, load_model
+from code_directory.train_model import make_optimizers
+
+
+def _unit_groups(model):
+    """
+    the groups of hidden units of a BaseNet or AdvancedNet that can be removed, the units of a group are removed
+    together from all the parameters they own: unit j of a group of size H owns the indices offset + c * H + j for c
+    in range(chunks) of the dim of every slice
+    :return: a dict from a group name to (its size, a list of slices (parameter name, dim, offset, chunks))
+    """
+    lstm = model.lstm
+    hidden_dim, num_layers = lstm.hidden_size, lstm.num_layers
+    suffixes = ['', '_reverse']
+    if isinstance(model, BaseNet):
+        mlp_rows, mlp_columns = ['layer1_head', 'layer1_modifier'], ['out_layer.weight']
+    elif isinstance(model.attn, AdditiveAttention):
+        mlp_rows, mlp_columns = ['attn.layer1_head.0', 'attn.layer1_modifier.0'], ['attn.out_layer.weight']
+    elif isinstance(model.attn, BiaffineAttention):
+        mlp_rows, mlp_columns = ['attn.projection.0'], ['attn.weight']
+    else:
+        mlp_rows, mlp_columns = ['attn.layer_head.0', 'attn.layer_modifier.0'], []
+    groups = {}
+    for layer in range(num_layers):
+        for direction, suffix in enumerate(suffixes):
+            slices = [('lstm.{}_l{}{}'.format(name, layer, suffix), 0, 0, 4)
+                      for name in ['weight_ih', 'weight_hh', 'bias_ih', 'bias_hh']]
+            slices.append(('lstm.weight_hh_l{}{}'.format(layer, suffix), 1, 0, 1))
+            if layer + 1 < num_layers:
+                consumers = ['lstm.weight_ih_l{}{}'.format(layer + 1, next_suffix) for next_suffix in suffixes]
+            else:
+                consumers = [name + '.weight' for name in mlp_rows]
+                if model.label_classifier is not None:
+                    consumers.append('label_classifier.projection.0.weight')
+            slices += [(name, 1, direction * hidden_dim, 1) for name in consumers]
+            groups['lstm_l{}{}'.format(layer, suffix)] = (hidden_dim, slices)
+    mlp_dim = model.state_dict()[mlp_rows[0] + '.weight'].shape[0]
+    if isinstance(model, BaseNet) or not isinstance(model.attn, BiaffineAttention):
+        groups['mlp'] = (mlp_dim, [(name + '.' + parameter, 0, 0, 1)
+                                   for name in mlp_rows for parameter in ['weight', 'bias']] +
+                         [(name, 1, 0, 1) for name in mlp_columns])
+    else:
+        # unit j of the biaffine scorer is the head unit j and the modifier unit j of its fused projection
+        groups['mlp'] = (mlp_dim // 2, [('attn.projection.0.weight', 0, 0, 2), ('attn.projection.0.bias', 0, 0, 2),
+                                        ('attn.weight', 0, 0, 1), ('attn.weight', 1, 0, 1),
+                                        ('attn.head_bias', 0, 0, 1)])
+    return groups
+
+
+def _unit_indices(size, offset, chunks, units):
+    return torch.cat([offset + chunk * size + units for chunk in range(chunks)])
+
+
+def unit_importance(model, dataset=None, loss_func=nll_loss, criterion='taylor'):
+    """
+    scores every hidden unit of the LSTM and of the attention (or the MLP of a BaseNet) by the importance of the
+    parameters it owns, summed over them
+    :param model: a BaseNet or an AdvancedNet
+    :param dataset: the sentences the importance is estimated on (e.g. a subset of train), for criterion 'taylor'
+    :param loss_func: the loss of the sentences
+    :param criterion: 'taylor' - the sum over the sentences of the squared first order (weight times gradient)
+    estimate of the change in the loss when the parameter is removed, 'magnitude' - the absolute value of the
+    parameter (the data is not used)
+    :return: a dict from a group of units (see _unit_groups) to the importance of its units
+    """
+    parameters = dict(model.named_parameters())
+    if criterion == 'magnitude':
+        scores = {name: parameter.detach().abs() for name, parameter in parameters.items()}
+    elif criterion == 'taylor':
+        scores = {name: torch.zeros_like(parameter) for name, parameter in parameters.items()}
+        model.eval()
+        # the backward of the cudnn LSTM is not allowed in eval mode
+        with torch.backends.cudnn.flags(enabled=False):
+            for words_idx_tensor, pos_idx_tensor, true_heads, _ in DataLoader(dataset, shuffle=False):
+                model.zero_grad()
+                scores_out = model(words_idx_tensor, pos_idx_tensor)
+                loss_func(scores_out.to("cpu"), true_heads.squeeze(0)).backward()
+                for name, parameter in parameters.items():
+                    if parameter.grad is not None:
+                        scores[name] += (parameter.detach() * parameter.grad).pow(2)
+        model.zero_grad()
+    else:
+        raise ValueError('unknown importance criterion: {}'.format(criterion))
+    importance = {}
+    for group, (size, slices) in _unit_groups(model).items():
+        importance[group] = torch.zeros(size, device=next(model.parameters()).device)
+        for name, dim, offset, chunks in slices:
+            score = scores[name].transpose(0, dim).reshape(scores[name].shape[dim], -1).sum(dim=1)
+            units = _unit_indices(size, offset, chunks, torch.arange(size, device=score.device))
+            importance[group] += score[units].view(chunks, size).sum(0)
+    return importance
+
+
+def prune_model(model, importance, lstm_hidden_dim=None, hidden_dim=None):
+    """
+    removes the least important hidden units of a model, the result is a new dense model with smaller hidden sizes,
+    every (layer, direction) of the LSTM keeps its own most important lstm_hidden_dim units
+    :param model: a BaseNet or an AdvancedNet
+    :param importance: the importance of the units (see unit_importance)
+    :param lstm_hidden_dim: the new hidden size of the LSTM (None keeps it)
+    :param hidden_dim: the new hidden size of the attention of an AdvancedNet or of the MLP of a BaseNet (None keeps
+    it)
+    :return: the pruned model (in eval mode)
+    """
+    groups = _unit_groups(model)
+    kept = {}
+    for group, (size, _) in groups.items():
+        new_size = hidden_dim if group == 'mlp' else lstm_hidden_dim
+        new_size = size if new_size is None else new_size
+        kept[group] = importance[group].topk(new_size).indices.sort().values.cpu()
+    # the units kept in every dim of every parameter, from all the groups that own parts of it (in the order of the
+    # offsets, e.g. the forward and then the backward direction of the previous LSTM layer)
+    parameter_indices = {}
+    for group, (size, slices) in groups.items():
+        for name, dim, offset, chunks in slices:
+            parameter_indices.setdefault((name, dim), []).append((offset, _unit_indices(size, offset, chunks,
+                                                                                        kept[group])))
+    state_dict = model.state_dict()
+    for (name, dim), indices in parameter_indices.items():
+        indices = torch.cat([index for _, index in sorted(indices, key=lambda offset_index: offset_index[0])])
+        state_dict[name] = state_dict[name].index_select(dim, indices.to(state_dict[name].device))
+    args = dict(model.args, lstm_hidden_dim=len(kept['lstm_l0']))
+    args['mlp_hidden_dim' if isinstance(model, BaseNet) else 'attn_hidden_dim'] = len(kept['mlp'])
+    pruned_model = type(model)(**args, device=model.device)
+    pruned_model.load_state_dict(state_dict)
+    for pruned_parameter, parameter in zip(pruned_model.word_embedding.parameters(), model.word_embedding.parameters()):
+        pruned_parameter.requires_grad = parameter.requires_grad
+    pruned_model.to(model.device)
+    pruned_model.eval()
+    return pruned_model
+
+
+def fine_tune(model, dataset, loss_func=nll_loss, epochs=1, lr=0.001, acumulate_grad_steps=50):
+    """
+    trains a (pruned) model for a few epochs
+    :return: the model (in eval mode)
+    """
+    optimizers = make_optimizers(model, lr=lr)
+    loader = DataLoader(dataset, shuffle=True)
+    model.train()
+    for epoch in range(epochs):
+        for i, (words_idx_tensor, pos_idx_tensor, true_heads, _) in enumerate(loader):
+            scores = model(words_idx_tensor, pos_idx_tensor)
+            loss = loss_func(scores.to("cpu"), true_heads.squeeze(0)) / acumulate_grad_steps
+            loss.backward()
+            if (i + 1) % acumulate_grad_steps == 0:
+                for optimizer in optimizers:
+                    optimizer.step()
+                model.zero_grad()
+    model.zero_grad()
+    model.eval()
+    return model
+
+
+def prune_bundle(model_path, model_type, out_path, lstm_hidden_dim=None, hidden_dim=None, importance=None,
+                 criterion='taylor', num_sentences=1000, fine_tune_epochs=0, loss_func=nll_loss, dir_path='data',
+                 seed=0):
+    """
+    prunes a saved model and saves the pruned model as a bundle that eval.load_model loads with the same model type
+    :param model_path: the path of the model
+    :param model_type: 'base' or 'advanced'
+    :param out_path: the path of the pruned model
+    :param lstm_hidden_dim: the new hidden size of the LSTM
+    :param hidden_dim: the new hidden size of the attention (or of the MLP of a BaseNet)
+    :param importance: the importance of the units if it is already computed (see unit_importance)
+    :param criterion: the importance criterion (see unit_importance)
+    :param num_sentences: the number of train sentences (a fixed random subset) the importance is estimated on, None
+    for all
+    :param fine_tune_epochs: the number of epochs the pruned model is trained on train.labeled (0 for none)
+    :return: the importance of the units of the model (to prune it again to other sizes)
+    """
+    model, indexing_dictionaries = load_model(model_path=model_path, model_type=model_type,
+                                              return_indexing_dictionaries=True)
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    model.to(device)
+    train_dataset = DpDataset(dir_path, 'train', indexing_dictionaries=indexing_dictionaries)
+    if importance is None:
+        sample = train_dataset
+        if criterion == 'taylor' and num_sentences is not None and num_sentences < len(train_dataset):
+            indices = np.random.default_rng(seed).choice(len(train_dataset), size=num_sentences, replace=False)
+            sample = Subset(train_dataset, np.sort(indices).tolist())
+        importance = unit_importance(model, sample, loss_func, criterion)
+    pruned_model = prune_model(model, importance, lstm_hidden_dim, hidden_dim)
+    if fine_tune_epochs:
+        torch.manual_seed(seed)
+        fine_tune(pruned_model, train_dataset, loss_func, epochs=fine_tune_epochs)
+    torch.save({'state_dict': pruned_model.state_dict(), 'args': pruned_model.args,
+                'indexing_dictionaries': indexing_dictionaries, 'label_idx_mappings': model.label_idx_mappings},
+               out_path)
+    return importance
+
+
+def pruning_table(model_path, model_type, sizes, fine_tune_epochs=0, dir_path='data', file='test.labeled',
+                  execution_config=None):
+    """
+    prunes a saved model to several sizes and prints the parameter count, latency and UAS of every pruned model next
+    to the model
+    :param sizes: a list of (lstm_hidden_dim, hidden_dim)
+    :return: the results of eval.compare_models
+    """
+    bundles = {'unpruned': (model_path, model_type)}
+    importance = None
+    for lstm_hidden_dim, hidden_dim in sizes:
+        pruned_path = '{}_pruned_{}_{}.pkl'.format(model_path.rsplit('.', 1)[0], lstm_hidden_dim, hidden_dim)
+        importance = prune_bundle(model_path, model_type, pruned_path, lstm_hidden_dim, hidden_dim, importance,
+                                  fine_tune_epochs=fine_tune_epochs, dir_path=dir_path)
+        bundles['lstm {} / hidden {}'.format(lstm_hidden_dim, hidden_dim)] = (pruned_path, model_type)
+    return compare_models(bundles, dir_path, file, execution_config)
+
+
+if __name__ == '__main__':
+    pruning_table('./advanced_model.pkl', 'advanced', [(100, 80), (75, 60), (50, 40)], fine_tune_epochs=1)
+    pruning_table('./basic_model.pkl', 'base', [(100, 80), (75, 60), (50, 40)], fine_tune_epochs=1)
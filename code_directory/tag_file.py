@@ -1,64 +1,321 @@
+import contextlib
+import copy
+import multiprocessing
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
 from torch.utils.data import DataLoader
 import numpy as np
 
-from code_directory.data_loader import DpDataset
+from code_directory.Models import JointNet, arc_marginals
+from code_directory.data_loader import SPECIAL_TOKENS
+from code_directory.data_loader import DpDataReader, DpDataset
 from code_directory.eval import load_model
+from code_directory.execution import autocast, configure_execution, loader_kwargs
 from code_directory.inference import infer_heads
 
+# the number of columns of a line of a CoNLL file
+CONLL_COLUMNS = 10
 
-def tag_file(dir_path: str, file: str, out_path, model_path, model_type, time_run=False):
+
+def write_tagged_file(file_to_tag, file_to_write, sentence_heads, sentence_head_probs=None, sentence_labels=None,
+                      sentence_pos_tags=None):
+    """
+    writes a copy of the file to tag with the inferred heads in column 7
+    :param file_to_tag: the path of the file to tag
+    :param file_to_write: the path of the output
+    :param sentence_heads: the inferred heads of every sentence of the file
+    :param sentence_head_probs: if given the probabilities of the heads of every sentence, written to column 9 with
+    their mean (the confidence of the sentence) in column 10
+    :param sentence_labels: if given the inferred relation labels of every sentence, written to column 8
+    :param sentence_pos_tags: if given the inferred POS tags of every sentence, written to column 4 where it is '_'
+    """
+    write_tagged_files(file_to_tag, [(file_to_write, sentence_heads, sentence_head_probs, sentence_labels,
+                                      sentence_pos_tags)])
+
+
+def _sentence_lines(lines):
+    for sentence in lines:
+        yield from sentence
+        yield '\n'
+
+
+def write_tagged_files(file_to_tag, outputs, lines=None):
+    """
+    writes several tagged copies of a file in one pass over it (see write_tagged_file), every word line of the
+    copies has the 10 CoNLL columns (a line with fewer columns is padded with '_')
+    :param file_to_tag: the path of the file to tag
+    :param outputs: a list of (the path of the output, sentence_heads, sentence_head_probs, sentence_labels,
+    sentence_pos_tags) as the arguments of write_tagged_file
+    :param lines: the lines of the sentences of the file if they were already read (see data_loader.DpDataReader
+    keep_lines), None reads the file
+    """
+    file_writers = [open(output[0], 'w') for output in outputs]
+    try:
+        sentence_counter = 0
+        word_in_sentence = 0
+        file_reader = open(file_to_tag, 'r') if lines is None else contextlib.nullcontext(_sentence_lines(lines))
+        with file_reader as file_lines:
+            for line_number, line in enumerate(file_lines, 1):
+                if not line.strip():
+                    for file_writer in file_writers:
+                        file_writer.write('\n')
+                    sentence_counter += 1
+                    word_in_sentence = 0
+                    continue
+                columns = line.rstrip('\n').split('\t')
+                if len(columns) > CONLL_COLUMNS:
+                    raise ValueError('line {} of {} has {} columns, a CoNLL line has {}'.format(
+                        line_number, file_to_tag, len(columns), CONLL_COLUMNS))
+                # the missing columns (e.g. of a file with the first 7 columns only) are written as '_'
+                columns += ['_'] * (CONLL_COLUMNS - len(columns))
+                for file_writer, (_, sentence_heads, sentence_head_probs, sentence_labels, sentence_pos_tags) in \
+                        zip(file_writers, outputs):
+                    split_words = list(columns)
+                    split_words[6] = str(sentence_heads[sentence_counter][word_in_sentence])
+                    if sentence_labels is not None:
+                        split_words[7] = sentence_labels[sentence_counter][word_in_sentence]
+                    if sentence_pos_tags is not None and split_words[3] == '_':
+                        split_words[3] = sentence_pos_tags[sentence_counter][word_in_sentence]
+                    if sentence_head_probs is not None:
+                        head_probs = sentence_head_probs[sentence_counter]
+                        split_words[8] = '{:.4f}'.format(head_probs[word_in_sentence])
+                        split_words[9] = '{:.4f}'.format(head_probs.mean())
+                    file_writer.write('\t'.join(split_words) + '\n')
+                word_in_sentence += 1
+    finally:
+        for file_writer in file_writers:
+            file_writer.close()
+
+
+class _SentenceParser:
+    """
+    parses the (index tensors of the) sentences of a DpDataset with a model: the heads, and the relation labels if
+    the model has a label classifier, and the POS tags if it is a JointNet
+    """
+    def __init__(self, model, indexing_dictionaries, config, decoder=None):
+        self.model = model
+        self.config = config
+        self.decoder = decoder
+        self.label_names = None
+        if model.label_classifier is not None:
+            self.label_names = {index: label for label, index in model.label_idx_mappings.items()}
+        self.tag_names = {index: tag for tag, index in indexing_dictionaries[1].items()}
+        self.special_tags = [indexing_dictionaries[1][token] for token in SPECIAL_TOKENS]
+
+    def __call__(self, words_idx_tensor, pos_idx_tensor):
+        """
+        :param words_idx_tensor: the word indices of a sentence from the shape (1, n+1)
+        :param pos_idx_tensor: the tag indices of the sentence from the shape (1, n+1)
+        :return: the scores (1, n+1, n), the heads, the labels (None if the model has no label classifier) and the
+        POS tags (None if the model is not a JointNet)
+        """
+        model = self.model
+        labels, tags = None, None
+        with torch.no_grad(), autocast(self.config, model.device):
+            if isinstance(model, JointNet):
+                scores, tag_scores = model.forward_with_tags(words_idx_tensor)
+                tag_scores[:, :, self.special_tags] = float('-inf')
+                tags = [self.tag_names[tag] for tag in tag_scores[0].argmax(dim=1).tolist()]
+            else:
+                encoding = model.encode(words_idx_tensor, pos_idx_tensor)
+                scores = model.score_arcs(encoding)
+        heads = infer_heads(scores.float(), decoder=self.decoder)
+        if model.label_classifier is not None:
+            with torch.no_grad(), autocast(self.config, model.device):
+                label_scores = model.label_classifier(encoding, torch.from_numpy(heads.astype(np.int64))[None])
+            labels = [self.label_names[label] for label in label_scores[0].argmax(dim=1).tolist()]
+        return scores, heads, labels, tags
+
+
+def tag_file(dir_path: str, file: str, out_path, model_path, model_type, time_run=False, execution_config=None,
+             decoder=None, nbest=None, nbest_path=None, marginals_path=None, confidence_columns=False):
     """
+    writes the inferred heads to column 7 of the output, and if the model has a label classifier (see
+    Models.LabelClassifier) the relation labels of the inferred arcs to column 8. a JointNet parses untagged text:
+    it reads the words only and writes the POS tags it infers (in the same encoder pass) to column 4 where it is '_'
     :param out_path: the path of the output
     :param dir_path: the path of the directory of the file to tag
     :param file: the name of the file to tag
-    :param model_path: the path of the model to tag with
-    :param model_type: the model type 'advanced' or base
+    :param model_path: the path of the model to tag with, or a list of paths of models of the same architecture
+    whose arc scores are averaged (see Models.EnsembleModel) and decoded once
+    :param model_type: the model type 'advanced', 'base', 'transformer' or 'joint'
     :param time_run: if True times the run
+    :param execution_config: the execution config (see execution.configure_execution)
+    :param decoder: the decoder of the heads (see inference.infer_heads), e.g. a decoding.HybridDecoder whose routing
+    report is printed if time_run is True
+    :param nbest: if given the nbest best trees of every sentence are written to a side file, a line for every tree:
+    the sentence index, the rank of the tree, its score and its heads (separated by tabs, the heads by spaces)
+    :param nbest_path: the path of the side file (out_path + '.nbest' if None)
+    :param marginals_path: if given the arc marginals (see Models.arc_marginals) of the inferred heads are saved there
+    as a npz file: head_probs - the probability of the inferred head of every word of the file, sentence_confidence -
+    the mean of head_probs over every sentence, sentence_offsets - where the words of every sentence start in
+    head_probs
+    :param confidence_columns: if True the probability of the inferred head of every word is written to column 9
+    and the confidence of its sentence to column 10 of the output
     :return:
     """
+    config = configure_execution(execution_config)
     if time_run:
         t0 = time.time()
     model, indexing_dictionaries = load_model(model_path=model_path, model_type=model_type,
                                               return_indexing_dictionaries=True)
     dataset = DpDataset(dir_path, file.split('.')[0], indexing_dictionaries=indexing_dictionaries)
-    loader = DataLoader(dataset, shuffle=False)
+    loader = DataLoader(dataset, shuffle=False, **loader_kwargs(config))
     num_sentences = len(loader)
     device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
     model.to(device)
     inferred_head_all = np.zeros((num_sentences, 1), dtype='object')
+    nbest_all = []
+    head_probs_all = []
+    labels_all = []
+    tags_all = []
+    parse = _SentenceParser(model, indexing_dictionaries, config, decoder)
     for i, input_data in enumerate(loader):
         words_idx_tensor, pos_idx_tensor, true_heads, _ = input_data
         true_heads = true_heads.squeeze(0)
-        scores = model(words_idx_tensor, pos_idx_tensor)
-        infered_heads = infer_heads(scores)
+        scores, infered_heads, labels, tags = parse(words_idx_tensor, pos_idx_tensor)
+        if labels is not None:
+            labels_all.append(labels)
+        if tags is not None:
+            tags_all.append(tags)
+        if nbest is not None:
+            nbest_all.append(infer_heads(scores.float(), k=nbest))
+        if marginals_path is not None or confidence_columns:
+            marginals = arc_marginals(scores.float().cpu())[0]
+            head_probs_all.append(marginals[infered_heads, np.arange(len(infered_heads))].numpy())
         inferred_head_all[i, 0] = infered_heads
         assert ((true_heads.shape[0]) == infered_heads.shape[0])
-    file_to_tag = os.path.join(dir_path, file)
-    file_to_write = out_path
-    sentence_counter = 0
-    word_in_sentence = 0
-    with open(file_to_write, 'w') as file_writer:
-        with open(file_to_tag, 'r') as file_reader:
-            for i, line in enumerate(file_reader):
-                sentence_tags = inferred_head_all[sentence_counter, 0]
-                if line.strip():
-                    split_words = line.split('\t')
-                    infered_head = sentence_tags[word_in_sentence]
-                    split_words[6] = str(infered_head)
-                    new_line = '\t'.join(split_words)
-                    file_writer.write(new_line)
-
-                    word_in_sentence += 1
-                else:
-                    file_writer.write('\n')
-                    sentence_counter += 1
-                    word_in_sentence = 0
+    write_tagged_file(os.path.join(dir_path, file), out_path, inferred_head_all[:, 0],
+                      head_probs_all if confidence_columns else None,
+                      labels_all if model.label_classifier is not None else None, tags_all or None)
+    if marginals_path is not None:
+        np.savez(marginals_path, head_probs=np.concatenate(head_probs_all),
+                 sentence_confidence=np.array([head_probs.mean() for head_probs in head_probs_all]),
+                 sentence_offsets=np.cumsum([0] + [len(head_probs) for head_probs in head_probs_all]))
+    if nbest is not None:
+        with open(nbest_path if nbest_path is not None else out_path + '.nbest', 'w') as nbest_writer:
+            for sentence_index, trees in enumerate(nbest_all):
+                for rank, (heads, score) in enumerate(trees):
+                    nbest_writer.write('{}\t{}\t{}\t{}\n'.format(sentence_index, rank, score,
+                                                                   ' '.join(str(head) for head in heads)))
     if time_run:
         print('training took:', time.time()-t0)
+        if hasattr(decoder, 'report'):
+            decoder.report()
+
+
+def _shared_dataset(datasets, indexing_dictionaries, datareader, dir_path, file):
+    """
+    the DpDataset of the file indexed by the given dictionaries, made once for every distinct vocabulary: models that
+    were trained with the same vocabulary parse the same index tensors
+    """
+    for dataset in datasets:
+        if dataset.word_idx_mappings == indexing_dictionaries[0] and \
+                dataset.pos_idx_mappings == indexing_dictionaries[1]:
+            return dataset
+    dataset = DpDataset(dir_path, file.split('.')[0], indexing_dictionaries=indexing_dictionaries,
+                        datareader=datareader)
+    datasets.append(dataset)
+    return dataset
+
+
+def _parse_file(parse, dataset):
+    """
+    :return: the inferred heads, labels and POS tags of every sentence of the dataset as the arguments of
+    write_tagged_file (the labels or the tags are None if the model does not infer them)
+    """
+    heads_all, labels_all, tags_all = [], [], []
+    for i in range(len(dataset)):
+        words_idx_tensor, pos_idx_tensor = dataset[i][:2]
+        _, heads, labels, tags = parse(words_idx_tensor.unsqueeze(0), pos_idx_tensor.unsqueeze(0))
+        heads_all.append(heads)
+        labels_all.append(labels)
+        tags_all.append(tags)
+    return (heads_all, None, labels_all if parse.label_names is not None else None,
+            tags_all if isinstance(parse.model, JointNet) else None)
+
+
+# the (parser, dataset) pairs of tag_files, which the forked worker processes inherit instead of unpickling them
+_forked_parsers = None
+
+
+def _parse_forked(index, num_threads):
+    """
+    :return: the results of _parse_file and the decoder of the parser (with the records of its decisions)
+    """
+    torch.set_num_threads(num_threads)
+    parse, dataset = _forked_parsers[index]
+    return _parse_file(parse, dataset), parse.decoder
+
+
+def tag_files(dir_path: str, file: str, jobs, time_run=False, execution_config=None, decoder=None, workers='threads'):
+    """
+    tags a file with several models: the file is read once, the index tensors of its sentences are made once for
+    every distinct vocabulary of the models, the models parse them concurrently and all the outputs are written in
+    one pass over the file (see tag_file for the columns that are written)
+    :param dir_path: the path of the directory of the file to tag
+    :param file: the name of the file to tag
+    :param jobs: a list of (the path of the output, the path of the model (or a list of paths of an ensemble, see
+    tag_file), the model type)
+    :param time_run: if True times the run
+    :param execution_config: the execution config (see execution.configure_execution)
+    :param decoder: the decoder of the heads (see inference.infer_heads), every model decodes with its own copy of
+    it, and the records of the copies are added to it if it has a merge method (see decoding.HybridDecoder)
+    :param workers: 'threads' - a thread for every model (the torch ops release the GIL, best for large models),
+    'processes' - a forked process for every model that shares the loaded models and the index tensors with the
+    parent and gets an equal share of its intra-op threads (best for small models, whose parsing is mostly python,
+    CPU only), None - the models parse the file one after the other
+    """
+    config = configure_execution(execution_config)
+    if time_run:
+        t0 = time.time()
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    file_path = os.path.join(dir_path, file)
+    datareader = DpDataReader(file_path, keep_lines=True)
+    datasets = []
+    parsers = []
+    for _, model_path, model_type in jobs:
+        model, indexing_dictionaries = load_model(model_path=model_path, model_type=model_type,
+                                                  return_indexing_dictionaries=True)
+        model.to(device)
+        dataset = _shared_dataset(datasets, indexing_dictionaries, datareader, dir_path, file)
+        worker_decoder = copy.deepcopy(decoder)
+        if hasattr(worker_decoder, 'calibration_path'):
+            # the copies are calibrated without saving, the calibration is saved by merge
+            worker_decoder.calibration_path = None
+        parsers.append((_SentenceParser(model, indexing_dictionaries, config, worker_decoder), dataset))
+    if time_run:
+        print('loading took:', time.time() - t0)
+
+    worker_decoders = [parse.decoder for parse, _ in parsers]
+    if workers == 'processes' and len(parsers) > 1 and device.type == 'cpu':
+        global _forked_parsers
+        _forked_parsers = parsers
+        num_threads = max(1, torch.get_num_threads() // len(parsers))
+        try:
+            with multiprocessing.get_context('fork').Pool(len(parsers)) as pool:
+                results_decoders = pool.starmap(_parse_forked, [(i, num_threads) for i in range(len(parsers))])
+        finally:
+            _forked_parsers = None
+        results = [result for result, _ in results_decoders]
+        worker_decoders = [worker_decoder for _, worker_decoder in results_decoders]
+    elif workers is not None and len(parsers) > 1:
+        with ThreadPoolExecutor(max_workers=len(parsers)) as executor:
+            results = list(executor.map(lambda parser: _parse_file(*parser), parsers))
+    else:
+        results = [_parse_file(*parser) for parser in parsers]
+    if hasattr(decoder, 'merge'):
+        for worker_decoder in worker_decoders:
+            decoder.merge(worker_decoder)
+    write_tagged_files(file_path, [(out_path, *result) for (out_path, _, _), result in zip(jobs, results)],
+                       datareader.lines)
+    if time_run:
+        print('tagging with {} models took: {}'.format(len(jobs), time.time() - t0))
+        if hasattr(decoder, 'report'):
+            decoder.report()
 
 
 if __name__ == '__main__':
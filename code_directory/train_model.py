@@ -1,20 +1,54 @@
 import time
+from functools import partial
 import torch
 import numpy as np
 import matplotlib.pyplot as plt
-from code_directory.Models import BaseNet, AdvancedNet, nll_loss, regularized_paper_loss
+from code_directory.Models import BaseNet, AdvancedNet, JointNet, WordDropout, nll_loss, paper_loss, \
+    regularized_paper_loss, variational_paper_loss, tree_crf_loss, distillation_loss, forward_with_labels, label_loss, \
+    pos_loss, compress_word_embedding
 from torch import optim
-from code_directory.data_loader import DpDataset
-from torch.utils.data import DataLoader
+from code_directory.checkpoint import CheckpointWriter, ResumableSampler, latest_checkpoint, rng_state, set_rng_state
+from code_directory.data_loader import DpDataset, PadCollate
+from code_directory.distillation import DistillationDataset
+from torch.utils.data import ConcatDataset, DataLoader
 
-from code_directory.eval import eval_model
+from code_directory.async_eval import BackgroundEvaluator
+from code_directory.eval import compare_models, evaluate_training, load_model
+from code_directory.execution import autocast, configure_execution, loader_kwargs
+
+LOSS_FUNCTIONS = {'nll': nll_loss, 'paper': paper_loss,
+                  'regularized_paper': partial(regularized_paper_loss, alpha=0.5),
+                  'variational_paper': variational_paper_loss, 'tree_crf': tree_crf_loss}
+
+
+def make_optimizers(model, lr):
+    """
+    :param model: the model to train
+    :param lr: the learning rate of the optimizers
+    :return: a list of the optimizers of the model: Adam, and if the model has embeddings with sparse gradients (e.g.
+    BaseNet with sparse_word_embedding) SparseAdam for them, which keeps Adam moments for the whole vocabulary but
+    updates only the rows of the words of the step (lazy Adam)
+    """
+    sparse_parameters = [module.weight for module in model.modules()
+                         if isinstance(module, torch.nn.Embedding) and module.sparse and module.weight.requires_grad]
+    if not sparse_parameters:
+        return [optim.Adam(model.parameters(), lr=lr)]
+    sparse_ids = {id(parameter) for parameter in sparse_parameters}
+    return [optim.Adam([parameter for parameter in model.parameters() if id(parameter) not in sparse_ids], lr=lr),
+            optim.SparseAdam(sparse_parameters, lr=lr)]
 
 
 def train(epochs, model_type='advanced', test_epoch=1, save_model=True, model_path='model.pkl',
-          save_plots=False, plot_dir='./', checkpoint_at_test=False, checkpoint_path=None, time_run=False):
+          save_plots=False, plot_dir='./', checkpoint_at_test=False, checkpoint_path=None, time_run=False,
+          train_eval_size=1000, train_eval_seed=0, loss_type=None, execution_config=None, model_kwargs=None,
+          distill_targets=None, distill_weight=0.5, distill_temperature=1., checkpoint_dir=None,
+          checkpoint_every_steps=None, checkpoint_every_seconds=None, keep_checkpoints=3, resume=None,
+          with_labels=False, sparse_embeddings=False, word_hash_buckets=None, lr=None, word_dropout_a=None,
+          datasets=None, async_eval=False, async_eval_max_pending=2, async_eval_threads=1, best_model_path=None):
     """
     :param epochs: number of epochs
-    :param model_type: type of the model 'advanced' or 'base'
+    :param model_type: type of the model 'advanced', 'base' or 'joint' (a POS tagger and a parser with a shared
+    encoder, see Models.JointNet, trained on the sum of the parsing loss and the tagging loss)
     :param test_epoch: test every test_epoch epochs
     :param save_model: save the model or not
     :param model_path: path to save the model
@@ -23,89 +57,282 @@ def train(epochs, model_type='advanced', test_epoch=1, save_model=True, model_pa
     :param checkpoint_at_test: if True saves checkpoint of the model every test
     :param checkpoint_path: path to save the checkpoint to (appended the epoch number) if checkpoint_at_test==True
     :param time_run: if True rimes the run
+    :param train_eval_size: the number of train sentences (a fixed random subset) used to estimate the train UAS and
+    loss every test, None evaluates on the whole train set
+    :param train_eval_seed: the seed of the train evaluation subset
+    :param loss_type: one of the keys of LOSS_FUNCTIONS, None uses the default loss of the model type
+    :param execution_config: the execution config (see execution.configure_execution)
+    :param model_kwargs: arguments of the model constructor that override the defaults of the model type, e.g.
+    {'lstm_hidden_dim': 64, 'lstm_layers': 1, 'mlp_hidden_dim': 64} for a small student
+    :param distill_targets: a dict from a subset of data (e.g. 'train', 'comp') to the teacher targets saved for it
+    (see distillation.precompute_teacher_targets), the model is trained on the head distributions of the teacher
+    too, and the subsets other than train (labeled or not) are added to the train data
+    :param distill_weight: the weight of the distillation loss, the loss of the gold heads is weighted by the rest
+    (the sentences without gold heads are trained on the distillation loss only)
+    :param distill_temperature: the temperature the teacher targets were computed with
+    :param checkpoint_dir: if given the full training state (the model, the optimizers, the schedulers, the random
+    generators, the position in the data order and the results so far) is saved there periodically, in the
+    background, keeping the last keep_checkpoints checkpoints (see checkpoint.CheckpointWriter)
+    :param checkpoint_every_steps: save a checkpoint every this number of optimizer steps
+    :param checkpoint_every_seconds: save a checkpoint when this number of seconds passed since the last one (checked
+    after every optimizer step)
+    :param keep_checkpoints: the number of checkpoints kept in checkpoint_dir
+    :param resume: a checkpoint file or a checkpoint directory (its latest checkpoint) to resume the training from,
+    with the same arguments as the run that saved it, the resumed run continues exactly as the saved one would have
+    (when the data is loaded in the main process, the word dropout of loader workers is seeded anew)
+    :param with_labels: if True the model is trained to predict the relation labels too (with a label classifier
+    scored on the gold arcs) and the test LAS is reported
+    :param sparse_embeddings: if True the word embedding (when it is trained) gets sparse gradients and is trained by
+    SparseAdam, and the rest of the model by Adam (see make_optimizers), a step then costs in the embedding the rows
+    of its words instead of the whole vocabulary
+    :param word_hash_buckets: if given the words are hashed into this number of buckets instead of indexed by the
+    vocabulary of train (see data_loader.HashedVocab), and the advanced model does not start from the pre trained
+    word embedding
+    :param lr: the learning rate, None for the default of the model type
+    :param word_dropout_a: the alpha of the word dropout (see Models.drop_words), None for the default of the model type
+    :param datasets: (train dataset, test dataset) that are already made from data/train and data/test with the
+    arguments of this run (e.g. a data_loader.SharedDataset shared by the trials of a search), None makes them
+    :param async_eval: if True the tests run in a background process on snapshots of the model while the training
+    goes on (see async_eval.BackgroundEvaluator), their results are logged (and the checkpoints of checkpoint_at_test
+    and best_model_path saved) when they come back, all of them before the model and the plots are saved (the
+    periodic checkpoints do not have the results of the tests that are still running)
+    :param async_eval_max_pending: the number of snapshots that can wait for their results, the training waits when
+    there are more
+    :param async_eval_threads: the number of threads of the background evaluation
+    :param best_model_path: if given the model of the test with the best test UAS is saved there
     :return: the trained model
     """
     if time_run:
         t0 = time.time()
+    config = configure_execution(execution_config)
     torch.manual_seed(0)
     device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
     train_uas_array = []
     train_loss_array = []
     test_uas_array = []
     test_loss_array = []
+    model_kwargs = dict({'sparse_word_embedding': True} if sparse_embeddings else {}, **(model_kwargs or {}))
     if model_type == 'advanced':
-        train_dataset = DpDataset('data', 'train', word_embeddings_name="glove.6B.100d")
-        model: AdvancedNet = AdvancedNet(word_emb_dim=100, tag_emb_dim=100, lstm_hidden_dim=125,
-                                         attn_type='multiplicative', attn_hidden_dim=100, attn_dropout=0.25,
-                                         lstm_dropout=0.1,
-                                         word_vocab_size=len(train_dataset.word_idx_mappings),
-                                         tag_vocab_size=len(train_dataset.pos_idx_mappings),
-                                         appearance_count=train_dataset.word_idx_to_appearance, dropout_a=5,
-                                         unk_word_ind=train_dataset.unk_word_idx,
-                                         pre_trained_word_embedding=train_dataset.word_embeddings)
-        # dropout_a is the alpha for word dropout
-        optimizer = optim.Adam(model.parameters(), lr=0.005)
-        scheduler = optim.lr_scheduler.MultiStepLR(optimizer, [6], gamma=0.2)
-        loss_func = lambda out, th: regularized_paper_loss(out, th, alpha=0.5)
+        train_dataset = datasets[0] if datasets is not None else DpDataset(
+            'data', 'train', word_embeddings_name=None if word_hash_buckets else "glove.6B.100d",
+            with_labels=with_labels, word_hash_buckets=word_hash_buckets)
+        model_args = dict(word_emb_dim=100, tag_emb_dim=100, lstm_hidden_dim=125,
+                          attn_type='multiplicative', attn_hidden_dim=100, attn_dropout=0.25,
+                          lstm_dropout=0.1,
+                          word_vocab_size=len(train_dataset.word_idx_mappings),
+                          tag_vocab_size=len(train_dataset.pos_idx_mappings),
+                          unk_word_ind=train_dataset.unk_word_idx,
+                          pre_trained_word_embedding=train_dataset.word_embeddings,
+                          num_labels=len(train_dataset.label_idx_mappings) if with_labels else None)
+        model_args.update(model_kwargs)
+        model: AdvancedNet = AdvancedNet(**model_args)
+        # a is the alpha for word dropout
+        word_dropout = WordDropout(train_dataset.word_idx_to_appearance,
+                                   a=5 if word_dropout_a is None else word_dropout_a,
+                                   unk_ind=train_dataset.unk_word_idx)
+        optimizers = make_optimizers(model, lr=0.005 if lr is None else lr)
+        schedulers = [optim.lr_scheduler.MultiStepLR(optimizer, [6], gamma=0.2) for optimizer in optimizers]
+        loss_func = partial(regularized_paper_loss, alpha=0.5)
+    if model_type == 'joint':
+        if with_labels:
+            raise ValueError('the joint model does not predict labels')
+        train_dataset = datasets[0] if datasets is not None else DpDataset(
+            'data', 'train', word_embeddings_name=None if word_hash_buckets else "glove.6B.100d",
+            word_hash_buckets=word_hash_buckets)
+        model_args = dict(word_emb_dim=100, lstm_hidden_dim=125, attn_type='biaffine', attn_hidden_dim=100,
+                          attn_dropout=0.25, lstm_dropout=0.1,
+                          word_vocab_size=len(train_dataset.word_idx_mappings),
+                          tag_vocab_size=len(train_dataset.pos_idx_mappings),
+                          unk_word_ind=train_dataset.unk_word_idx,
+                          pre_trained_word_embedding=train_dataset.word_embeddings)
+        model_args.update(model_kwargs)
+        model: JointNet = JointNet(**model_args)
+        word_dropout = WordDropout(train_dataset.word_idx_to_appearance,
+                                   a=5 if word_dropout_a is None else word_dropout_a,
+                                   unk_ind=train_dataset.unk_word_idx)
+        optimizers = make_optimizers(model, lr=0.005 if lr is None else lr)
+        schedulers = [optim.lr_scheduler.MultiStepLR(optimizer, [6], gamma=0.2) for optimizer in optimizers]
+        loss_func = nll_loss
     if model_type == 'base':
-        train_dataset = DpDataset('data', 'train', word_embeddings_name=None)
-        model: BaseNet = BaseNet(word_emb_dim=100, tag_emb_dim=25, lstm_hidden_dim=125,
-                                 word_vocab_size=len(train_dataset.word_idx_mappings),
-                                 tag_vocab_size=len(train_dataset.pos_idx_mappings),
-                                 appearance_count=train_dataset.word_idx_to_appearance, dropout_a=0.25,
-                                 unk_word_ind=train_dataset.unk_word_idx)
-        optimizer = optim.Adam(model.parameters(), lr=0.01)
-        scheduler = None
+        train_dataset = datasets[0] if datasets is not None else DpDataset(
+            'data', 'train', word_embeddings_name=None, with_labels=with_labels, word_hash_buckets=word_hash_buckets)
+        model_args = dict(word_emb_dim=100, tag_emb_dim=25, lstm_hidden_dim=125,
+                          word_vocab_size=len(train_dataset.word_idx_mappings),
+                          tag_vocab_size=len(train_dataset.pos_idx_mappings),
+                          unk_word_ind=train_dataset.unk_word_idx,
+                          num_labels=len(train_dataset.label_idx_mappings) if with_labels else None)
+        model_args.update(model_kwargs)
+        model: BaseNet = BaseNet(**model_args)
+        word_dropout = WordDropout(train_dataset.word_idx_to_appearance,
+                                   a=0.25 if word_dropout_a is None else word_dropout_a,
+                                   unk_ind=train_dataset.unk_word_idx)
+        optimizers = make_optimizers(model, lr=0.01 if lr is None else lr)
+        schedulers = []
         loss_func = nll_loss
-    train_loader = DataLoader(train_dataset, shuffle=True)
-    test_dataset = DpDataset('data', 'test', vocab_dataset=train_dataset)
-    test_loader = DataLoader(test_dataset, shuffle=False)
+    if loss_type is not None:
+        loss_func = LOSS_FUNCTIONS[loss_type]
+    # the word dropout is applied by the collate of the train loader, in the loader workers, not by the model
+    train_data = train_dataset
+    if distill_targets is not None:
+        train_data = ConcatDataset([
+            DistillationDataset(train_dataset if subset == 'train' else
+                                DpDataset('data', subset, vocab_dataset=train_dataset, with_labels=with_labels),
+                                targets_path)
+            for subset, targets_path in distill_targets.items()] +
+            ([train_dataset] if 'train' not in distill_targets else []))
+    train_sampler = ResumableSampler(train_data, seed=0)
+    train_collate = PadCollate(word_dropout)
+    train_loader = DataLoader(train_data, sampler=train_sampler, collate_fn=train_collate, **loader_kwargs(config))
+    test_dataset = datasets[1] if datasets is not None else DpDataset('data', 'test', vocab_dataset=train_dataset,
+                                                                      with_labels=with_labels)
+    model.label_idx_mappings = train_dataset.label_idx_mappings
+    test_las_array = []
+    test_loader = DataLoader(test_dataset, shuffle=False, **loader_kwargs(config))
     model.to(device)
     acumulate_grad_steps = 50
+    start_epoch, start_sentence, step, printable_loss, resume_state = 0, 0, 0, 0, None
+    if resume is not None and latest_checkpoint(resume) is not None:
+        resume_state = torch.load(latest_checkpoint(resume), weights_only=False)
+        model.load_state_dict(resume_state['model'])
+        for optimizer, optimizer_state in zip(optimizers, resume_state['optimizers']):
+            optimizer.load_state_dict(optimizer_state)
+        for scheduler, scheduler_state in zip(schedulers, resume_state['schedulers']):
+            scheduler.load_state_dict(scheduler_state)
+        start_epoch, start_sentence, step = resume_state['epoch'], resume_state['sentence'], resume_state['step']
+        printable_loss = resume_state['printable_loss']
+        train_uas_array, train_loss_array, test_uas_array, test_loss_array, test_las_array = resume_state['results']
+        print("Resuming from epoch {}, sentence {}".format(start_epoch + 1, start_sentence))
+    def model_bundle(state_dict):
+        return {'state_dict': state_dict, 'args': model.args,
+                'indexing_dictionaries': (train_dataset.word_idx_mappings, test_dataset.pos_idx_mappings,
+                                          train_dataset.word_idx_to_appearance, None),
+                'label_idx_mappings': train_dataset.label_idx_mappings}
+
+    def record_test(epoch, result, state_dict, completed='Completed'):
+        train_uas_array.append(result['train_uas'])
+        train_loss_array.append(result['train_loss'])
+        test_uas_array.append(result['test_uas'])
+        test_loss_array.append(result['test_loss'])
+        if with_labels:
+            test_las_array.append(result['test_las'])
+        print("Epoch {} {},\tTrain Loss: {}, \tTest Loss: {},\tTrain UAS: {} ({:.4f}-{:.4f})\t "
+              "Test UAS: {}".format(epoch + 1, completed, result['train_loss'], result['test_loss'],
+                                    result['train_uas'], *result['train_uas_interval'], result['test_uas']) +
+              ("\tTest LAS: {}".format(result['test_las']) if with_labels else "") +
+              ("\tTest POS accuracy: {}".format(result['pos_accuracy']) if model_type == 'joint' else ""))
+        if checkpoint_at_test:
+            torch.save(dict(model_bundle(state_dict), test_uas=result['test_uas'], train_uas=result['train_uas']),
+                       checkpoint_path+'_'+str(epoch+1))
+        if best_model_path is not None and result['test_uas'] >= max(test_uas_array):
+            torch.save(dict(model_bundle(state_dict), test_uas=result['test_uas'], epoch=epoch + 1), best_model_path)
+
+    evaluator = None
+    if async_eval:
+        evaluator = BackgroundEvaluator(model, train_dataset, test_dataset, loss_func,
+                                        partial(record_test, completed='Evaluated'),
+                                        max_pending=async_eval_max_pending, num_threads=async_eval_threads,
+                                        train_eval_size=train_eval_size, train_eval_seed=train_eval_seed,
+                                        execution_config=config, labeled=with_labels, joint=model_type == 'joint')
+
+    def training_state(epoch, sentence):
+        return {'model': model.state_dict(), 'optimizers': [optimizer.state_dict() for optimizer in optimizers],
+                'schedulers': [scheduler.state_dict() for scheduler in schedulers], 'epoch': epoch,
+                'sentence': sentence, 'step': step, 'printable_loss': printable_loss, 'rng': rng_state(train_collate),
+                'results': (train_uas_array, train_loss_array, test_uas_array, test_loss_array, test_las_array)}
+
+    checkpoint_writer = CheckpointWriter(checkpoint_dir, keep_checkpoints) if checkpoint_dir is not None else None
+    last_checkpoint_time = time.time()
     print("Training Started")
-    for epoch in range(epochs):
-        printable_loss = 0
-        for i, input_data in enumerate(train_loader):
-            words_idx_tensor, pos_idx_tensor, true_heads, _ = input_data
+    for epoch in range(start_epoch, epochs):
+        if epoch > start_epoch:
+            start_sentence, printable_loss = 0, 0
+        train_sampler.set_epoch(epoch, start_sentence)
+        if resume_state is not None and start_sentence == 0:
+            # saved at the end of the training, before the loader of the next epoch drew its seed
+            set_rng_state(resume_state['rng'], train_collate)
+            resume_state = None
+        batches = iter(train_loader)
+        if resume_state is not None:
+            # after the loader drew its seed, as it had when the checkpoint was saved
+            set_rng_state(resume_state['rng'], train_collate)
+            resume_state = None
+        for i, input_data in enumerate(batches, start=start_sentence):
+            words_idx_tensor, pos_idx_tensor, true_heads = input_data[:3]
+            extra = list(input_data[4:])
+            true_labels = extra.pop(0) if with_labels else None
+            teacher_probs = extra.pop(0) if extra else None
+            with autocast(config, device):
+                if with_labels:
+                    scores, label_scores, _ = forward_with_labels(model, words_idx_tensor, pos_idx_tensor,
+                                                                  heads=true_heads)
+                elif model_type == 'joint':
+                    scores, tag_scores = model.forward_with_tags(words_idx_tensor)
+                else:
+                    scores = model(words_idx_tensor, pos_idx_tensor)
             true_heads = true_heads.squeeze(0)
-            scores = model(words_idx_tensor, pos_idx_tensor)
-            loss = loss_func(scores.to("cpu"), true_heads)
+            scores = scores.float().to("cpu")
+            if teacher_probs is not None:
+                # scaled by the squared temperature so its gradients do not shrink with the temperature
+                loss = distill_temperature ** 2 * distillation_loss(scores, teacher_probs, distill_temperature)
+                if (true_heads >= 0).all():
+                    loss = distill_weight * loss + (1 - distill_weight) * loss_func(scores, true_heads)
+            else:
+                loss = loss_func(scores, true_heads)
+            if with_labels and (true_heads >= 0).all() and (true_labels >= 0).any():
+                loss = loss + label_loss(label_scores.float().to("cpu"), true_labels)
+            if model_type == 'joint':
+                true_tags = pos_idx_tensor[:, 1:]
+                # the padded words and the words without a tag are not trained on
+                true_tags = true_tags.masked_fill((torch.arange(true_tags.shape[1]) >= input_data[3].unsqueeze(1) - 1) |
+                                                  (true_tags == train_dataset.unk_pos_idx), -1)
+                if (true_tags >= 0).any():
+                    loss = loss + pos_loss(tag_scores.float().to("cpu"), true_tags)
             loss = loss / acumulate_grad_steps
             loss.backward()
 
             if (i+1) % acumulate_grad_steps == 0:
-                optimizer.step()
-                if scheduler is not None:
+                for optimizer in optimizers:
+                    optimizer.step()
+                for scheduler in schedulers:
                     scheduler.step()
                 model.zero_grad()
                 printable_loss += loss.item()
+                step += 1
+                if checkpoint_writer is not None and (
+                        (checkpoint_every_steps is not None and step % checkpoint_every_steps == 0) or
+                        (checkpoint_every_seconds is not None and
+                         time.time() - last_checkpoint_time >= checkpoint_every_seconds)):
+                    checkpoint_writer.save(training_state(epoch, i + 1), step)
+                    last_checkpoint_time = time.time()
+                if evaluator is not None:
+                    # the results of the snapshots are recorded as they come back
+                    evaluator.poll()
 
-        if (epoch + 1) % test_epoch == 0:
-            train_uas, train_loss = eval_model(model, train_loader, loss_func, uas_list=train_uas_array,
-                                               loss_list=train_loss_array)
-            test_uas, test_loss = eval_model(model, test_loader, loss_func, uas_list=test_uas_array,
-                                             loss_list=test_loss_array)
-            print("Epoch {} Completed,\tTrain Loss: {}, \tTest Loss: {},\tTrain UAS: {}\t Test UAS: {}".format(
-                epoch + 1, train_loss, test_loss, train_uas, test_uas
-            ))
+        if (epoch + 1) % test_epoch == 0 and evaluator is None:
+            record_test(epoch, evaluate_training(model, train_dataset, test_loader, loss_func, train_eval_size,
+                                                 train_eval_seed, config, with_labels, model_type == 'joint'),
+                        model.state_dict())
             model.train()
-            if checkpoint_at_test:
-                torch.save({'state_dict': model.state_dict(), 'args': model.args,
-                            'test_uas': test_uas, 'train_uas': train_uas,
-                            'indexing_dictionaries': (train_dataset.word_idx_mappings, test_dataset.pos_idx_mappings,
-                                                      train_dataset.word_idx_to_appearance, None)
-                            }, checkpoint_path+'_'+str(epoch+1))
         else:
             print("Epoch {} Completed,\tTrain Loss: {}".format(
-                epoch + 1, printable_loss * acumulate_grad_steps / len(train_loader)
+                epoch + 1, printable_loss * acumulate_grad_steps / len(train_data)
             ))
+            if evaluator is not None:
+                evaluator.poll()
+                if (epoch + 1) % test_epoch == 0:
+                    evaluator.submit(epoch)
+    if evaluator is not None:
+        evaluator.close()
+    if checkpoint_writer is not None:
+        # the state at the end, a run with more epochs resumed from it continues this one
+        printable_loss = 0
+        checkpoint_writer.save(training_state(epochs, 0), step)
+        checkpoint_writer.close()
     if save_model:
-        torch.save({'state_dict': model.state_dict(), 'args': model.args,
-                    'test_uas_arr': test_uas_array, 'train_uas_arr': train_uas_array,
-                    'test_loss_arr': test_loss_array, 'train_loss_arr': train_loss_array,
-                    'indexing_dictionaries': (train_dataset.word_idx_mappings, test_dataset.pos_idx_mappings,
-                                              train_dataset.word_idx_to_appearance, None)
-                    }, model_path)
+        torch.save(dict(model_bundle(model.state_dict()),
+                        test_uas_arr=test_uas_array, train_uas_arr=train_uas_array,
+                        test_loss_arr=test_loss_array, train_loss_arr=train_loss_array,
+                        test_las_arr=test_las_array), model_path)
     if save_plots:
         epochs_arr = np.arange(1, epochs + 1, test_epoch)
 
@@ -128,6 +355,41 @@ def train(epochs, model_type='advanced', test_epoch=1, save_model=True, model_pa
         print('training took:', time.time()-t0)
 
 
+def compare_word_representations(epochs=4, model_type='base', hash_buckets=(20000,), ranks=(16,),
+                                 quantizations=((4, 256),), execution_config=None):
+    """
+    trains a model with every word representation and prints their size, latency and test UAS (see
+    eval.compare_models): the vocabulary of train with a full embedding table, the words hashed into buckets, a low
+    rank embedding table, and the product quantization of the table of the trained full model
+    :param hash_buckets: the numbers of hash buckets
+    :param ranks: the ranks of the low rank tables
+    :param quantizations: (num_subspaces, num_centroids) of the product quantized tables
+    :return: the results of eval.compare_models
+    """
+    full_path = 'words_full.pkl'
+    train(epochs, model_type=model_type, model_path=full_path, execution_config=execution_config)
+    bundles = {'full vocabulary': (full_path, model_type)}
+    for num_buckets in hash_buckets:
+        model_path = 'words_hashed_{}.pkl'.format(num_buckets)
+        train(epochs, model_type=model_type, model_path=model_path, execution_config=execution_config,
+              word_hash_buckets=num_buckets)
+        bundles['hashed {} buckets'.format(num_buckets)] = (model_path, model_type)
+    for rank in ranks:
+        model_path = 'words_low_rank_{}.pkl'.format(rank)
+        train(epochs, model_type=model_type, model_path=model_path, execution_config=execution_config,
+              model_kwargs={'word_embedding_compression': {'type': 'low_rank', 'rank': rank}})
+        bundles['low rank {}'.format(rank)] = (model_path, model_type)
+    for num_subspaces, num_centroids in quantizations:
+        model_path = 'words_pq_{}_{}.pkl'.format(num_subspaces, num_centroids)
+        bundle = torch.load(full_path, weights_only=False)
+        model = load_model(full_path, model_type, return_indexing_dictionaries=False)
+        compress_word_embedding(model, {'type': 'pq', 'num_subspaces': num_subspaces, 'num_centroids': num_centroids})
+        bundle.update(state_dict=model.state_dict(), args=model.args)
+        torch.save(bundle, model_path)
+        bundles['product quantized {}x{}'.format(num_subspaces, num_centroids)] = (model_path, model_type)
+    return compare_models(bundles, execution_config=execution_config)
+
+
 if __name__ == '__main__':
     train(4, model_type='base', save_model=True, model_path="basic_model.pkl", time_run=True)
     train(18, model_type='advanced', save_model=True, model_path="advanced_model.pkl", time_run=True)
@@ -1,17 +1,18 @@
-from code_directory.tag_file import tag_file
+from code_directory.tag_file import tag_files
 
 
-def generate_comp_tagged(model='both'):
+def generate_comp_tagged(model='both', execution_config=None):
     """
 
     :param model: the model to tag with base for the basic model advanced for the advanced model and both for both
+    :param execution_config: the execution config (see code_directory.execution.configure_execution)
     """
+    jobs = []
     if model == 'base' or model == 'both':
-        tag_file(dir_path='./code_directory/data', file='comp.unlabeled', out_path='comp_m1_318556206.labeled',
-                 model_path='./code_directory/basic_model.pkl', model_type='base')
+        jobs.append(('comp_m1_318556206.labeled', './code_directory/basic_model.pkl', 'base'))
     if model == 'advanced' or model == 'both':
-        tag_file(dir_path='./code_directory/data', file='comp.unlabeled', out_path='comp_m2_318556206.labeled',
-                 model_path='./code_directory/advanced_model.pkl', model_type='advanced')
+        jobs.append(('comp_m2_318556206.labeled', './code_directory/advanced_model.pkl', 'advanced'))
+    tag_files(dir_path='./code_directory/data', file='comp.unlabeled', jobs=jobs, execution_config=execution_config)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,29 @@
+import random
+
+import pytest
+
+
+def write_conll(path, num_sentences, seed=0):
+    """
+    writes a labeled file of random sentences (every word gets a random earlier head, so the heads form a tree)
+    """
+    rng = random.Random(seed)
+    words = ['w{}'.format(i) for i in range(30)]
+    tags = ['NN', 'VB', 'DT', 'JJ', 'IN']
+    labels = ['SBJ', 'OBJ', 'NMOD', 'ROOT']
+    with open(path, 'w') as f:
+        for _ in range(num_sentences):
+            for i in range(1, rng.randint(2, 9)):
+                f.write('\t'.join([str(i), rng.choice(words), '_', rng.choice(tags), '_', '_',
+                                   str(rng.randrange(i)), rng.choice(labels), '_', '_']) + '\n')
+            f.write('\n')
+
+
+@pytest.fixture
+def conll_dir(tmp_path):
+    """
+    a directory with a small train.labeled and test.labeled
+    """
+    write_conll(tmp_path / 'train.labeled', 60, seed=0)
+    write_conll(tmp_path / 'test.labeled', 20, seed=1)
+    return str(tmp_path)
@@ -0,0 +1,38 @@
+import time
+
+import torch
+
+from code_directory.Models import BaseNet, nll_loss
+from code_directory.async_eval import BackgroundEvaluator
+from code_directory.data_loader import DpDataset
+from code_directory.train_model import train
+
+
+def test_results_come_back_before_close(conll_dir):
+    train_dataset = DpDataset(conll_dir, 'train')
+    test_dataset = DpDataset(conll_dir, 'test', vocab_dataset=train_dataset)
+    model = BaseNet(len(train_dataset.word_idx_mappings), len(train_dataset.pos_idx_mappings),
+                    lstm_hidden_dim=16, mlp_hidden_dim=16, device=torch.device('cpu'))
+    results = []
+    evaluator = BackgroundEvaluator(model, train_dataset, test_dataset, nll_loss,
+                                    lambda epoch, result, state_dict: results.append((epoch, result)),
+                                    train_eval_size=10)
+    try:
+        evaluator.submit(0)
+        deadline = time.time() + 120
+        while not results and time.time() < deadline:
+            evaluator.poll()
+            time.sleep(0.1)
+        assert [epoch for epoch, _ in results] == [0]
+        assert 0 <= results[0][1]['test_uas'] <= 1
+    finally:
+        evaluator.close()
+
+
+def test_synchronous_train_skips_the_evaluation_of_untested_epochs(conll_dir, tmp_path):
+    train_dataset = DpDataset(conll_dir, 'train')
+    test_dataset = DpDataset(conll_dir, 'test', vocab_dataset=train_dataset)
+    train(2, test_epoch=2, model_type='base', model_path=str(tmp_path / 'model.pkl'),
+          datasets=(train_dataset, test_dataset), train_eval_size=10,
+          model_kwargs={'lstm_hidden_dim': 16, 'mlp_hidden_dim': 16, 'lstm_layers': 1})
+    assert len(torch.load(str(tmp_path / 'model.pkl'), weights_only=False)['test_uas_arr']) == 1
@@ -0,0 +1,26 @@
+import glob
+
+import torch
+
+from code_directory.data_loader import DpDataset
+from code_directory.train_model import train
+
+
+def test_resuming_in_the_middle_of_an_epoch_is_exact(conll_dir, tmp_path):
+    train_dataset = DpDataset(conll_dir, 'train')
+    test_dataset = DpDataset(conll_dir, 'test', vocab_dataset=train_dataset)
+    train_kwargs = dict(model_type='base', datasets=(train_dataset, test_dataset), train_eval_size=10,
+                        model_kwargs={'lstm_hidden_dim': 16, 'mlp_hidden_dim': 16, 'lstm_layers': 1})
+    # 60 sentences and an optimizer step every 50, so the checkpoint of the first step is in the middle of epoch 1
+    train(2, model_path=str(tmp_path / 'model.pkl'), checkpoint_dir=str(tmp_path / 'checkpoints'),
+          checkpoint_every_steps=1, keep_checkpoints=10, **train_kwargs)
+    checkpoints = [path for path in sorted(glob.glob(str(tmp_path / 'checkpoints' / 'checkpoint_*.pt')))
+                   if torch.load(path, weights_only=False)['sentence'] != 0]
+    assert checkpoints
+    train(2, model_path=str(tmp_path / 'resumed.pkl'), resume=checkpoints[0], **train_kwargs)
+    bundle, resumed_bundle = [torch.load(str(tmp_path / name), weights_only=False)
+                              for name in ['model.pkl', 'resumed.pkl']]
+    for name, tensor in bundle['state_dict'].items():
+        assert torch.equal(tensor, resumed_bundle['state_dict'][name]), name
+    assert bundle['test_uas_arr'] == resumed_bundle['test_uas_arr']
+    assert bundle['train_loss_arr'] == resumed_bundle['train_loss_arr']
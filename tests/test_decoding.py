@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+
+from code_directory.decoding import HybridDecoder, candidate_heads, chu_liu_edmonds_decode, eisner_decode, \
+    greedy_chu_liu_edmonds_decode, k_best_decode, pruned_chu_liu_edmonds_decode
+from tests.trees import all_trees, is_projective, is_tree, tree_score
+
+
+def _random_scores(seed, max_words=5):
+    rng = np.random.default_rng(seed)
+    n = rng.integers(1, max_words + 1)
+    return rng.normal(size=(n + 1, n))
+
+
+@pytest.mark.parametrize('decode', [chu_liu_edmonds_decode, greedy_chu_liu_edmonds_decode])
+def test_maximum_spanning_tree_decoders_match_brute_force(decode):
+    for seed in range(30):
+        scores = _random_scores(seed)
+        heads = decode(scores)
+        assert is_tree(heads)
+        best = max(tree_score(scores, tree) for tree in all_trees(scores.shape[1]))
+        assert tree_score(scores, heads) == pytest.approx(best)
+
+
+def test_eisner_decode_matches_the_best_projective_tree():
+    for seed in range(30):
+        scores = _random_scores(seed)
+        heads = eisner_decode(scores)
+        assert is_projective(heads)
+        best = max(tree_score(scores, tree) for tree in all_trees(scores.shape[1]) if is_projective(tree))
+        assert tree_score(scores, heads) == pytest.approx(best)
+
+
+def test_k_best_decode_matches_the_sorted_trees():
+    for seed in range(20):
+        scores = _random_scores(seed)
+        tree_scores = sorted((tree_score(scores, tree) for tree in all_trees(scores.shape[1])), reverse=True)
+        trees = k_best_decode(scores, 10)
+        assert len(trees) == min(10, len(tree_scores))
+        assert len({tuple(heads) for heads, _ in trees}) == len(trees)
+        for (heads, score), expected_score in zip(trees, tree_scores):
+            assert is_tree(heads)
+            assert score == pytest.approx(tree_score(scores, heads))
+            assert score == pytest.approx(expected_score)
+
+
+def test_pruned_chu_liu_edmonds_matches_the_best_tree_of_the_candidate_graph():
+    for seed in range(30):
+        scores = _random_scores(seed)
+        for k in [1, 2, scores.shape[0]]:
+            candidates = candidate_heads(scores, k)
+            heads = pruned_chu_liu_edmonds_decode(scores, k)
+            assert is_tree(heads)
+            assert candidates[heads, np.arange(len(heads))].all()
+            best = max(tree_score(scores, tree) for tree in all_trees(scores.shape[1])
+                       if candidates[tree, np.arange(len(tree))].all())
+            assert tree_score(scores, heads) == pytest.approx(best)
+
+
+def test_pruned_chu_liu_edmonds_without_pruning_is_chu_liu_edmonds_on_long_sentences():
+    rng = np.random.default_rng(0)
+    for n in [20, 50, 80]:
+        scores = rng.normal(size=(n + 1, n))
+        assert tree_score(scores, pruned_chu_liu_edmonds_decode(scores, k=n)) == pytest.approx(
+            tree_score(scores, chu_liu_edmonds_decode(scores)))
+
+
+def test_hybrid_decoder_calibrates_on_the_sentences_it_decodes():
+    decoder = HybridDecoder(calibration_path=None, calibration_sentences=5)
+    sentences = [_random_scores(seed, max_words=8) for seed in range(20)]
+    for scores in sentences:
+        assert tree_score(scores, decoder.decode(scores)) == pytest.approx(
+            tree_score(scores, chu_liu_edmonds_decode(scores)))
+    assert decoder.calibration is not None
+    # the sentences decoded after the calibration are routed, the ones before it were decoded with Chu-Liu-Edmonds
+    assert sum(sum(lengths.values()) for lengths in decoder.decisions.values()) < len(sentences)
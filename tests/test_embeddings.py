@@ -0,0 +1,72 @@
+import copy
+
+import pytest
+import torch
+
+from code_directory.Models import AdvancedNet, BaseNet, LowRankEmbedding, ProductQuantizedEmbedding, \
+    compress_word_embedding, fuse_embedding_projection
+from code_directory.data_loader import SPECIAL_TOKENS, DpDataset, HashedVocab
+from code_directory.eval import load_model
+
+
+def test_full_rank_low_rank_embedding_is_the_table():
+    table = torch.randn(40, 12)
+    embedding = LowRankEmbedding.from_pretrained(table, rank=12)
+    assert torch.allclose(embedding.weight, table, atol=1e-5)
+    assert torch.allclose(embedding(torch.tensor([[3, 7]])), table[[3, 7]].unsqueeze(0), atol=1e-5)
+
+
+def test_product_quantization():
+    table = torch.randn(16, 12)
+    embedding = ProductQuantizedEmbedding.from_pretrained(table, num_subspaces=3, num_centroids=16)
+    assert embedding.codes.dtype == torch.uint8
+    # as many centroids as words, every word is a centroid
+    assert torch.allclose(embedding.weight, table)
+    table = torch.randn(300, 12)
+    errors = [(ProductQuantizedEmbedding.from_pretrained(table, num_subspaces=3, num_centroids=num_centroids).weight -
+               table).pow(2).mean() for num_centroids in [4, 64]]
+    assert errors[1] < errors[0]
+
+
+def test_compressed_model_keeps_its_scores():
+    torch.manual_seed(0)
+    model = BaseNet(60, 10, word_emb_dim=20, device=torch.device('cpu')).eval()
+    words_idx, pos_idx = torch.randint(0, 60, (1, 6)), torch.randint(0, 10, (1, 6))
+    with torch.no_grad():
+        scores = model(words_idx, pos_idx)
+        compress_word_embedding(model, {'type': 'low_rank', 'rank': 20})
+        assert torch.allclose(model(words_idx, pos_idx), scores, atol=1e-4)
+    loaded_model = BaseNet(**model.args)
+    loaded_model.load_state_dict(model.state_dict())
+    assert isinstance(loaded_model.word_embedding, LowRankEmbedding)
+
+
+@pytest.mark.parametrize('model_class', [BaseNet, AdvancedNet])
+@pytest.mark.parametrize('lstm_layers', [1, 2])
+def test_fused_embedding_projection_keeps_the_scores(model_class, lstm_layers):
+    torch.manual_seed(0)
+    model = model_class(60, 10, word_emb_dim=20, tag_emb_dim=8, lstm_hidden_dim=16, lstm_layers=lstm_layers,
+                        device=torch.device('cpu')).eval()
+    fused_model = fuse_embedding_projection(copy.deepcopy(model))
+    words_idx, pos_idx = torch.randint(0, 60, (3, 7)), torch.randint(0, 10, (3, 7))
+    with torch.no_grad():
+        assert torch.allclose(fused_model(words_idx, pos_idx), model(words_idx, pos_idx), atol=1e-5)
+    # the fused tables are not saved
+    assert fused_model.state_dict().keys() == model.state_dict().keys()
+
+
+def test_hashed_vocab():
+    vocab = HashedVocab(100)
+    assert [vocab[token] for token in SPECIAL_TOKENS] == list(range(len(SPECIAL_TOKENS)))
+    assert vocab['parser'] == vocab.get('parser') == HashedVocab(100)['parser']
+    assert len(SPECIAL_TOKENS) <= vocab['parser'] < len(vocab) == len(SPECIAL_TOKENS) + 100
+
+
+def test_load_model_of_a_hashed_bundle(conll_dir, tmp_path):
+    dataset = DpDataset(conll_dir, 'train', word_hash_buckets=50)
+    model = BaseNet(len(dataset.word_idx_mappings), len(dataset.pos_idx_mappings), device=torch.device('cpu'))
+    torch.save({'state_dict': model.state_dict(), 'args': model.args,
+                'indexing_dictionaries': (dataset.word_idx_mappings, dataset.pos_idx_mappings,
+                                          dataset.word_idx_to_appearance, None)}, str(tmp_path / 'model.pkl'))
+    _, indexing_dictionaries = load_model(str(tmp_path / 'model.pkl'), 'base')
+    assert indexing_dictionaries[0] == HashedVocab(50)
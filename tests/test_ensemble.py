@@ -0,0 +1,26 @@
+import pytest
+import torch
+
+from code_directory.Models import AdvancedNet, BaseNet, EnsembleModel
+
+
+def _models(model_class, num_models, **kwargs):
+    models = []
+    for seed in range(num_models):
+        torch.manual_seed(seed)
+        models.append(model_class(50, 10, device=torch.device('cpu'), **kwargs).eval())
+    return models
+
+
+@pytest.mark.parametrize('model_class', [BaseNet, AdvancedNet])
+def test_ensemble_averages_the_scores_of_its_models(model_class):
+    models = _models(model_class, 3)
+    words_idx, pos_idx = torch.randint(0, 50, (2, 7)), torch.randint(0, 10, (2, 7))
+    with torch.no_grad():
+        expected = sum(model(words_idx, pos_idx) for model in models) / len(models)
+        assert torch.allclose(EnsembleModel(models)(words_idx, pos_idx), expected, atol=1e-6)
+
+
+def test_ensemble_of_different_architectures_is_rejected():
+    with pytest.raises(ValueError):
+        EnsembleModel(_models(BaseNet, 1) + _models(BaseNet, 1, lstm_hidden_dim=20))
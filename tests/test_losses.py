@@ -0,0 +1,83 @@
+import functools
+
+import torch
+
+from code_directory.Models import (arc_marginals, masked_nll_loss, nll_loss, tree_crf_loss, tree_log_partition,
+                                   variational_paper_loss)
+from code_directory.eval import evaluate_scores
+from tests.trees import all_trees, tree_score
+
+
+def test_masked_nll_loss_of_a_padded_batch_is_the_mean_over_its_words():
+    torch.manual_seed(0)
+    lengths = [3, 5, 2]
+    sentences = [(torch.randn(n + 1, n), torch.randint(0, n + 1, (n,))) for n in lengths]
+    max_len = max(lengths)
+    out = torch.full((len(lengths), max_len + 1, max_len), 7.)
+    true_heads = torch.zeros((len(lengths), max_len), dtype=torch.long)
+    mask = torch.zeros((len(lengths), max_len), dtype=torch.bool)
+    for b, (scores, heads) in enumerate(sentences):
+        n = len(heads)
+        out[b, :n + 1, :n] = scores
+        true_heads[b, :n] = heads
+        mask[b, :n] = True
+    expected = sum(nll_loss(scores, heads) * len(heads) for scores, heads in sentences) / sum(lengths)
+    assert torch.allclose(masked_nll_loss(out, true_heads, mask), expected)
+
+
+def test_nll_loss_is_stable_for_large_scores():
+    scores = torch.tensor([[1e4, -1e4], [0., 1e4], [-1e4, 0.]])
+    loss = nll_loss(scores, torch.tensor([0, 1]))
+    assert torch.isfinite(loss) and loss.item() == 0.
+
+
+def test_evaluate_scores_ignores_the_heads_decoded_on_noisy_scores():
+    true_heads = torch.tensor([0, 1, 2])
+    scores = torch.zeros(1, 4, 3)
+    scores[0, true_heads, torch.arange(3)] = 2.
+    # the plain tree attaches the third word to the first one
+    scores[0, 1, 2] = 2.5
+    loss = functools.partial(variational_paper_loss, std=1.)
+    torch.manual_seed(0)
+    assert all(evaluate_scores(scores, true_heads, loss)[0] == 2 for _ in range(100))
+
+
+def _brute_force_log_partition(scores):
+    return torch.logsumexp(torch.tensor([tree_score(scores.numpy(), heads) for heads in all_trees(scores.shape[1])],
+                                        dtype=torch.float64), dim=0)
+
+
+def test_tree_log_partition_is_the_sum_over_all_trees():
+    torch.manual_seed(0)
+    for n in range(1, 6):
+        scores = 3 * torch.randn(n + 1, n, dtype=torch.float64)
+        assert torch.allclose(tree_log_partition(scores.unsqueeze(0))[0], _brute_force_log_partition(scores))
+
+
+def test_tree_log_partition_of_a_padded_batch():
+    torch.manual_seed(1)
+    lengths = [2, 4, 3]
+    out = torch.randn(len(lengths), max(lengths) + 1, max(lengths), dtype=torch.float64)
+    mask = torch.arange(max(lengths)).unsqueeze(0) < torch.tensor(lengths).unsqueeze(1)
+    log_partition = tree_log_partition(out, mask)
+    for b, n in enumerate(lengths):
+        assert torch.allclose(log_partition[b], _brute_force_log_partition(out[b, :n + 1, :n]))
+
+
+def test_tree_crf_loss_is_the_negative_log_probability_of_the_true_tree():
+    torch.manual_seed(2)
+    scores = torch.randn(5, 4, dtype=torch.float64)
+    true_heads = torch.tensor([2, 0, 2, 3])
+    expected = _brute_force_log_partition(scores) - tree_score(scores.numpy(), true_heads.numpy())
+    assert torch.allclose(tree_crf_loss(scores, true_heads), expected)
+
+
+def test_arc_marginals_are_the_probabilities_of_the_arcs_over_all_trees():
+    torch.manual_seed(3)
+    scores = torch.randn(5, 4, dtype=torch.float64)
+    trees = all_trees(4)
+    probs = torch.softmax(torch.tensor([tree_score(scores.numpy(), heads) for heads in trees]), dim=0)
+    expected = torch.zeros_like(scores)
+    for heads, prob in zip(trees, probs):
+        expected[heads, torch.arange(4)] += prob
+    assert torch.allclose(arc_marginals(scores.unsqueeze(0))[0], expected)
@@ -0,0 +1,48 @@
+import itertools
+
+import numpy as np
+
+
+def is_tree(heads):
+    """
+    :param heads: the heads of the words 1..n (0 is the root)
+    :return: True if every word reaches the root (the root may have several modifiers)
+    """
+    for word in range(1, len(heads) + 1):
+        visited = set()
+        while word != 0:
+            if word in visited:
+                return False
+            visited.add(word)
+            word = heads[word - 1]
+    return True
+
+
+def is_projective(heads):
+    """
+    :return: True if every word between a head and its modifier is a descendant of the head
+    """
+    def ancestors(word):
+        while word != 0:
+            word = heads[word - 1]
+            yield word
+    for modifier, head in enumerate(heads, 1):
+        for word in range(min(head, modifier) + 1, max(head, modifier)):
+            if head not in ancestors(word):
+                return False
+    return True
+
+
+def all_trees(num_words):
+    """
+    :return: the heads of every dependency tree of num_words words
+    """
+    choices = [[head for head in range(num_words + 1) if head != modifier] for modifier in range(1, num_words + 1)]
+    return [np.array(heads) for heads in itertools.product(*choices) if is_tree(heads)]
+
+
+def tree_score(scores, heads):
+    """
+    :param scores: a np array from the shape (n+1, n) such that scores[h, m-1] is the score of (h, m)
+    """
+    return float(scores[heads, np.arange(len(heads))].sum())